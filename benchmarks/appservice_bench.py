@@ -0,0 +1,123 @@
+"""Compare receiving matrix events by per-user sync and as an application service.
+
+Resumes `users` sessions against a stand-in homeserver, all in the same
+room, then posts messages to that room. With per-user sync every client
+long-polls the homeserver from its own thread; as an application service
+the homeserver pushes each message once and matrigram fans it out.
+Reported are the threads matrigram needs, the requests the homeserver
+serves per message and the time until a message reached every user.
+The stand-in runs in the same process, so serving the syncs also weighs on
+the fan-out time of per-user sync.
+
+Run with ``PYTHONPATH=. python benchmarks/appservice_bench.py``.
+"""
+import threading
+import time
+
+from benchmarks.homeserver import Homeserver
+from matrigram.appservice import AppService
+from matrigram.client import MatrigramClient
+
+USER_COUNTS = (100, 1000)
+MESSAGES = 10
+ROOM_ID = '!room0:bench'
+
+
+class Bridge(object):
+    """The parts of the bot clients call back into."""
+
+    def __init__(self, appservice=None):
+        self.appservice = appservice
+
+    def checkpoint_session(self, client, force=False):
+        pass
+
+
+class Deliveries(object):
+    def __init__(self, users):
+        self.users = users
+        self.cond = threading.Condition()
+        self.received = {}  # event id -> users who got it
+
+    def on_event(self, room, event):
+        with self.cond:
+            self.received[event['event_id']] = self.received.get(event['event_id'], 0) + 1
+            self.cond.notify_all()
+
+    def wait(self, event_id):
+        with self.cond:
+            while self.received.get(event_id, 0) < self.users:
+                self.cond.wait()
+
+
+def session(homeserver, i):
+    return {
+        'server': homeserver.url, 'username': 'user{}'.format(i),
+        'user_id': '@user{}:bench'.format(i), 'token': 'token-user{}'.format(i),
+        'device_id': 'DEVICE', 'focus_room_id': None, 'since': '0',
+        'rooms': {ROOM_ID: {'name': 'Room', 'canonical_alias': None, 'aliases': []}},
+    }
+
+
+def bridge_threads():
+    # threads of the stand-in homeserver serve its connections
+    return sum(1 for thread in threading.enumerate()
+               if 'process_request_thread' not in thread.name and
+               thread is not threading.current_thread())
+
+
+def run(users, push):
+    homeserver = Homeserver(rooms=1, members=10, sync_timeout=30)
+    threads = bridge_threads()
+    appservice = None
+    if push:
+        appservice = AppService('hs', port=0, connections=1)
+        appservice.start()
+        homeserver.appservice_url = 'http://127.0.0.1:{}'.format(appservice.server_address[1])
+        homeserver.hs_token = 'hs'
+
+    bridge = Bridge(appservice)
+    deliveries = Deliveries(users)
+    clients = []
+    for i in range(users):
+        client = MatrigramClient(homeserver.url, bridge, 'user{}'.format(i))
+        client.restore(session(homeserver, i))
+        client.client.rooms[ROOM_ID].add_listener(deliveries.on_event)
+        clients.append(client)
+    threads = bridge_threads() - threads
+    # let every client settle in its long poll
+    time.sleep(2)
+
+    requests_before = homeserver.counters['sync'] + homeserver.counters['transactions']
+    latencies = []
+    for i in range(MESSAGES):
+        start = time.time()
+        event = homeserver.post_event(ROOM_ID, '@other:bench', 'message {}'.format(i))
+        deliveries.wait(event['event_id'])
+        latencies.append(time.time() - start)
+    served = homeserver.counters['sync'] + homeserver.counters['transactions'] - requests_before
+
+    for client in clients:
+        client.client.should_listen = False
+    homeserver.shutdown()
+    for client in clients:
+        if client.client.sync_thread is not None:
+            client.client.sync_thread.join()
+    if appservice is not None:
+        appservice.shutdown()
+    latencies.sort()
+    return threads, float(served) / MESSAGES, latencies[len(latencies) // 2]
+
+
+def main():
+    print('{:>6} {:<12} {:>8} {:>14} {:>16}'.format('users', 'mode', 'threads',
+                                                    'requests/msg', 'fan-out p50'))
+    for users in USER_COUNTS:
+        for name, push in (('sync', False), ('appservice', True)):
+            threads, served, latency = run(users, push)
+            print('{:>6} {:<12} {:>8} {:>14.1f} {:>13.1f} ms'.format(
+                users, name, threads, served, latency * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,242 @@
+"""Stand-in matrix homeserver for benchmarks.
+
+Serves just enough of the client-server API for matrigram to log in, sync
+and look up rooms. Every account is in the same `rooms` rooms, each with
+`members` members, so an initial sync downloads a realistic amount of
+state. Incremental syncs wait for events posted with :meth:`post_event`
+and return them. Sync filters are honoured for presence, state event types
+and lazy loaded members.
+
+When `appservice_url` is set, posted events are also pushed to that
+application service in transactions.
+"""
+import itertools
+import json
+import time
+from threading import Condition
+from threading import Lock
+from threading import Thread
+
+import requests
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler
+    from BaseHTTPServer import HTTPServer
+    from Queue import Queue
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs
+    from urlparse import urlparse
+except ImportError:
+    from http.server import BaseHTTPRequestHandler
+    from http.server import HTTPServer
+    from queue import Queue
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs
+    from urllib.parse import urlparse
+
+PREFIX = '/_matrix/client/r0'
+SERVER_NAME = 'bench'
+
+
+def _state_event(event_type, state_key, content, sender='@admin:bench'):
+    return {'type': event_type, 'state_key': state_key, 'content': content,
+            'sender': sender, 'event_id': '${}{}'.format(event_type, state_key),
+            'origin_server_ts': 0}
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.server.homeserver.handle(self, 'GET')
+
+    def do_POST(self):
+        self.server.homeserver.handle(self, 'POST')
+
+    def do_PUT(self):
+        self.server.homeserver.handle(self, 'PUT')
+
+    def log_message(self, *args):
+        pass
+
+
+class Homeserver(object):
+    def __init__(self, rooms=20, members=200, sync_timeout=1.0, appservice_url=None,
+                 hs_token=None):
+        self.sync_timeout = sync_timeout
+        self.appservice_url = appservice_url
+        self.hs_token = hs_token
+        self.lock = Lock()
+        self.counters = {'login': 0, 'initial_sync': 0, 'sync': 0, 'bytes': 0,
+                         'transactions': 0}
+        self.filters = []
+        self.new_events = Condition()
+        self.timeline = []  # (stream position, room id, event)
+        self._event_ids = itertools.count()
+        self._closed = False
+        self._pushes = Queue()
+        self.rooms = {}
+        for i in range(rooms):
+            room_id = '!room{}:{}'.format(i, SERVER_NAME)
+            state = [
+                _state_event('m.room.name', '', {'name': 'Room {}'.format(i)}),
+                _state_event('m.room.aliases', SERVER_NAME,
+                             {'aliases': ['#room{}:{}'.format(i, SERVER_NAME)]}),
+                _state_event('m.room.canonical_alias', '',
+                             {'alias': '#room{}:{}'.format(i, SERVER_NAME)}),
+            ]
+            state.extend(_state_event('m.room.member', '@member{}:bench'.format(m),
+                                      {'membership': 'join',
+                                       'displayname': 'Member {}'.format(m)})
+                         for m in range(members))
+            self.rooms[room_id] = state
+
+        self._server = _Server(('127.0.0.1', 0), _Handler)
+        self._server.homeserver = self
+        for target in (self._server.serve_forever, self._push):
+            thread = Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self._server.server_address[1])
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def handle(self, request, method):
+        url = urlparse(request.path)
+        path = url.path[len(PREFIX):]
+        query = parse_qs(url.query)
+        length = int(request.headers.get('Content-Length') or 0)
+        body = json.loads(request.rfile.read(length).decode('utf-8')) if length else {}
+
+        if path == '/login':
+            self.count('login')
+            user = body.get('user') or body['identifier']['user']
+            result = {'user_id': '@{}:{}'.format(user, SERVER_NAME),
+                      'access_token': 'token-{}'.format(user),
+                      'device_id': 'DEVICE', 'home_server': SERVER_NAME}
+        elif path.startswith('/user/') and path.endswith('/filter'):
+            with self.lock:
+                self.filters.append(body)
+                result = {'filter_id': str(len(self.filters) - 1)}
+        elif path == '/sync':
+            result = self.sync(query.get('since', [None])[0],
+                               int(query.get('timeout', ['0'])[0]) / 1000.0,
+                               query.get('filter', [None])[0])
+        elif path.startswith('/rooms/') and path.endswith('/state'):
+            result = self.rooms.get(path.split('/')[2], [])
+        else:
+            result = {}
+
+        data = json.dumps(result).encode('utf-8')
+        with self.lock:
+            self.counters['bytes'] += len(data)
+        request.send_response(200)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Content-Length', str(len(data)))
+        request.end_headers()
+        request.wfile.write(data)
+
+    def _filter(self, filter_param):
+        if filter_param is None:
+            return {}
+        if filter_param.isdigit():
+            return self.filters[int(filter_param)]
+        return json.loads(filter_param)
+
+    def post_event(self, room_id, sender, body):
+        """Send a text message to a room, as `sender`.
+
+        Returns:
+            dict: The event.
+        """
+        event = {'type': 'm.room.message', 'room_id': room_id, 'sender': sender,
+                 'event_id': '$bench{}'.format(next(self._event_ids)),
+                 'origin_server_ts': int(time.time() * 1000),
+                 'content': {'msgtype': 'm.text', 'body': body}}
+        with self.new_events:
+            self.timeline.append((len(self.timeline) + 1, room_id, event))
+            self.new_events.notify_all()
+        if self.appservice_url is not None:
+            self._pushes.put(event)
+        return event
+
+    def _push(self):
+        session = requests.Session()
+        for txn_id in itertools.count():
+            events = [self._pushes.get()]
+            while not self._pushes.empty():
+                events.append(self._pushes.get())
+            self.count('transactions')
+            session.put('{}/_matrix/app/v1/transactions/{}'.format(self.appservice_url, txn_id),
+                        params={'access_token': self.hs_token},
+                        data=json.dumps({'events': events}))
+
+    def sync(self, since, timeout, filter_param):
+        if since is not None:
+            self.count('sync')
+            position = int(since) if since.isdigit() else 0
+            deadline = time.time() + min(timeout, self.sync_timeout)
+            with self.new_events:
+                while (len(self.timeline) <= position and time.time() < deadline and
+                       not self._closed):
+                    self.new_events.wait(deadline - time.time())
+                new = self.timeline[position:]
+                next_batch = str(len(self.timeline))
+
+            join = {}
+            for _, room_id, event in new:
+                room = join.setdefault(room_id, {
+                    'timeline': {'events': [], 'prev_batch': since, 'limited': False},
+                })
+                room['timeline']['events'].append(event)
+            return {'next_batch': next_batch, 'rooms': {'join': join}}
+
+        self.count('initial_sync')
+        definition = self._filter(filter_param)
+        state_filter = definition.get('room', {}).get('state', {})
+        types = state_filter.get('types')
+        lazy = state_filter.get('lazy_load_members', False)
+
+        join = {}
+        members = set()
+        for room_id, state in self.rooms.items():
+            events = [event for event in state
+                      if (types is None or event['type'] in types) and
+                      not (lazy and event['type'] == 'm.room.member')]
+            members.update(event['state_key'] for event in state
+                           if event['type'] == 'm.room.member')
+            join[room_id] = {
+                'state': {'events': events},
+                'timeline': {'events': [], 'prev_batch': 'p0', 'limited': False},
+                'ephemeral': {'events': []},
+            }
+
+        with self.new_events:
+            next_batch = str(len(self.timeline))
+        response = {'next_batch': next_batch,
+                    'rooms': {'join': join, 'invite': {}, 'leave': {}}}
+        if definition.get('presence', {}).get('types') != []:
+            response['presence'] = {'events': [
+                {'type': 'm.presence', 'sender': member,
+                 'content': {'presence': 'online', 'last_active_ago': 1000}}
+                for member in sorted(members)]}
+        return response
+
+    def shutdown(self):
+        with self.new_events:
+            # end pending syncs
+            self._closed = True
+            self.new_events.notify_all()
+        self._server.shutdown()
+        self._server.server_close()
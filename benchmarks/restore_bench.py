@@ -0,0 +1,68 @@
+"""Measure startup time of many users: logging in again versus resuming.
+
+Logs `USERS` users in against a stand-in homeserver, as matrigram did after
+every restart, then starts a new bot on the same data directory that
+resumes the saved sessions instead.
+
+Run with ``PYTHONPATH=. python benchmarks/restore_bench.py``.
+"""
+import shutil
+import tempfile
+import time
+
+from benchmarks.homeserver import Homeserver
+from matrigram.bot import MatrigramBot
+
+USERS = 50
+
+
+def make_bot(homeserver, data_dir):
+    bot = MatrigramBot('0:bench', config={'server': homeserver.url, 'data_dir': data_dir})
+    # there's no telegram to talk to
+    bot._reply = lambda *args, **kwargs: None
+    bot._send_chat_action = lambda *args, **kwargs: None
+    return bot
+
+
+def wait_logged_in(bot, count):
+    while len(bot.users) < count:
+        time.sleep(0.01)
+
+
+def main():
+    homeserver = Homeserver()
+    data_dir = tempfile.mkdtemp()
+    try:
+        bot = make_bot(homeserver, data_dir)
+        start = time.time()
+        for chat_id in range(USERS):
+            bot.login_executor.submit(chat_id, bot._do_login, chat_id,
+                                      'user{}'.format(chat_id), 'password')
+        wait_logged_in(bot, USERS)
+        login_time = time.time() - start
+        login_counters = dict(homeserver.counters)
+        for session in bot.users.sessions():
+            bot._save_session(session.chat_id, session.client)
+
+        restarted = make_bot(homeserver, data_dir)
+        start = time.time()
+        restarted.restore_sessions()
+        wait_logged_in(restarted, USERS)
+        restore_time = time.time() - start
+    finally:
+        homeserver.shutdown()
+        shutil.rmtree(data_dir)
+
+    restore_counters = dict((key, homeserver.counters[key] - login_counters[key])
+                            for key in login_counters)
+    print('{:<10} {:>10} {:>8} {:>14} {:>12}'.format('startup', 'time', 'logins',
+                                                     'initial syncs', 'downloaded'))
+    for name, elapsed, counters in (('login', login_time, login_counters),
+                                    ('resume', restore_time, restore_counters)):
+        print('{:<10} {:>8.2f} s {:>8} {:>14} {:>9.1f} MB'.format(
+            name, elapsed, counters['login'], counters['initial_sync'],
+            counters['bytes'] / 1e6))
+
+
+if __name__ == '__main__':
+    main()
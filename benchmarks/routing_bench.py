@@ -0,0 +1,46 @@
+"""Measure the per-message cost of routing telegram text messages.
+
+Compares the router of :class:`matrigram.bot.MatrigramBot` against trying
+every route pattern in order, which is how messages used to be routed.
+
+Run with ``PYTHONPATH=. python benchmarks/routing_bench.py``.
+"""
+import timeit
+
+from matrigram.bot import MatrigramBot
+
+NUMBER = 100000
+
+MESSAGES = [
+    ('chat text', 'hello everyone, how is it going?'),
+    ('/login', '/login username password'),
+    ('/me', '/me waves'),
+    ('/status', '/status'),
+    ('unknown command', '/unknown'),
+]
+
+
+def sequential_match(routes, text):
+    for pattern, callback in routes:
+        match = pattern.match(text)
+        if match:
+            return callback, match
+    return None, None
+
+
+def main():
+    bot = MatrigramBot('0:bench', config={'server': 'http://localhost'})
+    router = bot.text_router
+    routes = router.routes()
+
+    print('{:<16} {:>12} {:>12}'.format('message', 'sequential', 'router'))
+    for name, text in MESSAGES:
+        sequential = timeit.timeit(lambda: sequential_match(routes, text), number=NUMBER)
+        dispatched = timeit.timeit(lambda: router.match(text), number=NUMBER)
+        print('{:<16} {:>9.0f} ns {:>9.0f} ns'.format(name,
+                                                      sequential / NUMBER * 1e9,
+                                                      dispatched / NUMBER * 1e9))
+
+
+if __name__ == '__main__':
+    main()
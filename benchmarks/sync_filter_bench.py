@@ -0,0 +1,34 @@
+"""Measure the initial sync payload with and without matrigram's sync filter.
+
+Syncs once against a stand-in homeserver with the matrix SDK's default
+filter, which matrigram used to sync with, and with the filter built by
+:func:`matrigram.filters.sync_filter`.
+
+Run with ``PYTHONPATH=. python benchmarks/sync_filter_bench.py``.
+"""
+import json
+
+from matrix_client.api import MatrixHttpApi
+
+from benchmarks.homeserver import Homeserver
+from matrigram.filters import sync_filter
+
+SDK_FILTER = '{ "room": { "timeline" : { "limit" : 10 } } }'
+
+
+def main():
+    homeserver = Homeserver(rooms=20, members=500)
+    api = MatrixHttpApi(homeserver.url, 'token')
+    filter_id = api.create_filter('@bench:bench', sync_filter())['filter_id']
+
+    print('{:<12} {:>12} {:>14}'.format('filter', 'downloaded', 'state events'))
+    for name, sync_filter_param in (('sdk default', SDK_FILTER), ('matrigram', filter_id)):
+        response = api.sync(filter=sync_filter_param)
+        events = sum(len(room['state']['events']) for room in response['rooms']['join'].values())
+        print('{:<12} {:>9.2f} MB {:>14}'.format(name, len(json.dumps(response)) / 1e6, events))
+
+    homeserver.shutdown()
+
+
+if __name__ == '__main__':
+    main()
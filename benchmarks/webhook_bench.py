@@ -0,0 +1,181 @@
+"""Compare the latency of receiving updates by long polling and by webhook.
+
+A local stand-in for the Bot API produces updates. With long polling, the
+bot fetches them with telepot's ``getUpdates`` loop, as ``message_loop``
+does. With the webhook, the stand-in pushes each update to a
+:class:`matrigram.webhook.WebhookServer`. Latency is measured from the
+moment an update exists until the bot's ``on_chat_message`` sees it.
+
+The stand-in pushes webhook updates one at a time over a single
+connection, so the burst rate of the webhook is a lower bound: telegram
+pushes over up to 40 connections in parallel.
+
+Run with ``PYTHONPATH=. python benchmarks/webhook_bench.py``.
+"""
+import json
+import random
+import re
+import time
+from threading import Condition
+from threading import Event
+from threading import Thread
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler
+    from BaseHTTPServer import HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler
+    from http.server import HTTPServer
+    from socketserver import ThreadingMixIn
+
+import requests
+import telepot.api
+from telepot.loop import GetUpdatesLoop
+
+from matrigram.bot import MatrigramBot
+from matrigram.webhook import WebhookServer
+
+UPDATES = 200
+BURST = 500
+MAX_GAP = 0.02
+
+FIELD = re.compile(r'name="(\w+)"\r\n\r\n([^\r]*)')
+
+
+class UpdateQueue(object):
+    """Updates produced by the stand-in Bot API, served by ``getUpdates``."""
+
+    def __init__(self):
+        self.cond = Condition()
+        self.updates = []
+
+    def put(self, update):
+        with self.cond:
+            self.updates.append(update)
+            self.cond.notify_all()
+
+    def get(self, offset, timeout):
+        deadline = time.time() + timeout
+        with self.cond:
+            while True:
+                pending = [u for u in self.updates if u['update_id'] >= offset]
+                left = deadline - time.time()
+                if pending or left <= 0:
+                    return pending
+                self.cond.wait(left)
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class BotApiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        # telepot sends its parameters as multipart/form-data
+        params = dict(FIELD.findall(self.rfile.read(length).decode('utf-8')))
+        result = self.server.queue.get(int(params.get('offset', 0)),
+                                       float(params.get('timeout', 0)))
+        body = json.dumps({'ok': True, 'result': result}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Recorder(object):
+    """Record when each update reaches the bot."""
+
+    def __init__(self, expected):
+        self.expected = expected
+        self.sent = {}
+        self.latencies = []
+        self.done = Event()
+
+    def on_chat_message(self, msg):
+        self.latencies.append(time.time() - self.sent[msg['message_id']])
+        if len(self.latencies) == self.expected:
+            self.done.set()
+
+
+def make_update(update_id):
+    return {
+        'update_id': update_id,
+        'message': {'message_id': update_id, 'date': 0, 'text': 'hi',
+                    'chat': {'id': update_id % 10, 'type': 'private'}},
+    }
+
+
+def measure(bot, deliver, first_id, count, gap):
+    """Produce `count` updates, `gap` seconds apart at most.
+
+    Returns:
+        tuple: (latency of each update, seconds until all were received).
+    """
+    recorder = Recorder(count)
+    bot.on_chat_message = recorder.on_chat_message
+
+    start = time.time()
+    for update_id in range(first_id, first_id + count):
+        if gap:
+            time.sleep(random.uniform(0, gap))
+        recorder.sent[update_id] = time.time()
+        deliver(make_update(update_id))
+    recorder.done.wait()
+    return recorder.latencies, time.time() - start
+
+
+def polling(bot):
+    queue = UpdateQueue()
+    server = ThreadingServer(('127.0.0.1', 0), BotApiHandler)
+    server.queue = queue
+    thread = Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    base = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    telepot.api._methodurl = lambda req, **user_kw: '{}/{}'.format(base, req[1])
+
+    # what message_loop does, minus its collect thread
+    GetUpdatesLoop(bot, bot.on_update).run_as_thread()
+    return queue.put
+
+
+def webhook(bot):
+    server = WebhookServer(bot.on_update, 'secret', host='127.0.0.1', port=0)
+    server.start()
+    url = 'http://127.0.0.1:{}/secret'.format(server.server_address[1])
+    session = requests.Session()
+    return lambda update: session.post(url, data=json.dumps(update))
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def main():
+    bot = MatrigramBot('0:bench', config={'server': 'http://localhost'})
+
+    print('{:<10} {:>10} {:>10} {:>10} {:>14}'.format(
+        'mode', 'p50', 'p99', 'max', 'burst upd/s'))
+    for name, setup in (('polling', polling), ('webhook', webhook)):
+        deliver = setup(bot)
+        latencies, _ = measure(bot, deliver, 1, UPDATES, MAX_GAP)
+        _, elapsed = measure(bot, deliver, UPDATES + 1, BURST, 0)
+        print('{:<10} {:>7.2f} ms {:>7.2f} ms {:>7.2f} ms {:>14.0f}'.format(
+            name,
+            percentile(latencies, 0.5) * 1000,
+            percentile(latencies, 0.99) * 1000,
+            max(latencies) * 1000,
+            BURST / elapsed))
+
+
+if __name__ == '__main__':
+    main()
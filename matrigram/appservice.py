@@ -0,0 +1,207 @@
+import hmac
+import json
+import logging
+from threading import Lock
+from threading import Thread
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler
+    from urlparse import parse_qs
+    from urlparse import urlparse
+except ImportError:
+    from http.server import BaseHTTPRequestHandler
+    from urllib.parse import parse_qs
+    from urllib.parse import urlparse
+
+from .cache import TTLCache
+from .webhook import IDLE_TIMEOUT
+from .webhook import PooledHTTPServer
+
+logger = logging.getLogger('matrigram')
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 9090
+DEFAULT_CONNECTIONS = 4
+# seconds a transaction id is remembered, homeservers retry failed transactions
+TRANSACTION_TTL = 60 * 60
+
+TRANSACTION_PATHS = ('/transactions/', '/_matrix/app/v1/transactions/')
+# keys of a transaction holding ephemeral events, before and after MSC2409 was merged
+EPHEMERAL_KEYS = ('de.sorunome.msc2409.ephemeral', 'ephemeral')
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    timeout = IDLE_TIMEOUT
+    # headers and body are written apart, don't let them wait for each other's ack
+    disable_nagle_algorithm = True
+
+    def do_PUT(self):
+        appservice = self.server.appservice
+        url = urlparse(self.path)
+        txn_id = None
+        for prefix in TRANSACTION_PATHS:
+            if url.path.startswith(prefix):
+                txn_id = url.path[len(prefix):]
+        if not txn_id:
+            self._respond(404, {'errcode': 'M_UNRECOGNIZED'})
+            return
+
+        token = parse_qs(url.query).get('access_token', [None])[0]
+        authorization = self.headers.get('Authorization') or ''
+        if authorization.startswith('Bearer '):
+            token = authorization[len('Bearer '):]
+        if token is None:
+            self._respond(401, {'errcode': 'M_UNAUTHORIZED'})
+            return
+        if not appservice.authorized(token):
+            self._respond(403, {'errcode': 'M_FORBIDDEN'})
+            return
+
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            transaction = json.loads(self.rfile.read(length).decode('utf-8'))
+        except ValueError:
+            self._respond(400, {'errcode': 'M_NOT_JSON'})
+            return
+
+        appservice.on_transaction(txn_id, transaction)
+        self._respond(200, {})
+
+    def _respond(self, code, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, fmt, *args):
+        logger.debug('appservice: ' + fmt, *args)
+
+
+class AppService(object):
+    """Matrix application service fanning pushed events out to clients.
+
+    Instead of every client syncing on its own, the homeserver pushes the
+    events of all bridged users in transactions to a single endpoint. Each
+    event is handed to the clients of the users in its room, through
+    :meth:`MatrigramClient.on_pushed_event`.
+
+    Args:
+        hs_token (str): Token the homeserver authenticates with.
+        host (str): Address to listen on.
+        port (int): Port to listen on, ``0`` for any free port.
+        connections (int): Connections served at the same time.
+    """
+
+    def __init__(self, hs_token, host=DEFAULT_HOST, port=DEFAULT_PORT,
+                 connections=DEFAULT_CONNECTIONS):
+        self.hs_token = hs_token
+
+        self._lock = Lock()
+        self._rooms = {}  # room id -> set of clients in the room
+        self._users = {}  # matrix user id -> set of clients
+        self._seen = TTLCache(TRANSACTION_TTL)
+
+        self._server = PooledHTTPServer((host, port), _Handler, connections)
+        self._server.appservice = self
+        self._thread = None
+
+    @property
+    def server_address(self):
+        return self._server.server_address
+
+    def authorized(self, token):
+        return hmac.compare_digest(token.encode('utf-8'), self.hs_token.encode('utf-8'))
+
+    def register(self, client):
+        """Start pushing events of a client's user and rooms to it.
+
+        Args:
+            client (MatrigramClient): A logged in client.
+        """
+        with self._lock:
+            self._users.setdefault(client.user_id, set()).add(client)
+            for room_id in client.room_ids():
+                self._rooms.setdefault(room_id, set()).add(client)
+
+    def unregister(self, client):
+        with self._lock:
+            _discard(self._users, client.user_id, client)
+            for room_id in list(self._rooms):
+                _discard(self._rooms, room_id, client)
+
+    def on_transaction(self, txn_id, transaction):
+        """Hand the events of a transaction to the clients they concern.
+
+        Transactions already handled are ignored, as the homeserver resends
+        them until acknowledged.
+
+        Args:
+            txn_id (str): Transaction id.
+            transaction (dict): The transaction body.
+        """
+        if self._seen.get(txn_id):
+            logger.debug('ignoring repeated transaction %s', txn_id)
+            return
+        self._seen.set(txn_id, True)
+
+        for event in transaction.get('events', []):
+            self._dispatch(event, ephemeral=False)
+        for key in EPHEMERAL_KEYS:
+            for event in transaction.get(key, []):
+                self._dispatch(event, ephemeral=True)
+
+    def _dispatch(self, event, ephemeral):
+        room_id = event.get('room_id')
+        member = event.get('state_key') if event.get('type') == 'm.room.member' else None
+        with self._lock:
+            clients = set(self._rooms.get(room_id, ()))
+            if member is not None:
+                # invites reach users before they are in the room
+                clients.update(self._users.get(member, ()))
+
+        for client in clients:
+            try:
+                if ephemeral:
+                    client.on_pushed_ephemeral_event(event)
+                else:
+                    client.on_pushed_event(event)
+            except Exception:
+                logger.exception('handling pushed event %s failed', event.get('event_id'))
+
+        if member is not None:
+            self._update_membership(room_id, member, event['content'].get('membership'))
+
+    def _update_membership(self, room_id, user_id, membership):
+        with self._lock:
+            for client in self._users.get(user_id, ()):
+                if membership == 'join':
+                    self._rooms.setdefault(room_id, set()).add(client)
+                elif membership in ('leave', 'ban'):
+                    _discard(self._rooms, room_id, client)
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def start(self):
+        """Serve transactions from a background thread."""
+        self._thread = Thread(target=self.serve_forever, name='matrigram-appservice')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def shutdown(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+
+def _discard(index, key, client):
+    clients = index.get(key)
+    if clients is None:
+        return
+    clients.discard(client)
+    if not clients:
+        del index[key]
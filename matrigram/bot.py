@@ -1,25 +1,224 @@
 # -*- coding: utf-8 -*-
 
+import json
 import logging
+import mimetypes
 import os
-import re
 import time
-from threading import Lock
-from threading import Thread
 
-import requests
 import telepot
+from telepot.exception import TelegramError
 
 from . import helper
-from .helper import download_file
 from .helper import pprint_json
+from .appservice import AppService
+from .cache import PersistentMap
+from .cache import TTLCache
+from .client import ALIAS_TTL
 from .client import MatrigramClient
+from .directory import RoomDirectory
+from .history import DEFAULT_HISTORY_SIZE
+from .metrics import BridgeMetrics
+from .metrics import Gauge
+from .metrics import MATRIX_TO_TELEGRAM
+from .metrics import MetricsServer
+from .metrics import TELEGRAM_TO_MATRIX
+from .outbound import ChatActionThrottle
+from .outbound import DEFAULT_ACTION_WINDOW
+from .outbound import PRIORITY_COMMAND
+from .outbound import PRIORITY_RELAY
+from .outbound import SendScheduler
+from .routing import Router
+from .sessions import SessionRegistry
+from .streaming import DEFAULT_CHUNK_SIZE
+from .streaming import DEFAULT_SPOOL_THRESHOLD
+from .streaming import HashingReader
+from .streaming import MultipartStream
+from .streaming import SizedStream
+from .streaming import spool
+from .transport import HttpPool
+from .typing_indicator import TypingScheduler
+from .webhook import extract_message
+from .webhook import run_webhook
+from .workers import ChatExecutor
+from .workers import DEFAULT_WORKERS
 
 BOT_BASE_URL = 'https://api.telegram.org/bot{token}/{path}'
 BOT_FILE_URL = 'https://api.telegram.org/file/bot{token}/{file_path}'
 logger = logging.getLogger('matrigram')
 
 OPTS_IN_ROW = 4
+MEMBERS_PAGE_SIZE = 10
+DISCOVER_PAGE_SIZE = 10
+# bytes of callback data telegram accepts
+MAX_CALLBACK_DATA = 64
+# characters of a message telegram accepts
+MAX_MESSAGE_LENGTH = 4096
+# telegram media kind -> type of relayed message in the metrics
+RELAY_TYPES = {
+    'photo': 'photo',
+    'audio': 'voice',
+    'video': 'video',
+}
+# matrix media message type -> how history names it
+HISTORY_MEDIA = {
+    'm.image': 'a photo',
+    'm.audio': 'an audio',
+    'm.video': 'a video',
+    'm.file': 'a file',
+}
+DEFAULT_LOGIN_WORKERS = 4
+DEFAULT_MEDIA_WORKERS = 4
+DB_NAME = 'matrigram.db'
+FILE_OBJ_TTL = 30 * 60
+# seconds between saves of a session's sync token
+SESSION_CHECKPOINT_INTERVAL = 10
+# seconds before a typing action stops being displayed that it is sent again
+TYPING_REFRESH_MARGIN = 1.0
+
+# key added to a message, holding when it was received, to time its relay
+RECEIVED_AT = 'matrigram_received_at'
+# Bot API methods held open until there is news, their latency means nothing
+LONG_POLL_METHODS = ('getUpdates',)
+
+# telegram media kind -> Bot API method sending it
+MEDIA_METHODS = {
+    'photo': 'sendPhoto',
+    'audio': 'sendAudio',
+    'video': 'sendVideo',
+}
+
+
+def _check_response(res):
+    """Check a raw Bot API response.
+
+    Args:
+        res (requests.Response): The response.
+
+    Returns:
+        The ``result`` field of the response.
+
+    Raises:
+        TelegramError: If telegram returned an error.
+    """
+    data = res.json()
+    if not data.get('ok'):
+        raise TelegramError(data.get('description'), data.get('error_code', res.status_code), data)
+    return data['result']
+
+
+def _sent_file_id(message, kind):
+    """Get the file id of the media in a message sent by the bot.
+
+    Args:
+        message (dict): The sent message.
+        kind (str): Kind of the sent media, e.g. ``'photo'``.
+
+    Returns:
+        str: The file id, or None if the message has no media.
+    """
+    sent = message.get(kind) or message.get('document')
+    if isinstance(sent, list):
+        # photos come in several sizes, the last is the original
+        sent = sent[-1] if sent else None
+    return sent.get('file_id') if sent else None
+
+
+class _MatrixMedia(object):
+    """Matrix media on its way to a telegram chat.
+
+    Args:
+        kind (str): ``'photo'``, ``'audio'`` or ``'video'``.
+        sender (str): Name of the sender.
+        event (dict): The matrix media event.
+        client (MatrigramClient): The client the media is originated in.
+        chat_id: Telegram user id.
+    """
+
+    def __init__(self, kind, sender, event, client, chat_id):
+        self.kind = kind
+        self.sender = sender
+        self.event = event
+        self.client = client
+        self.chat_id = chat_id
+        self.mxc_key = '{} {}'.format(kind, event['content']['url'])
+        self.hash_key = None
+        self.file_id = None
+        self.response = None  # download from the homeserver, streamed into the upload
+        self.spooled = None  # copy of media of unknown size
+        self.size = None
+
+    def close(self):
+        if self.response is not None:
+            self.response.close()
+        if self.spooled is not None:
+            self.spooled.close()
+
+
+def _history_line(event, media_url):
+    """Render a matrix event of a room's history as a line of text.
+
+    Args:
+        event (dict): Message or topic event.
+        media_url: ``media_url(event)`` returning the http url of media.
+
+    Returns:
+        str: The line.
+    """
+    sender = event['sender'].split(':')[0]
+    content = event['content']
+    if event['type'] == 'm.room.topic':
+        return u'{} changed topic to: "{}"'.format(sender, content.get('topic', ''))
+
+    msgtype = content.get('msgtype')
+    if msgtype == 'm.emote':
+        return u'* {} {}'.format(sender, content.get('body', ''))
+    if msgtype in HISTORY_MEDIA and content.get('url'):
+        return u'{} sent {}: {}'.format(sender, HISTORY_MEDIA[msgtype], media_url(event))
+    return u'{}: {}'.format(sender, content.get('body', ''))
+
+
+def _page_keyboard(command, offset, page_size, more, term=None):
+    """Build the prev/next keyboard of a paged listing.
+
+    Args:
+        command (str): Callback query command of the listing, e.g. ``'MEMBERS'``.
+        offset (int): Offset of the page shown.
+        page_size (int): Entries in a page.
+        more (bool): Whether there are entries after the page.
+        term (str): Search term of the listing, or None.
+
+    Returns:
+        dict: The reply markup, or None if there is nothing to page to.
+    """
+    suffix = ' {}'.format(term) if term else ''
+    buttons = []
+    if offset > 0:
+        buttons.append({'text': '< Prev', 'callback_data': '{} {}{}'.format(
+            command, max(offset - page_size, 0), suffix)})
+    if more:
+        buttons.append({'text': 'Next >', 'callback_data': '{} {}{}'.format(
+            command, offset + page_size, suffix)})
+    if any(len(button['callback_data'].encode('utf-8')) > MAX_CALLBACK_DATA
+           for button in buttons):
+        # the search term is too long to page through
+        return None
+    return {'inline_keyboard': [buttons]} if buttons else None
+
+
+def relayed(kind):
+    """Count and time a handler relaying a telegram message to matrix.
+
+    The time counts from when the message was received, see ``RECEIVED_AT``.
+    """
+    def decorator(func):
+        def func_wrapper(self, msg, *args):
+            self.metrics.relay(TELEGRAM_TO_MATRIX, kind, func,
+                               msg.get(RECEIVED_AT))(self, msg, *args)
+
+        return func_wrapper
+
+    return decorator
 
 
 def logged_in(func):
@@ -27,8 +226,8 @@ def logged_in(func):
         chat_id = msg['chat']['id']
         client = self._get_client(chat_id)
         if client is None:
-            self.sendMessage(chat_id,
-                             'You are not logged in. Login to start with /login username password')
+            self._reply(chat_id,
+                        'You are not logged in. Login to start with /login username password')
             return
         func(self, msg, *args)
 
@@ -40,10 +239,10 @@ def focused(func):
         chat_id = msg['chat']['id']
         client = self._get_client(chat_id)
         if not client.get_rooms_aliases():
-            self.sendMessage(chat_id, 'You are not in any room. Type /join #room to join one.')
+            self._reply(chat_id, 'You are not in any room. Type /join #room to join one.')
             return
         if not client.have_focus_room():
-            self.sendMessage(chat_id, 'You don\'t have a room in focus. Type /focus to choose one.')
+            self._reply(chat_id, 'You don\'t have a room in focus. Type /focus to choose one.')
             return
         func(self, msg, *args)
 
@@ -57,30 +256,33 @@ class MatrigramBot(telepot.Bot):
         super(MatrigramBot, self).__init__(*args, **kwargs)
 
         routes = [
-            (r'^/login (?P<username>\S+) (?P<password>\S+)$', self.login),
-            (r'^/logout$', self.logout),
-            (r'^/join\s(?P<room_name>[^$]+)$', self.join_room),
-            (r'^/leave$', self.leave_room),
-            (r'^/discover$', self.discover_rooms),
-            (r'^/focus$', self.change_focus_room),
-            (r'^/status$', self.status),
-            (r'^/members$', self.get_members),
-            (r'^/create_room (?P<room_name>[\S]+)(?P<invitees>\s.*\S)*$', self.create_room),
-            (r'^/setname\s(?P<matrix_name>[^$]+)$', self.set_name),
-            (r'^/me (?P<text>[^/].*)$', self.emote),
-            (r'^(?P<text>[^/].*)$', self.forward_message_to_mc),
+            ('/login', r'^/login (?P<username>\S+) (?P<password>\S+)$', self.login),
+            ('/logout', r'^/logout$', self.logout),
+            ('/join', r'^/join\s(?P<room_name>[^$]+)$', self.join_room),
+            ('/leave', r'^/leave$', self.leave_room),
+            ('/discover', r'^/discover(\s(?P<term>.+))?$', self.discover_rooms),
+            ('/focus', r'^/focus$', self.change_focus_room),
+            ('/status', r'^/status$', self.status),
+            ('/members', r'^/members(\s(?P<prefix>\S+))?$', self.get_members),
+            ('/create_room', r'^/create_room (?P<room_name>[\S]+)(?P<invitees>\s.*\S)*$',
+             self.create_room),
+            ('/setname', r'^/setname\s(?P<matrix_name>[^$]+)$', self.set_name),
+            ('/me', r'^/me (?P<text>[^/].*)$', self.emote),
+            (None, r'^(?P<text>[^/].*)$', self.forward_message_to_mc),
         ]
 
         callback_query_routes = [
-            (r'^LEAVE (?P<room>\S+)$', self.do_leave),
-            (r'^FOCUS (?P<room>\S+)$', self.do_change_focus),
-            (r'^JOIN (?P<room>\S+)$', self.do_join),
-            (r'^NOP$', self.do_nop),
+            ('LEAVE', r'^LEAVE (?P<room>\S+)$', self.do_leave),
+            ('FOCUS', r'^FOCUS (?P<room>\S+)$', self.do_change_focus),
+            ('JOIN', r'^JOIN (?P<room>\S+)$', self.do_join),
+            ('MEMBERS', r'^MEMBERS (?P<offset>\d+) (?P<room>\S+)( (?P<prefix>\S+))?$',
+             self.do_members_page),
+            ('DISCOVER', r'^DISCOVER (?P<offset>\d+)( (?P<term>.+))?$', self.do_discover_page),
+            ('NOP', r'^NOP$', self.do_nop),
         ]
 
-        self.routes = [(re.compile(pattern), callback) for pattern, callback in routes]
-        self.callback_query_routes = [(re.compile(pattern), callback)
-                                      for pattern, callback in callback_query_routes]
+        self.text_router = Router(routes, command_prefix='/')
+        self.callback_query_router = Router(callback_query_routes)
 
         self.content_type_routes = {
             'text': self.on_text_message,
@@ -90,100 +292,264 @@ class MatrigramBot(telepot.Bot):
             'document': self.forward_gif_to_mc,
         }
 
-        # users map telegram_id -> client
-        self.users = {}
+        # users map telegram_id <-> client
+        self.users = SessionRegistry()
         self.config = config
 
-        self.users_lock = Lock()  # self.users lock for typing related matters
+        # updates of the same chat are handled in order, different chats in parallel
+        self.executor = ChatExecutor(config.get('workers', DEFAULT_WORKERS))
+        # logins (and their initial sync) run apart so they never occupy update workers
+        self.login_executor = ChatExecutor(config.get('login_workers', DEFAULT_LOGIN_WORKERS),
+                                           name='matrigram-login')
+        # media is prepared apart, only sending it goes through the outbox
+        self.media_executor = ChatExecutor(config.get('media_workers', DEFAULT_MEDIA_WORKERS),
+                                           name='matrigram-media')
+        data_dir = config.get('data_dir')
+        db_path = os.path.join(data_dir, DB_NAME) if data_dir else ':memory:'
+        # '<kind> <mxc url>' and '<kind> md5:<hash>' -> telegram file id
+        self.media_file_ids = PersistentMap(db_path, 'telegram_file_ids')
+        # telegram file unique id -> [mxc url, name]
+        self.matrix_urls = PersistentMap(db_path, 'matrix_urls')
+        # str(chat_id) -> json of the matrix session, resumed after a restart
+        self.saved_sessions = PersistentMap(db_path, 'sessions')
+        # telegram file id -> file object, download links are valid for an hour
+        self.file_objs = TTLCache(FILE_OBJ_TTL)
+        # (server, room alias) -> room id, resolved once for all users
+        self.alias_ids = TTLCache(ALIAS_TTL)
+        # public rooms of homeservers, shared by all users
+        self.directory = RoomDirectory(**config.get('directory', {}))
+
+        # keep-alive connections for the uploads telepot can't do for us
+        self.http = HttpPool(**config.get('http', {}))
+        # every message to telegram goes through the outbox to respect flood limits
+        self.outbox = SendScheduler(**config.get('outbox', {}))
+        self.chat_actions = ChatActionThrottle(
+            config.get('chat_action_window', DEFAULT_ACTION_WINDOW),
+            config.get('chat_actions', True))
+        self.typing = TypingScheduler(
+            lambda chat_id: self._send_chat_action(chat_id, 'typing', refresh=True),
+            interval=max(self.chat_actions.window - TYPING_REFRESH_MARGIN, TYPING_REFRESH_MARGIN))
+        # when set, the homeserver pushes events to us instead of every client syncing
+        appservice = config.get('appservice')
+        self.appservice = AppService(**appservice) if appservice else None
+
+        self.metrics = BridgeMetrics()
+        self.metrics.add(Gauge('matrigram_sessions', 'Logged in users.',
+                               lambda: len(self.users)))
+        metrics = config.get('metrics')
+        self.metrics_server = MetricsServer(self.metrics, **metrics) if metrics else None
+
+    def _api_request(self, method, params=None, files=None, **kwargs):
+        if method in LONG_POLL_METHODS:
+            return super(MatrigramBot, self)._api_request(method, params, files, **kwargs)
+        with self.metrics.bot_api_seconds.time((method,)):
+            return super(MatrigramBot, self)._api_request(method, params, files, **kwargs)
 
     def on_chat_message(self, msg):
         """Main entry point.
 
         This function is our main entry point to the bot.
-        Messages will be routed according to their content type.
+        Messages will be routed according to their content type, and handled
+        on ``self.executor`` in the order they were received in their chat.
 
         Args:
             msg: The message object received from telegram user.
         """
-        content_type, _, _ = telepot.glance(msg)
+        content_type, _, chat_id = telepot.glance(msg)
         logger.debug('content type: %s', content_type)
-        self.content_type_routes[content_type](msg)
+        msg[RECEIVED_AT] = time.time()
+        self.executor.submit(chat_id, self.content_type_routes[content_type], msg)
 
     def on_callback_query(self, msg):
         """Handle callback queries.
 
-        Route queries using ``self.callback_query_routes``.
+        Route queries using ``self.callback_query_router``.
 
         Args:
             msg: The message object received from telegram user.
         """
         data = msg['data']
+        chat_id = msg['message']['chat']['id']
+
+        callback, match = self.callback_query_router.match(data)
+        if callback:
+            self.executor.submit(chat_id, callback, msg, match)
+
+    def on_update(self, update):
+        """Handle an update pushed to the webhook or by the shard supervisor.
+
+        Args:
+            update (dict): The Bot API update.
+        """
+        msg = extract_message(update)
+        if msg is None:
+            logger.debug('ignoring update %s', update.get('update_id'))
+            return
+        self.handle(msg)
+
+    def run_webhook(self, **kwargs):
+        """Receive updates through a webhook instead of long polling.
 
-        for route, callback in self.callback_query_routes:
-            match = route.match(data)
-            if match:
-                callback_thread = Thread(target=callback, args=(msg, match))
-                callback_thread.start()
-                break
+        Takes the arguments of :func:`matrigram.webhook.run_webhook`.
+        """
+        run_webhook(self, self.on_update, **kwargs)
 
     def on_text_message(self, msg):
         """Handle text messages.
 
-        Route text messages using ``self.routes``.
+        Route text messages using ``self.text_router``.
 
         Args:
             msg: The message object received from telegram user.
         """
         text = msg['text'].encode('utf-8')
 
-        for route, callback in self.routes:
-            match = route.match(text)
-            if match:
-                callback_thread = Thread(target=callback, args=(msg, match))
-                callback_thread.start()
-
-                # wait for login thread to finish before moving on
-                if callback == self.login:
-                    callback_thread.join()
-                break
+        callback, match = self.text_router.match(text)
+        if callback:
+            callback(msg, match)
 
     def login(self, msg, match):
+        """Start login.
+
+        The login itself runs on ``self.login_executor``. Until it is done,
+        further updates of the chat are buffered, while other chats keep
+        being handled.
+
+        Args:
+            msg: The message object received from telegram user.
+            match: Match object containing extracted data.
+        """
+        chat_id = msg['chat']['id']
+
+        self.executor.hold(chat_id)
+        try:
+            self.login_executor.submit(chat_id, self._login, msg, match)
+        except Exception:
+            self.executor.release(chat_id)
+            raise
+
+    def _login(self, msg, match):
         """Perform login.
 
         Args:
             msg: The message object received from telegram user.
             match: Match object containing extracted data.
         """
-        username = match.group('username')
-        password = match.group('password')
         chat_id = msg['chat']['id']
+        try:
+            self._do_login(chat_id, match.group('username'), match.group('password'))
+        finally:
+            self.executor.release(chat_id)
 
+    def _do_login(self, chat_id, username, password):
         logger.info('telegram user %s, login to %s', chat_id, username)
-        self.sendChatAction(chat_id, 'typing')
+        self._send_chat_action(chat_id, 'typing', PRIORITY_COMMAND)
 
-        client = MatrigramClient(self.config['server'], self, username)
+        client = self._new_client(self.config['server'], username)
         login_bool, login_message = client.login(username, password)
         if login_bool:
-            self.sendMessage(chat_id, 'Logged in as {}'.format(username))
+            self._reply(chat_id, 'Logged in as {}'.format(username))
 
-            self.users[chat_id] = {
-                'client': client,
-                'typing_thread': None,
-                'should_type': False,
-            }
+            self.users.add(chat_id, client)
+            self._save_session(chat_id, client)
 
             rooms = client.get_rooms_aliases()
             logger.debug("rooms are: %s", rooms)
 
             if rooms:
                 room_aliases = '\n'.join([room_alias[0] for room_alias in rooms.values()])
-                self.sendMessage(chat_id, 'You are currently in rooms:\n{}'.format(room_aliases))
-                self.sendMessage(chat_id,
-                                 'You are now participating in: {}'.format(
-                                     client.get_focus_room_alias()))
-            logger.debug('%s user state:\n%s', chat_id, self.users[chat_id])
+                self._reply(chat_id, 'You are currently in rooms:\n{}'.format(room_aliases))
+                self._reply(chat_id,
+                            'You are now participating in: {}'.format(
+                                client.get_focus_room_alias()))
+            logger.debug('%s user state: %s', chat_id, self.users.get(chat_id))
         else:
-            self.sendMessage(chat_id, login_message)
+            self._reply(chat_id, login_message)
+
+    def _new_client(self, server, username):
+        client = MatrigramClient(server, self, username, self.config.get('sync_filter'),
+                                 self.alias_ids,
+                                 self.config.get('backfill', {}).get('limit', DEFAULT_HISTORY_SIZE))
+        self.metrics.watch_homeserver(client.client.api)
+        return client
+
+    def restore_sessions(self, owns=None):
+        """Resume the sessions saved before the last shutdown.
+
+        Sessions are resumed on ``self.login_executor``. Until a chat's
+        session is resumed, its updates are buffered.
+
+        Args:
+            owns: Optional callable taking a chat id, to resume only the
+                sessions it returns True for.
+
+        Returns:
+            int: Number of sessions being resumed.
+        """
+        count = 0
+        for key, state in self.saved_sessions.items():
+            chat_id = int(key)
+            if owns is not None and not owns(chat_id):
+                continue
+
+            self.executor.hold(chat_id)
+            try:
+                self.login_executor.submit(chat_id, self._restore, chat_id, json.loads(state))
+            except Exception:
+                self.executor.release(chat_id)
+                raise
+            count += 1
+
+        logger.info('resuming %d sessions', count)
+        return count
+
+    def _restore(self, chat_id, state):
+        try:
+            client = self._new_client(state['server'], state['username'])
+            client.restore(state)
+            self.users.add(chat_id, client)
+            logger.info('resumed session of %s as %s', chat_id, state['username'])
+        except Exception:
+            logger.exception('failed resuming session of %s', chat_id)
+        finally:
+            self.executor.release(chat_id)
+
+    def _save_session(self, chat_id, client):
+        self.saved_sessions.set(str(chat_id), json.dumps(client.state()))
+
+    def checkpoint_session(self, client, force=False):
+        """Save the session of a client, at most every few seconds.
+
+        Called after each sync, so a restart resumes syncing close to where
+        it stopped, and when the rooms or the focus of a client change.
+
+        Args:
+            client (MatrigramClient): The client that synced or changed.
+            force (bool): Save now, even if saved a moment ago.
+        """
+        chat_id = self.users.get_chat_id(client)
+        session = self.users.get(chat_id) if chat_id is not None else None
+        if session is None or session.client is not client:
+            # still logging in, or logged out meanwhile
+            return
+
+        now = time.time()
+        with session.lock:
+            if not force and now - session.saved_at < SESSION_CHECKPOINT_INTERVAL:
+                return
+            session.saved_at = now
+        self._save_session(chat_id, client)
+
+    def session_expired(self, client):
+        chat_id = self._get_chat_id(client)
+        if chat_id is None:
+            return
+
+        logger.info('matrix session of %s expired', chat_id)
+        self.users.remove(chat_id)
+        self.saved_sessions.delete(str(chat_id))
+        self._reply(chat_id,
+                    'Your matrix session expired. Login again with /login username password')
 
     @logged_in
     def logout(self, msg, _):
@@ -198,7 +564,8 @@ class MatrigramBot(telepot.Bot):
         logger.info('logout %s', chat_id)
 
         client.logout()
-        self.users[chat_id]['client'] = None
+        self.users.remove(chat_id)
+        self.saved_sessions.delete(str(chat_id))
 
     @logged_in
     def join_room(self, msg, match):
@@ -207,42 +574,45 @@ class MatrigramBot(telepot.Bot):
         room_name = match.group('room_name')
         ret = client.join_room(room_name)
         if not ret:
-            self.sendMessage(chat_id, 'Can\'t join room')
+            self._reply(chat_id, 'Can\'t join room')
         else:
-            self.sendMessage(chat_id, "Joined {}".format(room_name))
+            self._reply(chat_id, "Joined {}".format(room_name))
 
     @logged_in
     def leave_room(self, msg, _):
         chat_id = msg['chat']['id']
         client = self._get_client(chat_id)
 
-        rooms = [room[0] for dummy_room_id, room in client.get_rooms_aliases().items()]
+        rooms = client.get_rooms_aliases()
         if not rooms:
-            self.sendMessage(chat_id, 'Nothing to leave...')
+            self._reply(chat_id, 'Nothing to leave...')
             return
 
-        opts = [{'text': room, 'callback_data': 'LEAVE {}'.format(room)} for room in rooms]
+        # room ids, unlike aliases, resolve without asking the homeserver
+        opts = [{'text': aliases[0], 'callback_data': 'LEAVE {}'.format(room_id)}
+                for room_id, aliases in rooms.items()]
 
         keyboard = {
             'inline_keyboard': [chunk for chunk in helper.chunks(opts, OPTS_IN_ROW)]
         }
-        self.sendMessage(chat_id, 'Choose a room to leave:', reply_markup=keyboard)
+        self._reply(chat_id, 'Choose a room to leave:', reply_markup=keyboard)
 
     def do_leave(self, msg, match):
         query_id, _, _ = telepot.glance(msg, flavor='callback_query')
         chat_id = msg['message']['chat']['id']
-        room_name = match.group('room')
+        room = match.group('room')
         client = self._get_client(chat_id)
+        room_name = client.get_room_alias(room) or room
 
         prev_focus_room = client.get_focus_room_alias()
-        client.leave_room(room_name)
-        self.sendMessage(chat_id, 'Left {}'.format(room_name))
+        client.leave_room(room)
+        self._reply(chat_id, 'Left {}'.format(room_name))
         curr_focus_room = client.get_focus_room_alias()
 
         if curr_focus_room != prev_focus_room and curr_focus_room is not None:
-            self.sendMessage(chat_id,
-                             'You are now participating in: {}'.format(
-                                 client.get_focus_room_alias()))
+            self._reply(chat_id,
+                        'You are now participating in: {}'.format(
+                            client.get_focus_room_alias()))
 
         self.answerCallbackQuery(query_id, 'Done!')
 
@@ -251,58 +621,86 @@ class MatrigramBot(telepot.Bot):
         chat_id = msg['chat']['id']
         client = self._get_client(chat_id)
 
-        rooms = [room[0] for dummy_room_id, room in client.get_rooms_aliases().items()]
-        if not rooms or len(rooms) == 0:
-            self.sendMessage(chat_id, 'You need to be at least in one room to use this command.')
+        rooms = client.get_rooms_aliases()
+        if not rooms:
+            self._reply(chat_id, 'You need to be at least in one room to use this command.')
             return
 
-        opts = [{'text': room, 'callback_data': 'FOCUS {}'.format(room)} for room in rooms]
+        opts = [{'text': aliases[0], 'callback_data': 'FOCUS {}'.format(room_id)}
+                for room_id, aliases in rooms.items()]
 
         keyboard = {
             'inline_keyboard': [chunk for chunk in helper.chunks(opts, OPTS_IN_ROW)]
         }
-        self.sendMessage(chat_id, 'Choose a room to focus:', reply_markup=keyboard)
+        self._reply(chat_id, 'Choose a room to focus:', reply_markup=keyboard)
 
     def do_change_focus(self, msg, match):
         query_id, _, _ = telepot.glance(msg, flavor='callback_query')
         chat_id = msg['message']['chat']['id']
-        room_name = match.group('room')
+        room = match.group('room')
 
-        self.sendChatAction(chat_id, 'typing')
+        self._send_chat_action(chat_id, 'typing', PRIORITY_COMMAND)
         client = self._get_client(chat_id)
 
-        client.set_focus_room(room_name)
-        self.sendMessage(chat_id, 'You are now participating in {}'.format(room_name))
-        self.sendMessage(chat_id, '{} Room history:'.format(room_name))
-        client.backfill_previous_messages()
+        client.set_focus_room(room)
+        room_name = client.get_room_alias(room) or room
+        self._reply(chat_id, 'You are now participating in {}'.format(room_name))
+        self._send_history(chat_id, client, room_name)
 
         self.answerCallbackQuery(query_id, 'Done!')
 
+    def _send_history(self, chat_id, client, room_name):
+        """Send the latest messages of the focus room as a digest.
+
+        The history is packed in as few messages as telegram allows, media
+        are shown as links unless the ``backfill`` config asks for them.
+
+        Args:
+            chat_id: Telegram user id.
+            client (MatrigramClient): Client of the user.
+            room_name (str): Name of the focus room.
+        """
+        events = client.get_history()
+        if not events:
+            self._reply(chat_id, u'{} has no history'.format(room_name))
+            return
+
+        lines = [u'{} Room history:'.format(room_name)]
+        lines.extend(_history_line(event, client.media_url) for event in events)
+        for text in helper.pack_lines(lines, MAX_MESSAGE_LENGTH):
+            self._reply(chat_id, text)
+
+        if self.config.get('backfill', {}).get('media'):
+            for event in events:
+                if event['content'].get('msgtype') in HISTORY_MEDIA:
+                    client.relay_media(event)
+
     def do_join(self, msg, match):
         query_id, _, _ = telepot.glance(msg, flavor='callback_query')
         chat_id = msg['message']['chat']['id']
-        room_name = match.group('room')
+        room = match.group('room')
 
-        self.sendChatAction(chat_id, 'typing')
+        self._send_chat_action(chat_id, 'typing', PRIORITY_COMMAND)
         client = self._get_client(chat_id)
 
-        ret = client.join_room(room_name)
+        ret = client.join_room(room)
         if not ret:
             self.answerCallbackQuery(query_id, 'Can\'t join room')
         else:
+            room_name = client.get_room_alias(room) or room
             self.answerCallbackQuery(query_id, 'Joined {}'.format(room_name))
 
     def do_nop(self, msg, _):
         query_id, _, _ = telepot.glance(msg, flavor='callback_query')
         chat_id = msg['message']['chat']['id']
 
-        self.sendChatAction(chat_id, 'typing')
+        self._send_chat_action(chat_id, 'typing', PRIORITY_COMMAND)
         self.answerCallbackQuery(query_id, 'OK Boss!')
 
     @logged_in
     def status(self, msg, _):
         chat_id = msg['chat']['id']
-        self.sendChatAction(chat_id, 'typing')
+        self._send_chat_action(chat_id, 'typing', PRIORITY_COMMAND)
         client = self._get_client(chat_id)
 
         focus_room = client.get_focus_room_alias()
@@ -312,25 +710,97 @@ class MatrigramBot(telepot.Bot):
         message = '''Status:
         Focused room: {}
         Joined rooms: {}'''.format(focus_room, helper.list_to_nice_str(joined_rooms_list))
-        self.sendMessage(chat_id, message)
+        self._reply(chat_id, message)
 
     @logged_in
     @focused
-    def get_members(self, msg, _):
+    def get_members(self, msg, match):
         chat_id = msg['chat']['id']
         client = self._get_client(chat_id)
 
-        l = client.get_members()
-        # TODO: we need to think how we avoid too long messages, for now send 10 elements
-        self.sendMessage(chat_id, helper.list_to_nice_str(l[0:10]))
+        text, keyboard = self._members_page(client, 0, match.group('prefix'))
+        self._reply(chat_id, text, reply_markup=keyboard)
+
+    def do_members_page(self, msg, match):
+        query_id, _, _ = telepot.glance(msg, flavor='callback_query')
+        chat_id = msg['message']['chat']['id']
+        client = self._get_client(chat_id)
+        if client is None or client.focus_room_id != match.group('room'):
+            # the listing is of a room that lost focus since
+            self.answerCallbackQuery(query_id, 'This listing expired, send /members again')
+            return
+
+        text, keyboard = self._members_page(client, int(match.group('offset')),
+                                            match.group('prefix'))
+        self._edit(chat_id, msg['message']['message_id'], text, reply_markup=keyboard)
+        self.answerCallbackQuery(query_id)
+
+    @staticmethod
+    def _members_page(client, offset, prefix):
+        """Render a page of the focus room's members.
+
+        Args:
+            client (MatrigramClient): Client of the user.
+            offset (int): Members to skip.
+            prefix (str): Only members whose name starts with it, or None.
+
+        Returns:
+            tuple: (text, reply markup) of the page.
+        """
+        names, total = client.get_members(offset, MEMBERS_PAGE_SIZE, prefix)
+        if not names:
+            return 'No members found', None
+
+        text = '{}\n({}-{} of {})'.format(helper.list_to_nice_str(names), offset + 1,
+                                          offset + len(names), total)
+        more = offset + len(names) < total
+        # pages are tied to the room listed, which may lose focus meanwhile
+        term = ' '.join([client.focus_room_id] + ([prefix] if prefix else []))
+        return text, _page_keyboard('MEMBERS', offset, MEMBERS_PAGE_SIZE, more, term)
 
     @logged_in
-    def discover_rooms(self, msg, _):
+    def discover_rooms(self, msg, match):
         chat_id = msg['chat']['id']
+        self._send_chat_action(chat_id, 'typing', PRIORITY_COMMAND)
+        client = self._get_client(chat_id)
+
+        text, keyboard = self._discover_page(client, 0, match.group('term'))
+        self._reply(chat_id, text, reply_markup=keyboard)
+
+    def do_discover_page(self, msg, match):
+        query_id, _, _ = telepot.glance(msg, flavor='callback_query')
+        chat_id = msg['message']['chat']['id']
         client = self._get_client(chat_id)
+        if client is None:
+            self.answerCallbackQuery(query_id, 'You are not logged in')
+            return
+
+        text, keyboard = self._discover_page(client, int(match.group('offset')),
+                                             match.group('term'))
+        self._edit(chat_id, msg['message']['message_id'], text, reply_markup=keyboard)
+        self.answerCallbackQuery(query_id)
+
+    @staticmethod
+    def _discover_page(client, offset, term):
+        """Render a page of the homeserver's public rooms.
+
+        Args:
+            client (MatrigramClient): Client of the user.
+            offset (int): Rooms to skip.
+            term (str): Search term, or None.
+
+        Returns:
+            tuple: (text, reply markup) of the page.
+        """
+        rooms, more = client.discover_rooms(offset, DISCOVER_PAGE_SIZE, term)
+        if not rooms:
+            return 'No rooms found', None
 
-        rooms = client.discover_rooms()
-        self.sendMessage(chat_id, helper.list_to_nice_lines(rooms))
+        lines = ['{} - {} ({} members)'.format(room['alias'], room['name'], room['members'])
+                 if room['name'] else '{} ({} members)'.format(room['alias'], room['members'])
+                 for room in rooms]
+        return (helper.list_to_nice_lines(lines),
+                _page_keyboard('DISCOVER', offset, DISCOVER_PAGE_SIZE, more, term))
 
     @logged_in
     def create_room(self, msg, match):
@@ -342,16 +812,17 @@ class MatrigramBot(telepot.Bot):
         invitees = invitees.split() if invitees else None
         room_id, actual_alias = client.create_room(room_alias, is_public=True, invitees=invitees)
         if room_id:
-            self.sendMessage(chat_id,
-                             'Created room {} with room id {}'.format(actual_alias, room_id))
-            self.sendMessage(chat_id,
-                             'Invitees for the rooms are {}'.format(
-                                 helper.list_to_nice_str(invitees)))
+            self._reply(chat_id,
+                        'Created room {} with room id {}'.format(actual_alias, room_id))
+            self._reply(chat_id,
+                        'Invitees for the rooms are {}'.format(
+                            helper.list_to_nice_str(invitees)))
         else:
-            self.sendMessage(chat_id, 'Could not create room')
+            self._reply(chat_id, 'Could not create room')
 
     @logged_in
     @focused
+    @relayed('text')
     def forward_message_to_mc(self, msg, match):
         text = match.group('text')
         chat_id = msg['chat']['id']
@@ -365,73 +836,115 @@ class MatrigramBot(telepot.Bot):
 
     @logged_in
     @focused
+    @relayed('photo')
     def forward_photo_to_mc(self, msg):
-        chat_id = msg['chat']['id']
-        client = self._get_client(chat_id)
-
         logger.debug(pprint_json(msg))
-        file_id = msg['photo'][-1]['file_id']
-        file_obj = self.getFile(file_id)
-        file_path = file_obj['file_path']
-        file_name = os.path.split(file_path)[1]
-
-        link = BOT_FILE_URL.format(token=self._token, file_path=file_path)
-        download_file(link, os.path.join(self.config['media_dir'], file_name))
-
-        client.send_photo(os.path.join(self.config['media_dir'], file_name))
+        self._forward_media_to_mc(msg, msg['photo'][-1], 'm.image')
 
     @logged_in
     @focused
+    @relayed('voice')
     def forward_voice_to_mc(self, msg):
-        chat_id = msg['chat']['id']
-        client = self._get_client(chat_id)
-
-        file_id = msg['voice']['file_id']
-        file = self.getFile(file_id)
-        file_path = file['file_path']
-        file_name = os.path.split(file_path)[1]
-
-        link = BOT_FILE_URL.format(token=self._token, file_path=file_path)
-        path = os.path.join(self.config['media_dir'], file_name)
-        download_file(link, path)
-
-        client.send_voice(path)
+        self._forward_media_to_mc(msg, msg['voice'], 'm.audio')
 
     @logged_in
     @focused
+    @relayed('video')
     def forward_video_to_mc(self, msg):
-        chat_id = msg['chat']['id']
-
-        client = self._get_client(chat_id)
-
-        file_id = msg['video']['file_id']
-        file = self.getFile(file_id)
-        file_path = file['file_path']
-        file_name = os.path.split(file_path)[1]
-
-        link = BOT_FILE_URL.format(token=self._token, file_path=file_path)
-        path = os.path.join(self.config['media_dir'], file_name)
-        download_file(link, path)
-
-        client.send_video(path)
+        self._forward_media_to_mc(msg, msg['video'], 'm.video')
 
     # gifs are mp4 in telegram
     @logged_in
     @focused
+    @relayed('video')
     def forward_gif_to_mc(self, msg):
-        chat_id = msg['chat']['id']
+        self._forward_media_to_mc(msg, msg['document'], 'm.video')
 
+    def _forward_media_to_mc(self, msg, media, msgtype):
+        """Send telegram media to the focus room.
+
+        Media already uploaded to matrix is sent by its mxc url, without
+        downloading it from telegram or uploading it again. Otherwise the
+        media is streamed from the Bot API file endpoint to the homeserver.
+
+        Args:
+            msg: The message object received from telegram user.
+            media (dict): The telegram file object of the media.
+            msgtype (str): Matrix message type of the media.
+        """
+        chat_id = msg['chat']['id']
         client = self._get_client(chat_id)
 
-        file_id = msg['document']['file_id']
-        file = self.getFile(file_id)
-        file_path = file['file_path']
-        file_name = os.path.split(file_path)[1]
-        link = BOT_FILE_URL.format(token=self._token, file_path=file_path)
-        path = os.path.join(self.config['media_dir'], file_name)
-        download_file(link, path)
+        unique_id = media.get('file_unique_id', media['file_id'])
+        cached = self.matrix_urls.get(unique_id)
+        if cached is not None:
+            mxcurl, name = json.loads(cached)
+            client.send_media(msgtype, mxcurl, name)
+            return
+
+        file_obj = self._get_file(media['file_id'])
+        file_name = os.path.split(file_obj['file_path'])[1]
+        link = BOT_FILE_URL.format(token=self._token, file_path=file_obj['file_path'])
+
+        chunk_size = self.config.get('media_chunk_size', DEFAULT_CHUNK_SIZE)
+        responses = [self._download(link)]
+        spooled = None
+        try:
+            size = responses[0].headers.get('Content-Length', file_obj.get('file_size'))
+            if size is None:
+                spooled, size, _ = self._spool(responses[0].raw)
+            size = int(size)
+
+            def open_body():
+                # opened again when the homeserver asks to retry the upload
+                if spooled is not None:
+                    spooled.seek(0)
+                    return SizedStream(spooled, size, chunk_size)
+                if responses[-1].raw.tell():
+                    responses.append(self._download(link))
+                return SizedStream(responses[-1].raw, size, chunk_size)
+
+            mxcurl = client.upload(open_body, mimetypes.guess_type(file_name)[0])
+            self.metrics.media_bytes.inc((TELEGRAM_TO_MATRIX,), size)
+        finally:
+            for res in responses:
+                res.close()
+            if spooled is not None:
+                spooled.close()
+
+        client.send_media(msgtype, mxcurl, file_name)
+        self.matrix_urls.set(unique_id, json.dumps([mxcurl, file_name]))
+
+    def _download(self, link):
+        """Open a streamed download of a telegram file."""
+        res = self.http.get(link, stream=True, headers={'Accept-Encoding': 'identity'})
+        try:
+            res.raise_for_status()
+        except Exception:
+            res.close()
+            raise
+        return res
 
-        client.send_video(path)
+    def _spool(self, source):
+        """Hold a stream of unknown size aside, in memory if small, else in media_dir."""
+        return spool(source, self.config.get('media_spool_threshold', DEFAULT_SPOOL_THRESHOLD),
+                     self.config.get('media_chunk_size', DEFAULT_CHUNK_SIZE),
+                     self.config.get('media_dir'))
+
+    def _get_file(self, file_id):
+        """Get a telegram file object, cached while its download link is valid.
+
+        Args:
+            file_id (str): Telegram file id.
+
+        Returns:
+            dict: The file object.
+        """
+        file_obj = self.file_objs.get(file_id)
+        if file_obj is None:
+            file_obj = self.getFile(file_id)
+            self.file_objs.set(file_id, file_obj)
+        return file_obj
 
     def send_message(self, sender, msg, client):
         """Send message to telegram user.
@@ -448,24 +961,24 @@ class MatrigramBot(telepot.Bot):
         if not chat_id:
             return
 
-        self.sendChatAction(chat_id, 'typing')
-        self.sendMessage(chat_id, "{}: {}".format(sender, msg))
+        self._send_chat_action(chat_id, 'typing')
+        self._relay(chat_id, "{}: {}".format(sender, msg), 'text')
 
     def send_emote(self, sender, msg, client):
         chat_id = self._get_chat_id(client)
         if not chat_id:
             return
 
-        self.sendChatAction(chat_id, 'typing')
-        self.sendMessage(chat_id, '* {} {}'.format(sender, msg))
+        self._send_chat_action(chat_id, 'typing')
+        self._relay(chat_id, '* {} {}'.format(sender, msg), 'emote')
 
     def send_topic(self, sender, topic, client):
         chat_id = self._get_chat_id(client)
         if not chat_id:
             return
 
-        self.sendChatAction(chat_id, 'typing')
-        self.sendMessage(chat_id, "{} changed topic to: \"{}\"".format(sender, topic))
+        self._send_chat_action(chat_id, 'typing')
+        self._relay(chat_id, "{} changed topic to: \"{}\"".format(sender, topic), 'topic')
 
     def send_kick(self, room, client):
         logger.info('got kicked from %s', room)
@@ -473,7 +986,7 @@ class MatrigramBot(telepot.Bot):
         if not chat_id:
             return
 
-        self.sendMessage(chat_id, 'You got kicked from {}'.format(room))
+        self._reply(chat_id, 'You got kicked from {}'.format(room))
         client.set_focus_room(None)
 
     @logged_in
@@ -482,10 +995,11 @@ class MatrigramBot(telepot.Bot):
         client = self._get_client(chat_id)
         name = match.group('matrix_name')
         client.set_name(name)
-        self.sendMessage(chat_id, 'Set matrix display name to: {}'.format(name))
+        self._reply(chat_id, 'Set matrix display name to: {}'.format(name))
 
     @logged_in
     @focused
+    @relayed('emote')
     def emote(self, msg, match):
         chat_id = msg['chat']['id']
         client = self._get_client(chat_id)
@@ -493,8 +1007,8 @@ class MatrigramBot(telepot.Bot):
 
         client.emote(body)
 
-    def send_invite(self, client, room):
-        logger.info('join room %s?', room)
+    def send_invite(self, client, room, room_id):
+        logger.info('join room %s (%s)?', room, room_id)
         chat_id = self._get_chat_id(client)
         if not chat_id:
             return
@@ -504,7 +1018,7 @@ class MatrigramBot(telepot.Bot):
                 [
                     {
                         'text': 'Yes',
-                        'callback_data': 'JOIN {}'.format(room),
+                        'callback_data': 'JOIN {}'.format(room_id),
                     },
                     {
                         'text': 'No',
@@ -514,110 +1028,229 @@ class MatrigramBot(telepot.Bot):
             ]
         }
 
-        self.sendMessage(chat_id, 'You have been invited to room {}, accept?'.format(room),
-                         reply_markup=keyboard)
+        self._reply(chat_id, 'You have been invited to room {}, accept?'.format(room),
+                    reply_markup=keyboard)
 
     # temporary fixes are permanent, lets do it the hard way
-    def _workaround_sendPhoto(self, sender, path, chat_id):
+    def _workaround_upload(self, kind, sender, body, chat_id):
         payload = {
             'chat_id': chat_id,
             'caption': sender,
         }
 
-        files = {
-            'photo': open(path, 'rb')
-        }
+        base_url = BOT_BASE_URL.format(token=self._token, path=MEDIA_METHODS[kind])
+        with self.metrics.bot_api_seconds.time((MEDIA_METHODS[kind],)):
+            res = self.http.post(base_url, params=payload, data=body,
+                                 headers={'Content-Type': body.content_type})
+        return _check_response(res)
 
-        base_url = BOT_BASE_URL.format(token=self._token, path='sendPhoto')
-        requests.post(base_url, params=payload, files=files)
+    def _send_file_id(self, kind, sender, file_id, chat_id):
+        send = getattr(self, MEDIA_METHODS[kind])
+        return send(chat_id, file_id, caption=sender)
 
-    def _workaround_sendAudio(self, sender, path, chat_id):
-        payload = {
-            'chat_id': chat_id,
-            'caption': sender,
-        }
+    def _prepare_media(self, reservation, forward, media):
+        """Get matrix media ready to be sent, on a media worker.
 
-        files = {
-            'audio': open(path, 'rb')
-        }
+        Media telegram has already seen under the same mxc url is sent by
+        its telegram file id. Otherwise the download from the homeserver is
+        opened, to be streamed into the upload. If the homeserver doesn't
+        tell its size, the media is first spooled aside, and sent by file id
+        if telegram has seen the same content before. The send then fills
+        the place of the media in the outbox.
 
-        base_url = BOT_BASE_URL.format(token=self._token, path='sendAudio')
-        requests.post(base_url, params=payload, files=files)
+        Args:
+            reservation (Reservation): Place of the media in the outbox.
+            forward: ``forward(media)`` sending the media.
+            media (_MatrixMedia): The media.
+        """
+        try:
+            media.file_id = self.media_file_ids.get(media.mxc_key)
+            if media.file_id is None:
+                self._open_media(media)
+            if media.hash_key is not None:
+                media.file_id = self.media_file_ids.get(media.hash_key)
+                if media.file_id is not None:
+                    self.media_file_ids.set(media.mxc_key, media.file_id)
+        except Exception:
+            media.close()
+            reservation.cancel()
+            raise
+        reservation.fill(forward, (media,))
+
+    def _open_media(self, media):
+        res = media.client.open_media(media.event)
+        size = res.headers.get('Content-Length')
+        if size is not None:
+            media.response = res
+            media.size = int(size)
+            return
 
-    def _workaround_sendVideo(self, sender, path, chat_id):
-        payload = {
-            'chat_id': chat_id,
-            'caption': sender,
-        }
+        # the upload needs a size, hold the media aside but on disk if it's big
+        try:
+            media.spooled, media.size, digest = self._spool(res.raw)
+        finally:
+            res.close()
+        media.hash_key = '{} md5:{}'.format(media.kind, digest)
 
-        files = {
-            'video': open(path, 'rb')
-        }
+    def _forward_media(self, media):
+        """Send matrix media to a telegram user, from the outbox.
 
-        base_url = BOT_BASE_URL.format(token=self._token, path='sendVideo')
-        requests.post(base_url, params=payload, files=files)
+        A rejected file id is forgotten and the media uploaded instead. When
+        telegram asks to retry, the media is kept for the outbox to call
+        again.
 
-    def send_photo(self, sender, path, client):
-        logger.info('path = %s', path)
+        Args:
+            media (_MatrixMedia): The media, prepared by :meth:`_prepare_media`.
+        """
+        try:
+            if media.file_id is not None:
+                try:
+                    self._send_file_id(media.kind, media.sender, media.file_id, media.chat_id)
+                    media.close()
+                    return
+                except TelegramError as e:
+                    if e.error_code == 429:
+                        raise
+                    logger.warning('file id of %s rejected: %s', media.mxc_key, e.description)
+                    self.media_file_ids.delete(media.mxc_key)
+                    media.file_id = None
+
+            message = self._upload_media(media)
+        except TelegramError as e:
+            if e.error_code != 429:
+                media.close()
+            raise
+        except Exception:
+            media.close()
+            raise
+        media.close()
+
+        file_id = _sent_file_id(message, media.kind)
+        if file_id is not None:
+            self.media_file_ids.set(media.hash_key, file_id)
+            self.media_file_ids.set(media.mxc_key, file_id)
+
+    def _upload_media(self, media):
+        """Upload media to telegram, streamed from the homeserver or its spooled copy."""
+        if media.spooled is None and (media.response is None or media.response.raw.tell()):
+            # sent by file id so far, or the download went into an upload telegram asked to retry
+            if media.response is not None:
+                media.response.close()
+                media.response = None
+            self._open_media(media)
+
+        if media.spooled is not None:
+            media.spooled.seek(0)
+            source = media.spooled
+        else:
+            source = HashingReader(media.response.raw)
+
+        body = MultipartStream(media.kind, media.client.media_name(media.event),
+                               media.event['content']['info']['mimetype'], source, media.size,
+                               self.config.get('media_chunk_size', DEFAULT_CHUNK_SIZE))
+        message = self._workaround_upload(media.kind, media.sender, body, media.chat_id)
+        self.metrics.media_bytes.inc((MATRIX_TO_TELEGRAM,), media.size)
+        if media.spooled is None:
+            media.hash_key = '{} md5:{}'.format(media.kind, source.hexdigest())
+        return message
+
+    def _send_media(self, kind, sender, event, client):
+        logger.info('media = %s', event['content']['url'])
         chat_id = self._get_chat_id(client)
         if not chat_id:
             return
 
-        self.sendChatAction(chat_id, 'upload_photo')
-        self._workaround_sendPhoto(sender, path, chat_id)
-        # self.sendPhoto(chat_id, open(path, 'rb'))
+        self._send_chat_action(chat_id, 'upload_{}'.format(kind))
+        # the media keeps its place among the chat's messages while it is prepared
+        reservation = self.outbox.reserve(chat_id)
+        forward = self.metrics.relay(MATRIX_TO_TELEGRAM, RELAY_TYPES[kind], self._forward_media)
+        self.media_executor.submit(chat_id, self._prepare_media, reservation, forward,
+                                   _MatrixMedia(kind, sender, event, client, chat_id))
 
-    def send_voice(self, sender, path, client):
-        logger.info('path = %s', path)
+    def send_photo(self, sender, event, client):
+        self._send_media('photo', sender, event, client)
+
+    def send_voice(self, sender, event, client):
+        self._send_media('audio', sender, event, client)
+
+    def send_video(self, sender, event, client):
+        self._send_media('video', sender, event, client)
+
+    def start_typing(self, client):
+        """Show a typing indicator to the telegram user of client until stopped.
+
+        Args:
+            client (MatrigramClient): The client someone is typing in.
+        """
         chat_id = self._get_chat_id(client)
         if not chat_id:
             return
 
-        self.sendChatAction(chat_id, 'upload_audio')
-        self._workaround_sendAudio(sender, path, chat_id)
+        self.typing.start(chat_id)
 
-    def send_video(self, sender, path, client):
-        logger.info('path = %s', path)
+    def stop_typing(self, client):
+        """Stop the typing indicator of the telegram user of client.
+
+        Args:
+            client (MatrigramClient): The client everyone stopped typing in.
+        """
         chat_id = self._get_chat_id(client)
         if not chat_id:
             return
 
-        self.sendChatAction(chat_id, 'upload_video')
-        self._workaround_sendVideo(sender, path, chat_id)
+        self.typing.stop(chat_id)
 
-    def relay_typing(self, chat_id):
-        while True:
-            with self.users_lock:
-                if not self.users[chat_id]['should_type']:
-                    return
-            self.sendChatAction(chat_id, 'typing')
-            time.sleep(2)
+    def _reply(self, chat_id, text, **kwargs):
+        """Queue a bot message (e.g. a command reply) to a telegram user.
 
-    def start_typing_thread(self, client):
-        chat_id = self._get_chat_id(client)
+        Bot messages are sent ahead of messages relayed from matrix.
 
-        with self.users_lock:
-            if self.users[chat_id]['typing_thread']:
-                return
+        Args:
+            chat_id: Telegram user id.
+            text (str): Text message.
+            **kwargs: Extra ``sendMessage`` arguments.
+        """
+        self.outbox.submit(chat_id, self.sendMessage, (chat_id, text), kwargs,
+                           priority=PRIORITY_COMMAND)
 
-            typing_thread = Thread(target=self.relay_typing, args=(chat_id,))
-            self.users[chat_id]['should_type'] = True
-            typing_thread.start()
-            self.users[chat_id]['typing_thread'] = typing_thread
+    def _edit(self, chat_id, message_id, text, **kwargs):
+        """Queue an edit of a bot message, e.g. to show another page.
 
-    def stop_typing_thread(self, client):
-        chat_id = self._get_chat_id(client)
+        Args:
+            chat_id: Telegram user id.
+            message_id: Id of the message to edit.
+            text (str): New text of the message.
+            **kwargs: Extra ``editMessageText`` arguments.
+        """
+        self.outbox.submit(chat_id, self.editMessageText, ((chat_id, message_id), text), kwargs,
+                           priority=PRIORITY_COMMAND)
 
-        with self.users_lock:
-            if not self.users[chat_id]['typing_thread']:
-                return
+    def _relay(self, chat_id, text, kind):
+        """Queue a message relayed from matrix to a telegram user.
+
+        Args:
+            chat_id: Telegram user id.
+            text (str): Text message.
+            kind (str): Type of the relayed message, e.g. ``'text'``.
+        """
+        send = self.metrics.relay(MATRIX_TO_TELEGRAM, kind, self.sendMessage)
+        self.outbox.submit(chat_id, send, (chat_id, text))
 
-            typing_thread = self.users[chat_id]['typing_thread']
-            self.users[chat_id]['should_type'] = False
-        typing_thread.join()
+    def _send_chat_action(self, chat_id, action, priority=PRIORITY_RELAY, refresh=False):
+        """Queue a chat action to a telegram user.
 
-        with self.users_lock:
-            self.users[chat_id]['typing_thread'] = None
+        The action is dropped if the same action is still displayed in the
+        chat, unless it is a refresh, or if chat actions are disabled.
+
+        Args:
+            chat_id: Telegram user id.
+            action (str): Chat action, e.g. ``'typing'``.
+            priority (int): Priority of the action in the outbox.
+            refresh (bool): Whether the action keeps one displayed before it expires.
+        """
+        if not self.chat_actions.allow(chat_id, action, refresh):
+            return
+        self.outbox.submit(chat_id, self.sendChatAction, (chat_id, action), priority=priority)
 
     def _get_client(self, chat_id):
         """Get matrigram client.
@@ -628,11 +1261,10 @@ class MatrigramBot(telepot.Bot):
         Returns:
             MatrigramClient: The client associated to the telegram user with `chat_id`.
         """
-        try:
-            return self.users[chat_id]['client']
-        except KeyError:
+        client = self.users.get_client(chat_id)
+        if client is None:
             logger.error('chat_id doesnt exist?')
-            return None
+        return client
 
     def _get_chat_id(self, client):
         """Get telegram id associated with client.
@@ -643,9 +1275,7 @@ class MatrigramBot(telepot.Bot):
         Returns:
             str: The `chat_id` associated to the client.
         """
-        for chat_id, user in self.users.items():
-            if user['client'] == client:
-                return chat_id
-
-        logger.error('client without user?')
-        return None
+        chat_id = self.users.get_chat_id(client)
+        if chat_id is None:
+            logger.error('client without user?')
+        return chat_id
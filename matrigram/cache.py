@@ -0,0 +1,102 @@
+import sqlite3
+import time
+from collections import OrderedDict
+from threading import Lock
+
+DEFAULT_MAX_SIZE = 1024
+# seconds to wait for another process writing to the database
+DEFAULT_BUSY_TIMEOUT = 30
+
+
+class PersistentMap(object):
+    """String to string mapping persisted in an sqlite table.
+
+    Safe to share between threads, and between processes using the same
+    database file, which wait up to `busy_timeout` seconds for each other.
+
+    Args:
+        path (str): Path of the sqlite database, or ``':memory:'``.
+        table (str): Name of the table holding the mapping.
+        busy_timeout (float): Seconds to wait while the database is locked.
+    """
+
+    def __init__(self, path, table, busy_timeout=DEFAULT_BUSY_TIMEOUT):
+        self.table = table
+
+        self._lock = Lock()
+        self._conn = sqlite3.connect(path, timeout=busy_timeout, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute('CREATE TABLE IF NOT EXISTS {} '
+                               '(key TEXT PRIMARY KEY, value TEXT NOT NULL)'.format(table))
+
+    def get(self, key, default=None):
+        with self._lock:
+            row = self._conn.execute('SELECT value FROM {} WHERE key = ?'.format(self.table),
+                                     (key,)).fetchone()
+        return row[0] if row else default
+
+    def set(self, key, value):
+        with self._lock, self._conn:
+            self._conn.execute('INSERT OR REPLACE INTO {} (key, value) VALUES (?, ?)'.format(
+                self.table), (key, value))
+
+    def delete(self, key):
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM {} WHERE key = ?'.format(self.table), (key,))
+
+    def items(self):
+        """Return a list of all (key, value) pairs."""
+        with self._lock:
+            return self._conn.execute('SELECT key, value FROM {}'.format(self.table)).fetchall()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM {}'.format(self.table)).fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class TTLCache(object):
+    """In memory mapping whose entries expire.
+
+    Safe to share between threads. When full, the least recently set entry
+    is evicted.
+
+    Args:
+        ttl (float): Seconds an entry is kept.
+        max_size (int): Maximal number of entries.
+    """
+
+    def __init__(self, ttl, max_size=DEFAULT_MAX_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+
+        self._lock = Lock()
+        self._items = OrderedDict()  # key -> (expiry time, value)
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return default
+            if item[0] <= time.time():
+                del self._items[key]
+                return default
+            return item[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (time.time() + self.ttl, value)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._items)
@@ -1,24 +1,107 @@
 # -*- coding: utf-8 -*-
 
+import json
 import logging
-import mimetypes
-import os
+import time
+
+try:
+    from urllib import quote
+except ImportError:
+    from urllib.parse import quote
 
-import requests
 from matrix_client.client import MatrixClient
 from matrix_client.client import MatrixRequestError
 from requests import ConnectionError
 
-from .helper import download_file
+from .cache import TTLCache
+from .filters import sync_filter
 from .helper import pprint_json
+from .history import DEFAULT_HISTORY_SIZE
+from .history import RoomHistory
+from .members import DEFAULT_PAGE_SIZE
+from .members import MemberIndex
 
 logger = logging.getLogger('matrigram')
 
+# seconds to wait before syncing again after an error
+SYNC_RETRY_DELAY = 5
+# seconds a resolved room alias is trusted, unless the room says it changed
+ALIAS_TTL = 10 * 60
+ALIAS_EVENT_TYPES = ('m.room.aliases', 'm.room.canonical_alias')
+UPLOAD_PATH = '/_matrix/media/r0/upload'
+# seconds to wait before uploading again, unless the homeserver says
+DEFAULT_UPLOAD_RETRY_DELAY = 5
+
+
+class _UploadThrottled(Exception):
+    """The homeserver asked to retry a media upload later.
+
+    Raised from the response, before matrix_client would send the same,
+    already consumed, body again.
+
+    Args:
+        retry_after (float): Seconds to wait before retrying.
+    """
+
+    def __init__(self, retry_after):
+        super(_UploadThrottled, self).__init__(retry_after)
+        self.retry_after = retry_after
+
+
+def _check_upload(response, *args, **kwargs):
+    """Response hook raising :class:`_UploadThrottled` for rate limited uploads."""
+    if response.status_code != 429 or UPLOAD_PATH not in response.request.path_url:
+        return
+    try:
+        retry_after = response.json()['retry_after_ms'] / 1000.0
+    except (ValueError, KeyError):
+        retry_after = DEFAULT_UPLOAD_RETRY_DELAY
+    raise _UploadThrottled(retry_after)
+
+
+class _MatrixClient(MatrixClient):
+    """MatrixClient calling `on_sync` after each successful sync.
+
+    `on_gap` is called with the id of each room whose timeline a sync left
+    events out of, before its events are handled. Rate limited media uploads
+    raise :class:`_UploadThrottled` instead of being retried.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.on_sync = kwargs.pop('on_sync', None)
+        self.on_gap = kwargs.pop('on_gap', None)
+        super(_MatrixClient, self).__init__(*args, **kwargs)
+        self._api_sync = self.api.sync
+        self.api.sync = self._checked_sync
+        self.api.session.hooks['response'].append(_check_upload)
+
+    def _checked_sync(self, *args, **kwargs):
+        response = self._api_sync(*args, **kwargs)
+        if self.on_gap is not None:
+            for room_id, sync_room in response.get('rooms', {}).get('join', {}).items():
+                if sync_room.get('timeline', {}).get('limited'):
+                    self.on_gap(room_id)
+        return response
+
+    def _sync(self, timeout_ms=30000):
+        super(_MatrixClient, self)._sync(timeout_ms)
+        if self.on_sync is not None:
+            self.on_sync()
+
 
 class MatrigramClient(object):
-    def __init__(self, server, tb, username):
-        self.client = MatrixClient(server)
+    def __init__(self, server, tb, username, filter_options=None, alias_ids=None,
+                 history_size=DEFAULT_HISTORY_SIZE):
+        self.client = _MatrixClient(server, on_sync=self.on_sync, on_gap=self.on_gap)
+        # recent events of every room, replayed when the focus changes
+        self.history = RoomHistory(history_size)
+        self.client.add_listener(self.on_timeline_event)
         self.tb = tb
+        # (server, alias) -> room id, shared between the clients of a bot
+        self.alias_ids = alias_ids if alias_ids is not None else TTLCache(ALIAS_TTL)
+        # keyword arguments of matrigram.filters.sync_filter
+        self.filter_options = filter_options or {}
+        self._filtered = False
         self.token = None
         self.server = server
         self.username = username
@@ -31,26 +114,170 @@ class MatrigramClient(object):
         }
         self.room_listener_uid = None
         self.ephemeral_listener_uid = None
+        self._members = {}  # room id -> MemberIndex, built on the first listing
 
     def login(self, username, password):
         try:
-            self.token = self.client.login_with_password(username, password)
+            self.token = self.client.login(username, password, sync=False)
             logger.info('token = %s', self.token)
+            self.update_sync_filter()
+            self.client._sync()
             rooms = self.get_rooms_aliases()
             if rooms:
                 # set focus room to "first" room
-                self.set_focus_room(rooms.keys()[0])
+                self.set_focus_room(next(iter(rooms)))
 
-            self.client.add_invite_listener(self.on_invite_event)
-            self.client.add_leave_listener(self.on_leave_event)
-            self.client.start_listener_thread()
+            self._listen()
             return True, "OK"
         except MatrixRequestError:
             return False, "Failed to login"
         except ConnectionError:
             return False, "Server is offline"
 
+    def restore(self, state):
+        """Resume a session saved with :meth:`state`, without logging in again.
+
+        Rooms are rebuilt from the saved state, and syncing resumes from the
+        saved sync token, so only what happened since is downloaded.
+
+        Args:
+            state (dict): The saved session.
+        """
+        self.token = state['token']
+        self.client.api.token = state['token']
+        self.client.user_id = state['user_id']
+        self.client.device_id = state['device_id']
+        self.client.sync_token = state['since']
+
+        for room_id, room_state in state['rooms'].items():
+            room = self.client._mkroom(room_id)
+            room.name = room_state['name']
+            room.canonical_alias = room_state['canonical_alias']
+            room.aliases = room_state['aliases']
+
+        if state['focus_room_id'] in self.client.rooms:
+            self.set_focus_room(state['focus_room_id'])
+
+        self.update_sync_filter()
+        self._listen()
+
+    def state(self):
+        """Return what is needed to resume the session after a restart.
+
+        Returns (dict): Credentials, focus room, sync token and joined rooms.
+
+        """
+        rooms = self.client.rooms
+        return {
+            'server': self.server,
+            'username': self.username,
+            'user_id': self.client.user_id,
+            'token': self.token,
+            'device_id': self.client.device_id,
+            'focus_room_id': self.focus_room_id,
+            'since': self.client.sync_token,
+            'rooms': {room_id: {'name': room.name,
+                                'canonical_alias': room.canonical_alias,
+                                'aliases': room.aliases}
+                      for room_id, room in rooms.items()},
+        }
+
+    def update_sync_filter(self):
+        """Upload the sync filter and use it for the next syncs.
+
+        Falls back to sending the filter along with each sync if the
+        homeserver doesn't store filters.
+        """
+        definition = sync_filter(focus_room_id=self.focus_room_id, **self.filter_options)
+        try:
+            res = self.client.api.create_filter(self.client.user_id, definition)
+            self.client.sync_filter = res['filter_id']
+        except MatrixRequestError:
+            logger.warning('homeserver refused the sync filter, sending it inline')
+            self.client.sync_filter = json.dumps(definition)
+        self._filtered = True
+
+    @property
+    def user_id(self):
+        return self.client.user_id
+
+    def room_ids(self):
+        return list(self.client.rooms)
+
+    def _listen(self):
+        if self.tb.appservice is not None:
+            # the homeserver pushes our events, no need to sync
+            self.tb.appservice.register(self)
+            return
+
+        self.client.add_invite_listener(self.on_invite_event)
+        self.client.add_leave_listener(self.on_leave_event)
+        for event_type in ALIAS_EVENT_TYPES:
+            self.client.add_listener(self.on_alias_event, event_type)
+        self.client.start_listener_thread(exception_handler=self.on_sync_error)
+
+    def on_pushed_event(self, event):
+        """Handle an event pushed to the application service.
+
+        Does what a sync containing the event would do.
+
+        Args:
+            event (dict): Matrix room event.
+        """
+        room_id = event['room_id']
+        joined = False
+        if event['type'] == 'm.room.member' and event.get('state_key') == self.user_id:
+            membership = event['content'].get('membership')
+            if membership == 'invite':
+                invite_state = event.get('unsigned', {}).get('invite_room_state', [])
+                self.on_invite_event(room_id, {'events': invite_state})
+                return
+            if membership in ('leave', 'ban'):
+                self.client.rooms.pop(room_id, None)
+                self.on_leave_event(room_id, {'timeline': {'events': [event]}})
+                # without syncs, nothing else saves the rooms for a restart
+                self.tb.checkpoint_session(self, force=True)
+                return
+            if membership == 'join' and room_id not in self.client.rooms:
+                self.client._mkroom(room_id)
+                joined = True
+
+        room = self.client.rooms.get(room_id)
+        if room is not None:
+            room._put_event(event)
+            self.on_timeline_event(event)
+            if event['type'] in ALIAS_EVENT_TYPES:
+                self.on_alias_event(event)
+        if joined:
+            self.tb.checkpoint_session(self, force=True)
+
+    def on_gap(self, room_id):
+        self._forget_members(room_id)
+        # the recorded events would skip over the gap
+        self.history.discard(room_id)
+
+    def on_timeline_event(self, event):
+        self.history.add(event['room_id'], event)
+
+    def on_pushed_ephemeral_event(self, event):
+        room = self.client.rooms.get(event.get('room_id'))
+        if room is not None:
+            room._put_ephemeral_event(event)
+
+    def on_sync(self):
+        self.tb.checkpoint_session(self)
+
+    def on_sync_error(self, error):
+        if isinstance(error, MatrixRequestError) and error.code == 401:
+            # the access token was revoked, or expired while we were away
+            self.client.should_listen = False
+            self.tb.session_expired(self)
+            return
+        time.sleep(SYNC_RETRY_DELAY)
+
     def logout(self):
+        if self.tb.appservice is not None:
+            self.tb.appservice.unregister(self)
         self.client.logout()
 
     def on_event(self, _, event):
@@ -82,17 +309,21 @@ class MatrigramClient(object):
 
         if ee['type'] == 'm.typing':
             if ee['content']['user_ids']:
-                self.tb.start_typing_thread(self)
+                self.tb.start_typing(self)
             else:
-                self.tb.stop_typing_thread(self)
+                self.tb.stop_typing(self)
 
     def on_leave_event(self, room_id, le):
         logger.debug(pprint_json(le))
+        self._forget_members(room_id)
+        self.history.discard(room_id)
 
-        if le['timeline']['events'][0]['sender'] != le['timeline']['events'][0]['state_key']:
+        events = le['timeline']['events']
+        # the timeline of rooms out of focus may be filtered out
+        if events and events[0]['sender'] != events[0]['state_key']:
             self.tb.send_kick(self._room_id_to_alias(room_id), self)
 
-    def on_invite_event(self, _, ie):
+    def on_invite_event(self, room_id, ie):
         logger.debug('invite event %s', pprint_json(ie))
         room_name = None
         for event in ie['events']:
@@ -100,7 +331,21 @@ class MatrigramClient(object):
                 room_name = event['content']['name']
 
         if room_name:
-            self.tb.send_invite(self, self._room_id_to_alias(room_name))
+            self.tb.send_invite(self, room_name, room_id)
+
+    def on_alias_event(self, event):
+        """Forget the resolutions of aliases a room gained or lost.
+
+        Args:
+            event (dict): ``m.room.aliases`` or ``m.room.canonical_alias`` event.
+        """
+        prev_content = event.get('unsigned', {}).get('prev_content', {})
+        for content in (event.get('content', {}), prev_content):
+            aliases = content.get('aliases', []) + content.get('alt_aliases', [])
+            if content.get('alias'):
+                aliases.append(content['alias'])
+            for alias in aliases:
+                self.alias_ids.delete((self.server, alias))
 
     def join_room(self, room_id_or_alias):
         try:
@@ -118,10 +363,9 @@ class MatrigramClient(object):
 
         if self.focus_room_id == room.room_id:
             rooms = self.get_rooms_aliases()
-            room_id = self._room_alias_to_id(room_id_or_alias)
 
-            del rooms[room_id]
-            new_focus_room = rooms.keys()[0] if rooms else None
+            del rooms[room.room_id]
+            new_focus_room = next(iter(rooms)) if rooms else None
             self.set_focus_room(new_focus_room)
 
         return room.leave()
@@ -137,6 +381,10 @@ class MatrigramClient(object):
             self.room_listener_uid = None
             room_obj.remove_ephemeral_listener(self.ephemeral_listener_uid)
             self.ephemeral_listener_uid = None
+            if self.filter_options.get('focus_only'):
+                # its timeline is filtered out from now on
+                self.history.discard(self.focus_room_id)
+                self._forget_members(self.focus_room_id)
             logger.info("remove focus room %s", self.focus_room_id)
             self.focus_room_id = None
 
@@ -148,17 +396,55 @@ class MatrigramClient(object):
             self.ephemeral_listener_uid = room_obj.add_ephemeral_listener(self.on_ephemeral_event)
             logger.info("set focus room to %s", self.focus_room_id)
 
+        if self.filter_options.get('focus_only') and self._filtered:
+            self.update_sync_filter()
+        self.tb.checkpoint_session(self, force=True)
+
     def get_focus_room_alias(self):
         return self._room_id_to_alias(self.focus_room_id)
 
+    def get_room_alias(self, room_id_or_alias):
+        return self._room_id_to_alias(room_id_or_alias)
+
     def have_focus_room(self):
         return self.focus_room_id is not None
 
-    def get_members(self):
-        room_obj = self.get_room_obj(self.focus_room_id)
-        rtn = room_obj.get_joined_members()
+    def get_members(self, offset=0, limit=DEFAULT_PAGE_SIZE, prefix=None):
+        """List members of the focus room.
+
+        Args:
+            offset (int): Members to skip.
+            limit (int): Maximal number of members returned.
+            prefix (str): Only members whose name starts with it, ignoring case.
 
-        return [member['displayname'] for _, member in rtn.items() if member.get('displayname')]
+        Returns (tuple): The names of the members and the number of members matching `prefix`.
+
+        """
+        return self._member_index(self.focus_room_id).page(offset, limit, prefix)
+
+    def _member_index(self, room_id):
+        index = self._members.get(room_id)
+        if index is None:
+            index = MemberIndex()
+            # listen first, so no membership change is lost while fetching
+            self.get_room_obj(room_id).add_state_listener(index.on_member_event, 'm.room.member')
+            self._members[room_id] = index
+            try:
+                response = self.client.api._send(
+                    'GET', '/rooms/{}/joined_members'.format(quote(room_id, safe='')))
+            except Exception:
+                self._forget_members(room_id)
+                raise
+            index.load(response.get('joined', {}))
+        return index
+
+    def _forget_members(self, room_id):
+        """Drop the member index of a room, once its membership changes may go unseen."""
+        index = self._members.pop(room_id, None)
+        room = self.client.rooms.get(room_id)
+        if index is not None and room is not None:
+            room.state_listeners = [listener for listener in room.state_listeners
+                                    if listener['callback'] != index.on_member_event]
 
     def set_name(self, name):
         user = self.client.get_user(self.client.user_id)
@@ -179,20 +465,40 @@ class MatrigramClient(object):
             logger.error('error creating room')
             return None, None
 
-    def backfill_previous_messages(self, limit=10):
-        room_obj = self.get_room_obj(self.focus_room_id)
-        room_obj.backfill_previous_messages(limit=limit)
+    def get_history(self):
+        """Get the latest messages of the focus room, without relaying them.
 
-    def get_rooms_aliases(self):
-        # returns a dict with id: room obj
-        rooms = self._get_rooms_updated()
-        if not rooms:
-            return rooms
+        The history of a room is fetched from the homeserver the first time
+        only, and kept current by the events that arrive after.
+
+        Returns (list): The message and topic events, oldest first.
+
+        """
+        room_id = self.focus_room_id
+        events = self.history.get(room_id)
+        if events is None:
+            room_obj = self.get_room_obj(room_id)
+            res = self.client.api.get_room_messages(room_id, room_obj.prev_batch,
+                                                    direction='b', limit=self.history.size)
+            self.history.seed(room_id, list(reversed(res['chunk'])))
+            events = self.history.get(room_id)
+        return events
+
+    def relay_media(self, event):
+        """Send the media of a message event to telegram, as if it just arrived."""
+        callback = self.msg_type_router.get(event['content'].get('msgtype'))
+        if callback and callback != self.forward_emote_to_tb:
+            callback(event)
+
+    def media_url(self, event):
+        """Return the http url of the media of a message event."""
+        return self.client.api.get_download_url(event['content']['url'])
 
-        logger.debug("rooms got from server are %s", rooms)
+    def get_rooms_aliases(self):
+        rooms = self._get_rooms()
 
         # return dict with id: list of aliases or id (if no alias exists)
-        return {key: val.aliases if val.aliases else [key] for (key, val) in rooms.items()}
+        return {key: _room_aliases(val) or [key] for (key, val) in rooms.items()}
 
     def get_room_obj(self, room_id_or_alias):
         """Get room object of specific id or alias.
@@ -203,10 +509,9 @@ class MatrigramClient(object):
         Returns (Room): Room object corresponding to room_id_or_alias.
 
         """
-        rooms = self._get_rooms_updated()
         room_id = self._room_alias_to_id(room_id_or_alias)
 
-        return rooms.get(room_id)
+        return self.client.rooms.get(room_id)
 
     def send_message(self, msg):
         room_obj = self.get_room_obj(self.focus_room_id)
@@ -216,60 +521,107 @@ class MatrigramClient(object):
         else:
             room_obj.send_text(msg)
 
-    def send_photo(self, path):
-        with open(path, 'rb') as f:
-            mxcurl = self.client.upload(f.read(), mimetypes.guess_type(path)[0])
+    def upload(self, content, mimetype):
+        """Upload media to the homeserver.
 
-            room_obj = self.get_room_obj(self.focus_room_id)
+        Args:
+            content: The media, as bytes or a callable opening a sized stream
+                of it to be sent in chunks. The callable is called again for
+                each retry when the homeserver rate limits the upload.
+            mimetype (str): Content type of the media.
 
-            if not room_obj:
-                logger.error('cant find room')
-            else:
-                room_obj.send_image(mxcurl, os.path.split(path)[1])
+        Returns (str): The mxc url of the uploaded media.
 
-    def send_voice(self, path):
-        with open(path, 'rb') as f:
-            mxcurl = self.client.upload(f.read(), mimetypes.guess_type(path)[0])
-            room_obj = self.get_room_obj(self.focus_room_id)
-            room_obj.send_audio(mxcurl, os.path.split(path)[1])
+        """
+        while True:
+            body = content() if callable(content) else content
+            try:
+                return self.client.upload(body, mimetype)
+            except _UploadThrottled as e:
+                logger.warning('upload rate limited, retry after %ss', e.retry_after)
+                time.sleep(e.retry_after)
 
-    def send_video(self, path):
-        with open(path, 'rb') as f:
-            mxcurl = self.client.upload(f.read(), mimetypes.guess_type(path)[0])
-            room_obj = self.get_room_obj(self.focus_room_id)
-            room_obj.send_video(mxcurl, os.path.split(path)[1])
+    def send_media(self, msgtype, mxcurl, name):
+        """Send already uploaded media to the focus room.
 
-    def discover_rooms(self):
-        res = requests.get('{}/_matrix/client/r0/publicRooms?limit=20'.format(self.server))
-        res_json = res.json()
+        Args:
+            msgtype (str): ``'m.image'``, ``'m.audio'`` or ``'m.video'``.
+            mxcurl (str): The mxc url of the media.
+            name (str): Name of the media.
 
-        room_objs = res_json['chunk']
-        return [room['aliases'][0] for room in room_objs if room.get('aliases')]
+        """
+        room_obj = self.get_room_obj(self.focus_room_id)
 
-    def download_from_event(self, event):
-        mxcurl = event['content']['url']
-        link = self.client.api.get_download_url(mxcurl)
-        media_id = mxcurl.split('/')[3]
-        media_type = event['content']['info']['mimetype'].split('/')[1]
-        path = os.path.join(self.tb.config['media_dir'], '{}.{}'.format(media_id, media_type))
-        download_file(link, path)
+        if not room_obj:
+            logger.error('cant find room')
+        elif msgtype == 'm.image':
+            room_obj.send_image(mxcurl, name)
+        elif msgtype == 'm.audio':
+            room_obj.send_audio(mxcurl, name)
+        else:
+            room_obj.send_video(mxcurl, name)
 
-        return path
+    def discover_rooms(self, offset=0, limit=DEFAULT_PAGE_SIZE, term=None):
+        """List public rooms of the homeserver, from the directory shared by the bot.
+
+        Args:
+            offset (int): Rooms to skip.
+            limit (int): Maximal number of rooms returned.
+            term (str): Search term filtering the rooms.
+
+        Returns (tuple): The rooms and whether there are rooms after them,
+            see :meth:`matrigram.directory.RoomDirectory.page`.
+
+        """
+        return self.tb.directory.page(self.server, self._fetch_public_rooms, offset, limit, term)
+
+    def _fetch_public_rooms(self, since, limit, term):
+        body = {'limit': limit}
+        if since:
+            body['since'] = since
+        if term:
+            body['filter'] = {'generic_search_term': term}
+        return self.client.api._send('POST', '/publicRooms', body)
+
+    def open_media(self, event):
+        """Start downloading the media of an event.
+
+        Args:
+            event (dict): Matrix media event.
+
+        Returns (requests.Response): The streamed response, to be closed by the caller.
+
+        """
+        link = self.client.api.get_download_url(event['content']['url'])
+        res = self.tb.http.get(link, stream=True, headers={'Accept-Encoding': 'identity'})
+        res.raise_for_status()
+        return res
+
+    @staticmethod
+    def media_name(event):
+        """Name media of an event after its media id and type.
+
+        Args:
+            event (dict): Matrix media event.
+
+        Returns (str): File name of the media.
+
+        """
+        media_id = event['content']['url'].split('/')[3]
+        media_type = event['content']['info']['mimetype'].split('/')[1]
+        return '{}.{}'.format(media_id, media_type)
 
     def forward_image_to_tb(self, event):
         sender = event['sender'].split(':')[0].encode('utf-8')
-        path = self.download_from_event(event)
-        self.tb.send_photo(sender, path, self)
+        self.tb.send_photo(sender, event, self)
 
     def forward_voice_to_tb(self, event):
         sender = event['sender'].split(':')[0].encode('utf-8')
-        path = self.download_from_event(event)
-        self.tb.send_voice(sender, path, self)
+        self.tb.send_voice(sender, event, self)
 
     def forward_video_to_tb(self, event):
         sender = event['sender'].split(':')[0].encode('utf-8')
-        path = self.download_from_event(event)
-        self.tb.send_video(sender, path, self)
+        self.tb.send_video(sender, event, self)
 
     def forward_emote_to_tb(self, event):
         sender = event['sender'].split(':')[0].encode('utf-8')
@@ -310,16 +662,41 @@ class MatrigramClient(object):
         if not alias.startswith('#'):
             return alias
 
-        return self.client.api.get_room_id(alias)
+        for room in self._get_rooms().values():
+            if alias in _room_aliases(room):
+                return room.room_id
 
-    def _get_rooms_updated(self):
-        """Return rooms dictionary with updated aliases.
+        # rooms we're not in, e.g. those we're about to join
+        key = (self.server, alias)
+        room_id = self.alias_ids.get(key)
+        if room_id is None:
+            room_id = self.client.api.get_room_id(alias)
+            self.alias_ids.set(key, room_id)
+        return room_id
 
-        Returns (dict): Return rooms dictionary with updated aliases.
+    def _get_rooms(self):
+        """Return the joined rooms.
+
+        Names and aliases of the rooms are kept current by the state events
+        of each sync, so this makes no request.
+
+        Returns (dict): Snapshot of room ids to room objects.
 
         """
-        rooms = self.client.get_rooms()
-        for room in rooms.values():
-            room.update_aliases()
+        # copied in one step, as the sync thread adds and removes rooms
+        return dict(self.client.rooms)
+
+
+def _room_aliases(room):
+    """Return the aliases of a room, its canonical alias first.
+
+    Args:
+        room (Room): The room.
+
+    Returns (list): The aliases.
 
-        return rooms
+    """
+    aliases = list(room.aliases or [])
+    if room.canonical_alias and room.canonical_alias not in aliases:
+        aliases.insert(0, room.canonical_alias)
+    return aliases
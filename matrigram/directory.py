@@ -0,0 +1,79 @@
+from threading import Lock
+
+from .cache import TTLCache
+
+# seconds a listing of public rooms is reused
+DEFAULT_TTL = 60
+# rooms asked for in each request to the homeserver
+DEFAULT_BATCH_SIZE = 50
+
+
+class _Listing(object):
+    """Public rooms matching a search, as far as they were fetched."""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.rooms = []
+        self.next_batch = None
+        self.complete = False
+
+
+class RoomDirectory(object):
+    """Public rooms of homeservers, fetched in batches as they are paged through.
+
+    Listings are kept per homeserver and search term for `ttl` seconds and
+    shared by all users, so paging or repeating a search is served from
+    memory. Only rooms with an alias, which users can join, are listed.
+    Safe to share between threads.
+
+    Args:
+        ttl (float): Seconds a listing is kept.
+        batch_size (int): Rooms fetched per request.
+    """
+
+    def __init__(self, ttl=DEFAULT_TTL, batch_size=DEFAULT_BATCH_SIZE):
+        self.batch_size = batch_size
+
+        self._lock = Lock()
+        self._listings = TTLCache(ttl)  # (server, search term) -> _Listing
+
+    def page(self, server, fetch, offset, limit, term=None):
+        """Return a page of public rooms.
+
+        Args:
+            server (str): The homeserver.
+            fetch: ``fetch(since, limit, term)`` requesting a batch of the
+                homeserver's ``publicRooms``, returning the response.
+            offset (int): Rooms to skip.
+            limit (int): Maximal number of rooms returned.
+            term (str): Search term filtering the rooms on the homeserver.
+
+        Returns:
+            tuple: (rooms, more), rooms as dicts of ``alias``, ``name`` and
+            ``members``, and whether there are rooms after them.
+        """
+        key = (server, term)
+        with self._lock:
+            listing = self._listings.get(key)
+            if listing is None:
+                listing = _Listing()
+                self._listings.set(key, listing)
+
+        with listing.lock:
+            while len(listing.rooms) <= offset + limit and not listing.complete:
+                response = fetch(listing.next_batch, self.batch_size, term)
+                listing.rooms.extend(_room(chunk) for chunk in response.get('chunk', [])
+                                     if chunk.get('canonical_alias') or chunk.get('aliases'))
+                listing.next_batch = response.get('next_batch')
+                listing.complete = not listing.next_batch or not response.get('chunk')
+
+            return (listing.rooms[offset:offset + limit],
+                    len(listing.rooms) > offset + limit)
+
+
+def _room(chunk):
+    return {
+        'alias': chunk.get('canonical_alias') or chunk['aliases'][0],
+        'name': chunk.get('name'),
+        'members': chunk.get('num_joined_members', 0),
+    }
@@ -0,0 +1,63 @@
+DEFAULT_TIMELINE_LIMIT = 10
+
+# timeline events relayed to telegram, or keeping track of the rooms
+TIMELINE_TYPES = [
+    'm.room.message',
+    'm.room.topic',
+    'm.room.member',
+    'm.room.name',
+    'm.room.aliases',
+    'm.room.canonical_alias',
+]
+# room state needed to name rooms and their members
+STATE_TYPES = [
+    'm.room.name',
+    'm.room.aliases',
+    'm.room.canonical_alias',
+    'm.room.member',
+]
+EPHEMERAL_TYPES = ['m.typing']
+
+
+def sync_filter(timeline_limit=DEFAULT_TIMELINE_LIMIT, event_types=None, lazy_load_members=True,
+                presence=False, focus_only=False, focus_room_id=None):
+    """Build the sync filter of a matrigram client.
+
+    By default, syncs only carry what matrigram relays to telegram: no
+    presence or account data, no receipts, only the timeline events in
+    `TIMELINE_TYPES` and only the members who sent them.
+
+    Args:
+        timeline_limit (int): Timeline events per room and sync.
+        event_types (list): Timeline event types, defaults to `TIMELINE_TYPES`.
+        lazy_load_members (bool): Only sync members who sent timeline events.
+        presence (bool): Sync presence updates.
+        focus_only (bool): Sync timeline and typing of the focus room only.
+            Leaving other rooms is still noticed, but not kicks from them.
+        focus_room_id (str): The focus room, for `focus_only`.
+
+    Returns:
+        dict: The filter definition.
+    """
+    timeline = {
+        'limit': timeline_limit,
+        'types': list(event_types if event_types is not None else TIMELINE_TYPES),
+    }
+    ephemeral = {'types': list(EPHEMERAL_TYPES)}
+    if focus_only:
+        timeline['rooms'] = [focus_room_id] if focus_room_id else []
+        ephemeral['rooms'] = list(timeline['rooms'])
+
+    definition = {
+        'account_data': {'types': []},
+        'room': {
+            'state': {'types': list(STATE_TYPES), 'lazy_load_members': lazy_load_members},
+            'timeline': timeline,
+            'ephemeral': ephemeral,
+            'account_data': {'types': []},
+        },
+    }
+    if not presence:
+        definition['presence'] = {'types': []}
+
+    return definition
@@ -3,10 +3,9 @@ import json
 import os
 import shutil
 
-import requests
-
 HELP_MSG = 'matrigram: A bridge between matrix and telegram'
 CONFIG_PATH = os.path.join(os.path.expanduser('~'), '.matrigramconfig')
+DATA_DIR = os.path.join(os.path.expanduser('~'), '.matrigram')
 
 
 def pprint_json(to_print):
@@ -31,18 +30,6 @@ def get_config():
         return json.load(config_file)
 
 
-def download_file(url, path):
-    """Download a file from the net.
-
-    Args:
-        url (str): Link to the file.
-        path (str): Where to save.
-    """
-    res = requests.get(url)
-    with open(path, 'wb') as f:
-        f.write(res.content)
-
-
 def list_to_nice_str(l):
     """Convert a string list to a ready to print string.
 
@@ -67,6 +54,39 @@ def list_to_nice_lines(l):
     return '\n'.join(l)
 
 
+def pack_lines(lines, limit):
+    """Join lines into as few messages as fit `limit` characters each.
+
+    Lines are never split between messages, unless a line alone is longer
+    than `limit`.
+
+    Args:
+        lines (list): Lines of text.
+        limit (int): Maximal length of a message.
+
+    Returns:
+        list: The messages.
+    """
+    messages = []
+    current = None
+    for line in lines:
+        while len(line) > limit:
+            if current is not None:
+                messages.append(current)
+                current = None
+            messages.append(line[:limit])
+            line = line[limit:]
+        if current is not None and len(current) + 1 + len(line) <= limit:
+            current += '\n' + line
+        else:
+            if current is not None:
+                messages.append(current)
+            current = line
+    if current is not None:
+        messages.append(current)
+    return messages
+
+
 def chunks(l, n):
     """Yield successive n-sized chunks from l.
 
@@ -0,0 +1,102 @@
+from collections import deque
+from threading import Lock
+
+# recent events kept per room
+DEFAULT_HISTORY_SIZE = 10
+# characters of a message body kept
+MAX_BODY_LENGTH = 1024
+HISTORY_TYPES = ('m.room.message', 'm.room.topic')
+
+
+def _record(event):
+    content = event.get('content', {})
+    text = content.get('topic') if event['type'] == 'm.room.topic' else content.get('body')
+    mimetype = (content.get('info') or {}).get('mimetype')
+    return (event.get('event_id'), event['type'], event['sender'], content.get('msgtype'),
+            (text or '')[:MAX_BODY_LENGTH], content.get('url'), mimetype)
+
+
+def _event(record):
+    event_id, event_type, sender, msgtype, text, url, mimetype = record
+    if event_type == 'm.room.topic':
+        content = {'topic': text}
+    else:
+        content = {'msgtype': msgtype, 'body': text}
+        if url:
+            content['url'] = url
+            content['info'] = {'mimetype': mimetype}
+    return {'event_id': event_id, 'type': event_type, 'sender': sender, 'content': content}
+
+
+class RoomHistory(object):
+    """Recent message and topic events of rooms, kept as compact records.
+
+    Each room holds at most `size` events, as tuples instead of the event
+    dicts, with long bodies cut. A room is complete once seeded with its
+    history from the homeserver, after which events added keep it current
+    and it can be replayed without asking the homeserver. Safe to share
+    between threads.
+
+    Args:
+        size (int): Events kept per room.
+    """
+
+    def __init__(self, size=DEFAULT_HISTORY_SIZE):
+        self.size = size
+
+        self._lock = Lock()
+        self._rooms = {}  # room id -> deque of records
+        self._complete = set()  # room ids seeded from the homeserver
+
+    def add(self, room_id, event):
+        """Record an event that arrived in a room.
+
+        Args:
+            room_id (str): The room.
+            event (dict): The event, ignored unless its type is in `HISTORY_TYPES`.
+        """
+        if event.get('type') not in HISTORY_TYPES:
+            return
+        record = _record(event)
+        with self._lock:
+            records = self._rooms.get(room_id)
+            if records is None:
+                records = self._rooms[room_id] = deque(maxlen=self.size)
+            records.append(record)
+
+    def seed(self, room_id, events):
+        """Complete a room with its history fetched from the homeserver.
+
+        Events recorded meanwhile are kept after the fetched ones.
+
+        Args:
+            room_id (str): The room.
+            events (list): The latest events of the room, oldest first.
+        """
+        with self._lock:
+            fetched = [_record(event) for event in events if event.get('type') in HISTORY_TYPES]
+            fetched_ids = set(record[0] for record in fetched)
+            recorded = [record for record in self._rooms.get(room_id, ())
+                        if record[0] not in fetched_ids]
+            self._rooms[room_id] = deque(fetched + recorded, maxlen=self.size)
+            self._complete.add(room_id)
+
+    def get(self, room_id):
+        """Return the events of a complete room.
+
+        Args:
+            room_id (str): The room.
+
+        Returns:
+            list: The events, oldest first, or None if the room wasn't seeded.
+        """
+        with self._lock:
+            if room_id not in self._complete:
+                return None
+            return [_event(record) for record in self._rooms.get(room_id, ())]
+
+    def discard(self, room_id):
+        """Forget a room, e.g. when its events stop arriving."""
+        with self._lock:
+            self._rooms.pop(room_id, None)
+            self._complete.discard(room_id)
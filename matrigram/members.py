@@ -0,0 +1,92 @@
+from bisect import bisect_left
+from bisect import insort
+from threading import Lock
+
+DEFAULT_PAGE_SIZE = 10
+
+
+def _sort_key(user_id, name):
+    return (name or user_id).lower(), user_id
+
+
+class MemberIndex(object):
+    """Joined members of a room, sorted by display name.
+
+    Built once from the members of the room, then kept current from its
+    ``m.room.member`` events, so listing members never fetches them again.
+    Safe to share between threads.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._names = {}  # user id -> display name
+        self._sorted = []  # sort keys of the members
+        self._updated = set()  # user ids whose membership events were seen
+
+    def load(self, joined):
+        """Add the members of the room, as fetched from the homeserver.
+
+        Members whose membership events arrived meanwhile are left as the
+        events say.
+
+        Args:
+            joined (dict): User id to profile (``display_name``), as in the
+                response of ``/joined_members``.
+        """
+        with self._lock:
+            for user_id, profile in joined.items():
+                if user_id not in self._updated and user_id not in self._names:
+                    self._names[user_id] = (profile or {}).get('display_name')
+            self._sorted = sorted(_sort_key(user_id, name)
+                                  for user_id, name in self._names.items())
+
+    def on_member_event(self, event):
+        """Update the index with an ``m.room.member`` state event.
+
+        Args:
+            event (dict): The event.
+        """
+        user_id = event['state_key']
+        content = event.get('content', {})
+        with self._lock:
+            self._updated.add(user_id)
+            self._remove(user_id)
+            if content.get('membership') == 'join':
+                name = content.get('displayname')
+                self._names[user_id] = name
+                insort(self._sorted, _sort_key(user_id, name))
+
+    def _remove(self, user_id):
+        if user_id not in self._names:
+            return
+        key = _sort_key(user_id, self._names.pop(user_id))
+        del self._sorted[bisect_left(self._sorted, key)]
+
+    def page(self, offset=0, limit=DEFAULT_PAGE_SIZE, prefix=None):
+        """Return a page of member names.
+
+        Args:
+            offset (int): Members to skip.
+            limit (int): Maximal number of members returned.
+            prefix (str): Only members whose name starts with it, ignoring case.
+
+        Returns:
+            tuple: (names, total), the display names (or user ids) of the
+            page and the number of members matching `prefix`.
+        """
+        with self._lock:
+            if prefix:
+                prefix = prefix.lower()
+                start = bisect_left(self._sorted, (prefix,))
+                end = start
+                while end < len(self._sorted) and self._sorted[end][0].startswith(prefix):
+                    end += 1
+            else:
+                start, end = 0, len(self._sorted)
+
+            keys = self._sorted[start + offset:min(start + offset + limit, end)]
+            return [self._names[user_id] or user_id for _, user_id in keys], end - start
+
+    def __len__(self):
+        with self._lock:
+            return len(self._names)
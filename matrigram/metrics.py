@@ -0,0 +1,328 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from threading import Lock
+from threading import Thread
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler
+except ImportError:
+    from http.server import BaseHTTPRequestHandler
+
+from .webhook import IDLE_TIMEOUT
+from .webhook import PooledHTTPServer
+
+logger = logging.getLogger('matrigram')
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 9100
+DEFAULT_CONNECTIONS = 2
+METRICS_PATH = '/metrics'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# upper bounds in seconds of the latency buckets, syncs long poll for 30
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+MATRIX_TO_TELEGRAM = 'matrix_to_telegram'
+TELEGRAM_TO_MATRIX = 'telegram_to_matrix'
+# homeserver endpoints held open until there is news, their latency means nothing
+LONG_POLL_ENDPOINTS = ('sync',)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, _escape(value)) for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+    """Monotonic count, per combination of label values.
+
+    Args:
+        name (str): Metric name.
+        documentation (str): Help text of the metric.
+        labels (tuple): Label names.
+    """
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+
+        self._lock = Lock()
+        self._values = {}  # label values -> count
+
+    def inc(self, labels=(), amount=1):
+        labels = tuple(labels)
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def get(self, labels=()):
+        with self._lock:
+            return self._values.get(tuple(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return [(self.name, _format_labels(self.labels, labels), value)
+                for labels, value in values]
+
+
+class Histogram(object):
+    """Distribution of observed values, per combination of label values.
+
+    Args:
+        name (str): Metric name.
+        documentation (str): Help text of the metric.
+        labels (tuple): Label names.
+        buckets (tuple): Increasing upper bounds of the buckets.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+        self._lock = Lock()
+        self._values = {}  # label values -> [bucket counts, sum]
+
+    def observe(self, value, labels=()):
+        labels = tuple(labels)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * len(self.buckets), 0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+
+    @contextmanager
+    def time(self, labels=()):
+        """Observe the seconds the block takes.
+
+        Its outcome, ``'ok'`` or ``'error'`` if it raises, is added as the
+        last label value.
+        """
+        start = time.time()
+        outcome = 'error'
+        try:
+            yield
+            outcome = 'ok'
+        finally:
+            self.observe(time.time() - start, tuple(labels) + (outcome,))
+
+    def count(self, labels=()):
+        with self._lock:
+            entry = self._values.get(tuple(labels))
+            return sum(entry[0]) if entry else 0
+
+    def samples(self):
+        with self._lock:
+            values = sorted((labels, (list(entry[0]), entry[1]))
+                            for labels, entry in self._values.items())
+        samples = []
+        for labels, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                samples.append((self.name + '_bucket',
+                                _format_labels(self.labels, labels, [('le', _format_value(bound))]),
+                                cumulative))
+            label_text = _format_labels(self.labels, labels)
+            samples.append((self.name + '_sum', label_text, total))
+            samples.append((self.name + '_count', label_text, cumulative))
+        return samples
+
+
+class Gauge(object):
+    """Value read when the metrics are collected.
+
+    Args:
+        name (str): Metric name.
+        documentation (str): Help text of the metric.
+        func: Function returning the current value.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, func):
+        self.name = name
+        self.documentation = documentation
+        self.func = func
+
+    def samples(self):
+        return [(self.name, '', self.func())]
+
+
+class BridgeMetrics(object):
+    """Throughput and latency of the bridge, in the Prometheus text format.
+
+    Safe to share between threads.
+    """
+
+    def __init__(self):
+        self._metrics = []
+
+        self.relays = self.add(Counter(
+            'matrigram_relayed_messages_total', 'Messages relayed, by direction and type.',
+            ('direction', 'type')))
+        self.relay_seconds = self.add(Histogram(
+            'matrigram_relay_seconds',
+            'Seconds from receiving a message until it was relayed, by direction and type.',
+            ('direction', 'type')))
+        self.bot_api_seconds = self.add(Histogram(
+            'matrigram_bot_api_request_seconds',
+            'Seconds of Bot API calls, by method and outcome.',
+            ('method', 'outcome')))
+        self.homeserver_seconds = self.add(Histogram(
+            'matrigram_homeserver_request_seconds',
+            'Seconds of homeserver requests, by HTTP method, endpoint and outcome.',
+            ('method', 'endpoint', 'outcome')))
+        self.media_bytes = self.add(Counter(
+            'matrigram_media_bytes_total', 'Bytes of media relayed, by direction.',
+            ('direction',)))
+        self.add(Gauge('matrigram_threads', 'Live threads.', threading.active_count))
+
+    def add(self, metric):
+        """Register a metric.
+
+        Args:
+            metric: A :class:`Counter`, :class:`Histogram` or :class:`Gauge`.
+
+        Returns:
+            The metric.
+        """
+        self._metrics.append(metric)
+        return metric
+
+    def relay(self, direction, kind, func, start=None):
+        """Wrap a call relaying a message, timed until it returns.
+
+        Args:
+            direction (str): ``MATRIX_TO_TELEGRAM`` or ``TELEGRAM_TO_MATRIX``.
+            kind (str): Type of the message, e.g. ``'text'`` or ``'photo'``.
+            func: The call, which may be queued before it runs.
+            start (float): When the message was received, now if None.
+
+        Returns:
+            The wrapped call.
+        """
+        if start is None:
+            start = time.time()
+
+        def relay(*args, **kwargs):
+            result = func(*args, **kwargs)
+            self.relays.inc((direction, kind))
+            self.relay_seconds.observe(time.time() - start, (direction, kind))
+            return result
+
+        return relay
+
+    def watch_homeserver(self, api):
+        """Time the requests of a matrix client api, except long polls.
+
+        Args:
+            api (MatrixHttpApi): The api of a matrix client.
+        """
+        send = api._send
+
+        def timed_send(method, path, *args, **kwargs):
+            endpoint = _endpoint(path)
+            if endpoint in LONG_POLL_ENDPOINTS:
+                return send(method, path, *args, **kwargs)
+            with self.homeserver_seconds.time((method.upper(), endpoint)):
+                return send(method, path, *args, **kwargs)
+
+        api._send = timed_send
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in self._metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.documentation))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                lines.append('{}{} {}'.format(name, labels, _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+def _endpoint(path):
+    """Name the endpoint of a client api path, without ids, e.g. ``rooms/send``."""
+    parts = [part for part in path.split('/') if part]
+    if not parts:
+        return ''
+    if parts[0] == 'rooms' and len(parts) > 2:
+        return 'rooms/' + parts[2]
+    return parts[0]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    timeout = IDLE_TIMEOUT
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        if self.path.split('?')[0] != METRICS_PATH:
+            self.send_error(404)
+            return
+
+        data = self.server.metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, fmt, *args):
+        logger.debug('metrics: ' + fmt, *args)
+
+
+class MetricsServer(object):
+    """Serve metrics to Prometheus at ``/metrics``.
+
+    Args:
+        metrics (BridgeMetrics): The metrics served.
+        host (str): Address to listen on.
+        port (int): Port to listen on, ``0`` for any free port.
+        connections (int): Connections served at the same time.
+    """
+
+    def __init__(self, metrics, host=DEFAULT_HOST, port=DEFAULT_PORT,
+                 connections=DEFAULT_CONNECTIONS):
+        self._server = PooledHTTPServer((host, port), _Handler, connections)
+        self._server.metrics = metrics
+        self._thread = None
+
+    @property
+    def server_address(self):
+        return self._server.server_address
+
+    def start(self):
+        """Serve from a background thread."""
+        self._thread = Thread(target=self._server.serve_forever, name='matrigram-metrics')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def shutdown(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
@@ -0,0 +1,429 @@
+import heapq
+import itertools
+import logging
+import time
+from threading import Condition
+from threading import Lock
+from threading import Thread
+
+from telepot.exception import TelegramError
+
+logger = logging.getLogger('matrigram')
+
+PRIORITY_COMMAND = 0
+PRIORITY_RELAY = 1
+
+DEFAULT_SENDERS = 4
+DEFAULT_GLOBAL_RATE = 30.0
+DEFAULT_CHAT_RATE = 1.0
+DEFAULT_GROUP_RATE = 20 / 60.0
+DEFAULT_BURST = 3
+
+DEFAULT_ACTION_WINDOW = 5.0
+
+PRUNE_INTERVAL = 60
+
+_RUNNABLE = 'runnable'
+_SLEEPING = 'sleeping'
+_BUSY = 'busy'
+# the head of the chat is a reservation not filled yet
+_WAITING = 'waiting'
+
+
+class TokenBucket(object):
+    """Token bucket rate limiter.
+
+    Args:
+        rate (float): Tokens added per second.
+        capacity (float): Maximal number of tokens, i.e. allowed burst.
+        now (float): Current time.
+    """
+    __slots__ = ('rate', 'capacity', 'tokens', 'stamp', 'blocked_until')
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = now
+        self.blocked_until = 0
+
+    def _refill(self, now):
+        if now > self.stamp:
+            self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+
+    def delay(self, now):
+        """Return seconds until a token is available, 0 if one is available now."""
+        self._refill(now)
+        wait = 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.blocked_until - now)
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def block(self, until):
+        """Don't hand out tokens before `until`."""
+        self.blocked_until = max(self.blocked_until, until)
+
+    def full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity and self.blocked_until <= now
+
+
+class _ChatQueue(object):
+    __slots__ = ('chat_id', 'items', 'bucket', 'state')
+
+    def __init__(self, chat_id, bucket):
+        self.chat_id = chat_id
+        self.items = []  # heap of (priority, seq, func, args, kwargs)
+        self.bucket = bucket
+        self.state = None
+
+
+class Reservation(object):
+    """A place in the queue of a chat, for a call filled in later.
+
+    Created by :meth:`SendScheduler.reserve`.
+    """
+
+    def __init__(self, scheduler, chat_id):
+        self.scheduler = scheduler
+        self.chat_id = chat_id
+        self.filled = False
+        self.func = None
+        self.args = ()
+        self.kwargs = {}
+
+    def fill(self, func, args=(), kwargs=None):
+        """Set the call, which is then sent in the place reserved.
+
+        Args:
+            func: The Bot API call.
+            args (tuple): Positional arguments of the call.
+            kwargs (dict): Keyword arguments of the call.
+        """
+        self.scheduler._fill(self, func, args, kwargs or {})
+
+    def cancel(self):
+        """Give up the place, letting the calls after it go."""
+        self.scheduler._cancel(self)
+
+    def __call__(self):
+        return self.func(*self.args, **self.kwargs)
+
+
+class SendScheduler(object):
+    """Rate limited scheduler for outgoing Bot API calls.
+
+    Calls are queued per chat and sent by a few sender threads, at most
+    `chat_rate` per second per private chat, `group_rate` per group chat and
+    `global_rate` overall. Within a chat, calls with a lower priority value
+    go first, and calls of the same priority keep their order. A call not
+    known yet can keep its place with :meth:`reserve`. When telegram
+    answers with 429, the call is retried after the given ``retry_after``.
+
+    Args:
+        senders (int): Number of sender threads.
+        global_rate (float): Calls per second over all chats.
+        chat_rate (float): Calls per second to a private chat.
+        group_rate (float): Calls per second to a group chat.
+        burst (int): Calls a chat may burst above its rate.
+    """
+
+    def __init__(self, senders=DEFAULT_SENDERS, global_rate=DEFAULT_GLOBAL_RATE,
+                 chat_rate=DEFAULT_CHAT_RATE, group_rate=DEFAULT_GROUP_RATE,
+                 burst=DEFAULT_BURST):
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.burst = burst
+
+        self._cond = Condition()
+        self._seq = itertools.count()
+        self._chats = {}
+        self._runnable = []  # heap of (priority, seq, chat_id) of chats' head items
+        self._sleeping = []  # heap of (wake time, chat_id)
+        self._global = TokenBucket(global_rate, global_rate, time.time())
+        self._last_prune = time.time()
+        self._running = True
+        self._counters = {
+            'queued': 0,
+            'throttled': 0,
+            'retried': 0,
+            'sent': 0,
+            'failed': 0,
+        }
+
+        self._threads = []
+        for i in range(senders):
+            thread = Thread(target=self._work, name='matrigram-sender-{}'.format(i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, chat_id, func, args=(), kwargs=None, priority=PRIORITY_RELAY):
+        """Queue `func(*args, **kwargs)` as a call to `chat_id`.
+
+        Args:
+            chat_id: Telegram chat id the call is sent to.
+            func: The Bot API call.
+            args (tuple): Positional arguments of the call.
+            kwargs (dict): Keyword arguments of the call.
+            priority (int): ``PRIORITY_COMMAND`` or ``PRIORITY_RELAY``.
+        """
+        now = time.time()
+        with self._cond:
+            if not self._running:
+                raise RuntimeError('scheduler is shut down')
+
+            chat = self._chats.get(chat_id)
+            if chat is None:
+                rate = self.group_rate if chat_id < 0 else self.chat_rate
+                chat = self._chats[chat_id] = _ChatQueue(chat_id,
+                                                         TokenBucket(rate, self.burst, now))
+            self._push(chat, (priority, next(self._seq), func, args, kwargs or {}), now)
+
+    def reserve(self, chat_id, priority=PRIORITY_RELAY):
+        """Keep a place in the queue of a chat for a call filled in later.
+
+        Calls after it to the same chat wait until the reservation is filled
+        or cancelled, so they keep their order with it.
+
+        Args:
+            chat_id: Telegram chat id the call is sent to.
+            priority (int): ``PRIORITY_COMMAND`` or ``PRIORITY_RELAY``.
+
+        Returns:
+            Reservation: The place, to be filled or cancelled.
+        """
+        reservation = Reservation(self, chat_id)
+        self.submit(chat_id, reservation, priority=priority)
+        return reservation
+
+    def _fill(self, reservation, func, args, kwargs):
+        with self._cond:
+            reservation.func = func
+            reservation.args = args
+            reservation.kwargs = kwargs
+            reservation.filled = True
+            chat = self._chats[reservation.chat_id]
+            if chat.state == _WAITING:
+                self._schedule(chat, time.time())
+
+    def _cancel(self, reservation):
+        with self._cond:
+            chat = self._chats[reservation.chat_id]
+            chat.items = [item for item in chat.items if item[2] is not reservation]
+            heapq.heapify(chat.items)
+            self._counters['queued'] -= 1
+            if chat.state == _WAITING:
+                chat.state = None
+                if chat.items:
+                    self._schedule(chat, time.time())
+            self._cond.notify_all()
+
+    def _push(self, chat, item, now):
+        heapq.heappush(chat.items, item)
+        self._counters['queued'] += 1
+
+        if chat.state is None or (chat.state == _WAITING and chat.items[0] is item):
+            self._schedule(chat, now)
+        elif chat.state == _RUNNABLE and chat.items[0] is item:
+            # new head of the chat, the old runnable entry is now stale
+            heapq.heappush(self._runnable, (item[0], item[1], chat.chat_id))
+            self._cond.notify()
+
+    def _schedule(self, chat, now):
+        """Put a chat with pending items on the runnable or sleeping heap."""
+        head = chat.items[0][2]
+        if isinstance(head, Reservation) and not head.filled:
+            chat.state = _WAITING
+            return
+
+        delay = chat.bucket.delay(now)
+        if delay <= 0:
+            chat.state = _RUNNABLE
+            head = chat.items[0]
+            heapq.heappush(self._runnable, (head[0], head[1], chat.chat_id))
+        else:
+            chat.state = _SLEEPING
+            heapq.heappush(self._sleeping, (now + delay, chat.chat_id))
+            self._counters['throttled'] += 1
+        self._cond.notify()
+
+    def _next(self):
+        """Wait for the next call allowed to be sent.
+
+        Returns:
+            tuple: (chat queue, item), or None when shut down and drained.
+        """
+        with self._cond:
+            while True:
+                now = time.time()
+                while self._sleeping and self._sleeping[0][0] <= now:
+                    _, chat_id = heapq.heappop(self._sleeping)
+                    self._schedule(self._chats[chat_id], now)
+
+                while self._runnable and not self._valid(self._runnable[0]):
+                    heapq.heappop(self._runnable)
+
+                timeout = self._sleeping[0][0] - now if self._sleeping else None
+                if self._runnable:
+                    global_delay = self._global.delay(now)
+                    if global_delay <= 0:
+                        _, _, chat_id = heapq.heappop(self._runnable)
+                        chat = self._chats[chat_id]
+                        chat.state = _BUSY
+                        self._global.take(now)
+                        chat.bucket.take(now)
+                        self._counters['queued'] -= 1
+                        return chat, heapq.heappop(chat.items)
+                    timeout = global_delay if timeout is None else min(timeout, global_delay)
+                elif not self._running and not self._counters['queued']:
+                    self._cond.notify_all()
+                    return None
+
+                self._prune(now)
+                self._cond.wait(timeout)
+
+    def _valid(self, entry):
+        priority, seq, chat_id = entry
+        chat = self._chats.get(chat_id)
+        return (chat is not None and chat.state == _RUNNABLE and
+                chat.items[0][0] == priority and chat.items[0][1] == seq)
+
+    def _prune(self, now):
+        """Forget idle chats whose bucket is full anyway."""
+        if now - self._last_prune < PRUNE_INTERVAL:
+            return
+        self._last_prune = now
+        for chat_id, chat in list(self._chats.items()):
+            if chat.state is None and chat.bucket.full(now):
+                del self._chats[chat_id]
+
+    def _work(self):
+        while True:
+            job = self._next()
+            if job is None:
+                return
+            chat, item = job
+            func, args, kwargs = item[2:]
+
+            outcome = 'sent'
+            retry_after = None
+            try:
+                func(*args, **kwargs)
+            except TelegramError as e:
+                outcome = 'failed'
+                if e.error_code != 429:
+                    logger.exception('sending to %s failed', chat.chat_id)
+                else:
+                    outcome = 'retried'
+                    retry_after = e.json.get('parameters', {}).get('retry_after', 1)
+                    logger.warning('flood limit of %s, retry after %ss',
+                                   chat.chat_id, retry_after)
+            except Exception:
+                outcome = 'failed'
+                logger.exception('sending to %s failed', chat.chat_id)
+
+            now = time.time()
+            with self._cond:
+                self._counters[outcome] += 1
+                if retry_after is not None:
+                    chat.bucket.block(now + retry_after)
+                    heapq.heappush(chat.items, item)
+                    self._counters['queued'] += 1
+
+                chat.state = None
+                if chat.items:
+                    self._schedule(chat, now)
+                elif not self._running:
+                    self._cond.notify_all()
+
+    def stats(self):
+        """Return the scheduler counters.
+
+        Returns:
+            dict: Currently queued calls, and the total of throttled chat
+            wake ups, retried, sent and failed calls.
+        """
+        with self._cond:
+            return dict(self._counters)
+
+    def shutdown(self, wait=True):
+        """Stop accepting calls and let the senders drain the queues.
+
+        Args:
+            wait (bool): Block until all senders are done.
+        """
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+
+class ChatActionThrottle(object):
+    """Deduplicate chat actions.
+
+    Telegram shows a chat action for about 5 seconds, so sending the same
+    action to the same chat again within that window only costs a Bot API
+    call. The throttle lets the first action of a window through and drops
+    the repeats, except refreshes meant to keep an action displayed.
+
+    Args:
+        window (float): Seconds an action is considered displayed.
+        enabled (bool): If False, all chat actions are dropped.
+    """
+
+    def __init__(self, window=DEFAULT_ACTION_WINDOW, enabled=True):
+        self.window = window
+        self.enabled = enabled
+
+        self._lock = Lock()
+        self._last = {}  # chat_id -> (action, time sent)
+        self._last_prune = time.time()
+        self._counters = {
+            'allowed': 0,
+            'suppressed': 0,
+        }
+
+    def allow(self, chat_id, action, refresh=False):
+        """Check whether an action should be sent, and record it if so.
+
+        Args:
+            chat_id: Telegram chat id.
+            action (str): Chat action, e.g. ``'typing'``.
+            refresh (bool): Whether the action renews one about to expire,
+                which is sent even within the window.
+
+        Returns:
+            bool: True if the action should be sent.
+        """
+        now = time.time()
+        with self._lock:
+            last = self._last.get(chat_id)
+            if not self.enabled or (not refresh and last is not None and last[0] == action and
+                                    now - last[1] < self.window):
+                self._counters['suppressed'] += 1
+                return False
+
+            self._last[chat_id] = (action, now)
+            self._counters['allowed'] += 1
+            self._prune(now)
+            return True
+
+    def _prune(self, now):
+        if now - self._last_prune < PRUNE_INTERVAL:
+            return
+        self._last_prune = now
+        for chat_id, (_, stamp) in list(self._last.items()):
+            if now - stamp >= self.window:
+                del self._last[chat_id]
+
+    def stats(self):
+        """Return the number of allowed and suppressed actions."""
+        with self._lock:
+            return dict(self._counters)
@@ -0,0 +1,57 @@
+import re
+
+
+class Router(object):
+    """Dispatch text to callbacks by its leading token.
+
+    Each route is registered under a command, the first whitespace separated
+    token of the texts it handles (e.g. ``/login``), so routing a text costs
+    one dict lookup plus matching the few patterns of its command. Texts not
+    starting with `command_prefix` skip the lookup and go straight to the
+    default routes, registered with command None.
+
+    Args:
+        routes (list): (command, pattern, callback) tuples, tried in order
+            within the same command.
+        command_prefix (str): Prefix of texts routed by command.
+    """
+
+    def __init__(self, routes, command_prefix=''):
+        self.command_prefix = command_prefix
+        self._routes = []
+        self._commands = {}
+        self._default = []
+
+        for command, pattern, callback in routes:
+            route = (re.compile(pattern), callback)
+            self._routes.append(route)
+            if command is None:
+                self._default.append(route)
+            else:
+                self._commands.setdefault(command, []).append(route)
+
+    def routes(self):
+        """Return all (compiled pattern, callback) pairs in registration order."""
+        return list(self._routes)
+
+    def match(self, text):
+        """Find the route handling `text`.
+
+        Args:
+            text (str): Text to be routed.
+
+        Returns:
+            tuple: (callback, match object), or (None, None) if no route matches.
+        """
+        if text.startswith(self.command_prefix):
+            tokens = text.split(None, 1)
+            routes = self._commands.get(tokens[0] if tokens else text, ())
+        else:
+            routes = self._default
+
+        for pattern, callback in routes:
+            match = pattern.match(text)
+            if match:
+                return callback, match
+
+        return None, None
@@ -0,0 +1,159 @@
+from threading import Lock
+
+DEFAULT_SHARDS = 16
+
+
+class Session(object):
+    """State of a single logged in telegram chat.
+
+    Attributes:
+        chat_id: Telegram chat id.
+        client (MatrigramClient): The matrix client of the chat.
+        lock (Lock): Guards the mutable state of this session only.
+        saved_at (float): When the session was last saved, for restarts.
+    """
+    __slots__ = ('chat_id', 'client', 'lock', 'saved_at')
+
+    def __init__(self, chat_id, client):
+        self.chat_id = chat_id
+        self.client = client
+        self.lock = Lock()
+        self.saved_at = 0
+
+    def __repr__(self):
+        return '<Session chat_id={} client={}>'.format(self.chat_id, self.client)
+
+
+class _Shard(object):
+    __slots__ = ('lock', 'items')
+
+    def __init__(self):
+        self.lock = Lock()
+        self.items = {}
+
+
+class SessionRegistry(object):
+    """Thread safe registry of logged in chats.
+
+    Keeps a bidirectional index between telegram chat ids and matrigram
+    clients, so both directions are a single dict lookup. Each index is split
+    into shards with their own lock, so handlers of different chats rarely
+    contend on the same lock.
+
+    Args:
+        shards (int): Number of shards for each index.
+    """
+
+    def __init__(self, shards=DEFAULT_SHARDS):
+        self._by_chat = [_Shard() for _ in range(shards)]
+        self._by_client = [_Shard() for _ in range(shards)]
+
+    def _chat_shard(self, chat_id):
+        return self._by_chat[hash(chat_id) % len(self._by_chat)]
+
+    def _client_shard(self, client):
+        return self._by_client[hash(client) % len(self._by_client)]
+
+    def add(self, chat_id, client):
+        """Register a logged in chat, replacing any previous session.
+
+        Args:
+            chat_id: Telegram chat id.
+            client (MatrigramClient): The client of the chat.
+
+        Returns:
+            Session: The new session.
+        """
+        session = Session(chat_id, client)
+        shard = self._chat_shard(chat_id)
+        with shard.lock:
+            old = shard.items.get(chat_id)
+            shard.items[chat_id] = session
+
+        if old is not None and old.client is not None:
+            self._unindex_client(old.client)
+
+        client_shard = self._client_shard(client)
+        with client_shard.lock:
+            client_shard.items[client] = chat_id
+
+        return session
+
+    def remove(self, chat_id):
+        """Unregister a chat.
+
+        Args:
+            chat_id: Telegram chat id.
+
+        Returns:
+            Session: The removed session, or None if the chat was not registered.
+        """
+        shard = self._chat_shard(chat_id)
+        with shard.lock:
+            session = shard.items.pop(chat_id, None)
+
+        if session is not None and session.client is not None:
+            self._unindex_client(session.client)
+
+        return session
+
+    def _unindex_client(self, client):
+        client_shard = self._client_shard(client)
+        with client_shard.lock:
+            client_shard.items.pop(client, None)
+
+    def get(self, chat_id):
+        """Get the session of a chat.
+
+        Args:
+            chat_id: Telegram chat id.
+
+        Returns:
+            Session: The session, or None if the chat is not logged in.
+        """
+        shard = self._chat_shard(chat_id)
+        with shard.lock:
+            return shard.items.get(chat_id)
+
+    def get_client(self, chat_id):
+        """Get the client of a chat.
+
+        Args:
+            chat_id: Telegram chat id.
+
+        Returns:
+            MatrigramClient: The client, or None if the chat is not logged in.
+        """
+        session = self.get(chat_id)
+        return session.client if session is not None else None
+
+    def get_chat_id(self, client):
+        """Get the chat id of a client.
+
+        Args:
+            client (MatrigramClient): The client to be queried.
+
+        Returns:
+            The chat id, or None if the client is not registered.
+        """
+        shard = self._client_shard(client)
+        with shard.lock:
+            return shard.items.get(client)
+
+    def sessions(self):
+        """Return a snapshot list of all sessions."""
+        sessions = []
+        for shard in self._by_chat:
+            with shard.lock:
+                sessions.extend(shard.items.values())
+        return sessions
+
+    def __contains__(self, chat_id):
+        return self.get(chat_id) is not None
+
+    def __len__(self):
+        count = 0
+        for shard in self._by_chat:
+            with shard.lock:
+                count += len(shard.items)
+        return count
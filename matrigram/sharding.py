@@ -0,0 +1,246 @@
+import bisect
+import hashlib
+import logging
+import multiprocessing
+import time
+from threading import Event
+from threading import Lock
+from threading import Thread
+
+try:
+    from Queue import Empty
+except ImportError:
+    from queue import Empty
+
+from .webhook import extract_message
+
+logger = logging.getLogger('matrigram')
+
+DEFAULT_REPLICAS = 100
+DEFAULT_CHECK_INTERVAL = 1.0
+
+try:
+    # restarts happen from a thread of the front process, and a forked child
+    # would inherit locks other threads hold, e.g. the one of logging
+    _context = multiprocessing.get_context('spawn')
+except AttributeError:
+    # python 2 can only fork, restarted shards there may still inherit a held lock
+    _context = multiprocessing
+
+
+def _hash(key):
+    return int(hashlib.md5(str(key).encode('utf-8')).hexdigest()[:16], 16)
+
+
+def update_chat_id(update):
+    """Get the telegram chat an update belongs to.
+
+    Args:
+        update (dict): A Bot API update.
+
+    Returns:
+        The chat id, or None if the update belongs to no chat.
+    """
+    msg = extract_message(update)
+    if msg is None:
+        return None
+    if 'chat' in msg:
+        return msg['chat']['id']
+    if 'message' in msg:
+        # callback queries carry the message their keyboard is attached to
+        return msg['message']['chat']['id']
+    return msg.get('from', {}).get('id')
+
+
+class HashRing(object):
+    """Consistent hashing of keys to nodes.
+
+    Each node is placed on the ring `replicas` times, so keys spread evenly
+    and adding or removing a node only moves the keys of that node.
+
+    Args:
+        nodes: Initial nodes.
+        replicas (int): Points of each node on the ring.
+    """
+
+    def __init__(self, nodes=(), replicas=DEFAULT_REPLICAS):
+        self.replicas = replicas
+        self._points = []  # sorted hashes
+        self._nodes = {}  # hash -> node
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        for i in range(self.replicas):
+            point = _hash('{}-{}'.format(node, i))
+            if point not in self._nodes:
+                bisect.insort(self._points, point)
+            self._nodes[point] = node
+
+    def remove(self, node):
+        for i in range(self.replicas):
+            point = _hash('{}-{}'.format(node, i))
+            if self._nodes.get(point) == node:
+                del self._nodes[point]
+                self._points.remove(point)
+
+    def node_for(self, key):
+        """Get the node owning `key`.
+
+        Args:
+            key: Any key, e.g. a chat id.
+
+        Returns:
+            The node, or None if the ring is empty.
+        """
+        if not self._points:
+            return None
+        i = bisect.bisect(self._points, _hash(key)) % len(self._points)
+        return self._nodes[self._points[i]]
+
+
+def _run_shard(make_handler, shard, updates):
+    """Main function of a shard process."""
+    handler = make_handler(shard)
+    while True:
+        update = updates.get()
+        if update is None:
+            return
+        try:
+            handler(update)
+        except Exception:
+            logger.exception('shard %s failed handling update %s',
+                             shard, update.get('update_id'))
+
+
+class ShardSupervisor(object):
+    """Spread telegram updates over worker processes by chat.
+
+    Each of `processes` shards runs in its own process and owns the chats
+    hashed to it, so updates of a chat always reach the same process.
+    :meth:`dispatch` runs in the front process and hands an update to the
+    queue of its shard. A shard whose process dies is restarted on a new
+    queue, which gets the updates still waiting in the old one unless the
+    process died while reading it. The update the shard was handling when
+    it died is lost. Other shards are unaffected.
+
+    On python 3 processes are started fresh rather than forked from the
+    front process, so `make_handler` has to set up whatever the shard needs,
+    e.g. logging. Python 2 can only fork, so a shard restarted there may
+    inherit a lock another thread of the front process held, e.g. the one
+    of logging, and hang.
+
+    Args:
+        make_handler: Picklable callable taking a shard number, called in the
+            shard's process and returning a callable handling an update.
+        processes (int): Number of shards.
+        replicas (int): Points of each shard on the hash ring.
+        check_interval (float): Seconds between checks of the processes.
+    """
+
+    def __init__(self, make_handler, processes, replicas=DEFAULT_REPLICAS,
+                 check_interval=DEFAULT_CHECK_INTERVAL):
+        self.make_handler = make_handler
+        self.check_interval = check_interval
+        self.ring = HashRing(range(processes), replicas)
+
+        self._lock = Lock()
+        self._queues = [_context.Queue() for _ in range(processes)]
+        self._processes = [None] * processes
+        self._restarts = 0
+        self._stopped = Event()
+        self._monitor = None
+
+    def start(self):
+        for shard in range(len(self._processes)):
+            self._spawn(shard)
+        self._monitor = Thread(target=self._watch, name='matrigram-supervisor')
+        self._monitor.daemon = True
+        self._monitor.start()
+
+    def _spawn(self, shard):
+        process = _context.Process(target=_run_shard,
+                                   args=(self.make_handler, shard, self._queues[shard]),
+                                   name='matrigram-shard-{}'.format(shard))
+        process.daemon = True
+        process.start()
+        with self._lock:
+            self._processes[shard] = process
+
+    def _watch(self):
+        while not self._stopped.wait(self.check_interval):
+            with self._lock:
+                dead = [shard for shard, process in enumerate(self._processes)
+                        if not process.is_alive()]
+                for shard in dead:
+                    logger.error('shard %s exited with %s, restarting',
+                                 shard, self._processes[shard].exitcode)
+                    self._restarts += 1
+                    self._renew_queue(shard)
+
+            # starting a process takes a while, meanwhile updates keep being dispatched
+            for shard in dead:
+                if not self._stopped.is_set():
+                    self._spawn(shard)
+
+    def _renew_queue(self, shard):
+        """Replace the queue of a dead shard, moving over its waiting updates.
+
+        A process killed while reading a queue keeps holding its read lock,
+        leaving the queue unusable, so the waiting updates are only taken if
+        the lock is free.
+        """
+        old = self._queues[shard]
+        self._queues[shard] = _context.Queue()
+        moved = 0
+        try:
+            while True:
+                self._queues[shard].put(old.get(False))
+                moved += 1
+        except Empty:
+            pass
+        logger.info('moved %s updates to the new queue of shard %s', moved, shard)
+        old.close()
+        old.cancel_join_thread()
+
+    def shard_for(self, chat_id):
+        return self.ring.node_for(chat_id)
+
+    def dispatch(self, update):
+        """Hand an update to the shard owning its chat.
+
+        Updates belonging to no chat go to the first shard.
+
+        Args:
+            update (dict): A Bot API update.
+        """
+        chat_id = update_chat_id(update)
+        shard = self.shard_for(chat_id) if chat_id is not None else 0
+        with self._lock:
+            self._queues[shard].put(update)
+
+    def stats(self):
+        """Return the supervisor counters.
+
+        Returns:
+            dict: Number of shards, shards alive and restarts so far.
+        """
+        with self._lock:
+            return {
+                'shards': len(self._processes),
+                'alive': sum(1 for p in self._processes if p is not None and p.is_alive()),
+                'restarts': self._restarts,
+            }
+
+    def shutdown(self, timeout=None):
+        """Stop the shards once they handled their pending updates."""
+        self._stopped.set()
+        if self._monitor is not None:
+            self._monitor.join()
+        for updates in self._queues:
+            updates.put(None)
+
+        deadline = time.time() + timeout if timeout is not None else None
+        for process in self._processes:
+            left = max(deadline - time.time(), 0) if deadline is not None else None
+            process.join(left)
@@ -0,0 +1,139 @@
+import hashlib
+import tempfile
+import uuid
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+DEFAULT_SPOOL_THRESHOLD = 1024 * 1024
+
+
+class HashingReader(object):
+    """File-like wrapper computing the md5 of what is read through it.
+
+    Args:
+        source: Readable file-like object.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self._md5 = hashlib.md5()
+
+    def read(self, size=-1):
+        data = self.source.read(size)
+        self._md5.update(data)
+        return data
+
+    def hexdigest(self):
+        return self._md5.hexdigest()
+
+
+class SizedStream(object):
+    """Stream of known size, sent in chunks as a request body.
+
+    Args:
+        source: Readable file-like object.
+        size (int): Number of bytes `source` holds.
+        chunk_size (int): Bytes read from `source` at a time when iterated.
+    """
+
+    def __init__(self, source, size, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.source = source
+        self.size = size
+        self.chunk_size = chunk_size
+
+    def __len__(self):
+        return self.size
+
+    def read(self, size=-1):
+        return self.source.read(size)
+
+    def __iter__(self):
+        return iter(lambda: self.source.read(self.chunk_size), b'')
+
+
+class MultipartStream(object):
+    """Streaming ``multipart/form-data`` body holding a single file.
+
+    The file is read from `source` in chunks while the body is sent, so
+    only a chunk is held in memory at a time. The size of the file must be
+    known in advance, for the body to have a Content-Length.
+
+    Args:
+        field (str): Form field name of the file.
+        name (str): File name.
+        mimetype (str): Content type of the file.
+        source: Readable file-like object positioned at the file's start.
+        size (int): Size of the file in bytes.
+        chunk_size (int): Bytes read from `source` at a time when iterated.
+    """
+
+    def __init__(self, field, name, mimetype, source, size, chunk_size=DEFAULT_CHUNK_SIZE):
+        boundary = uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary={}'.format(boundary)
+        self.chunk_size = chunk_size
+
+        self._head = ('--{}\r\n'
+                      'Content-Disposition: form-data; name="{}"; filename="{}"\r\n'
+                      'Content-Type: {}\r\n\r\n').format(boundary, field, name,
+                                                         mimetype).encode('utf-8')
+        self._tail = '\r\n--{}--\r\n'.format(boundary).encode('utf-8')
+        self._source = source
+        self._size = size
+        self._left = size  # bytes of the file not read yet
+        self._parts = [self._head, None, self._tail]
+
+    def __len__(self):
+        return len(self._head) + self._size + len(self._tail)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return b''.join(iter(lambda: self.read(self.chunk_size), b''))
+
+        while self._parts:
+            part = self._parts[0]
+            if part is None:
+                data = self._source.read(min(size, self._left)) if self._left else b''
+                if not data:
+                    if self._left:
+                        raise IOError('media ended {} bytes early'.format(self._left))
+                    self._parts.pop(0)
+                    continue
+                self._left -= len(data)
+                return data
+
+            if not part:
+                self._parts.pop(0)
+                continue
+            self._parts[0] = part[size:]
+            return part[:size]
+
+        return b''
+
+    def __iter__(self):
+        return iter(lambda: self.read(self.chunk_size), b'')
+
+
+def spool(source, threshold=DEFAULT_SPOOL_THRESHOLD, chunk_size=DEFAULT_CHUNK_SIZE, dir=None):
+    """Copy a stream of unknown size to a temporary file.
+
+    The copy stays in memory up to `threshold` bytes and moves to disk
+    beyond that.
+
+    Args:
+        source: Readable file-like object.
+        threshold (int): Maximal bytes held in memory.
+        chunk_size (int): Bytes read at a time.
+        dir (str): Directory of the file once on disk.
+
+    Returns:
+        tuple: (file object positioned at its start, size, md5 hex digest).
+        The caller should close the file.
+    """
+    spooled = tempfile.SpooledTemporaryFile(max_size=threshold, dir=dir)
+    reader = HashingReader(source)
+    size = 0
+    for chunk in iter(lambda: reader.read(chunk_size), b''):
+        spooled.write(chunk)
+        size += len(chunk)
+    spooled.seek(0)
+
+    return spooled, size, reader.hexdigest()
@@ -0,0 +1,84 @@
+import logging
+from threading import Lock
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger('matrigram')
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 60
+
+
+class HttpPool(object):
+    """Shared keep-alive HTTP session.
+
+    Wraps a :class:`requests.Session` whose connections are kept open and
+    reused across requests (and threads), so repeated requests to the same
+    host don't pay for a new TCP and TLS handshake each time.
+
+    Args:
+        pool_size (int): Connections kept open per host.
+        connect_timeout (float): Seconds to wait for a connection.
+        read_timeout (float): Seconds to wait for the server between bytes.
+        retries (int): Retries of failed connection attempts.
+    """
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=DEFAULT_READ_TIMEOUT, retries=0):
+        self.timeout = (connect_timeout, read_timeout)
+
+        self._adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                                    max_retries=retries)
+        self.session = requests.Session()
+        self.session.mount('http://', self._adapter)
+        self.session.mount('https://', self._adapter)
+
+        self._lock = Lock()
+        self._requests = 0
+
+    def request(self, method, url, **kwargs):
+        """Send a request on the pooled session.
+
+        Takes the arguments of :meth:`requests.Session.request`, with the
+        pool timeouts as default ``timeout``.
+
+        Returns:
+            requests.Response: The response.
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        with self._lock:
+            self._requests += 1
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def stats(self):
+        """Return connection reuse statistics.
+
+        Returns:
+            dict: Requests sent, connections opened by the pools currently
+            alive, and requests that reused an open connection.
+        """
+        pools = self._adapter.poolmanager.pools
+        connections = 0
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                connections += pool.num_connections
+        with self._lock:
+            requests_sent = self._requests
+
+        return {
+            'requests': requests_sent,
+            'connections': connections,
+            'reused': max(requests_sent - connections, 0),
+        }
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,134 @@
+import heapq
+import itertools
+import logging
+import time
+from threading import Condition
+from threading import Thread
+
+logger = logging.getLogger('matrigram')
+
+DEFAULT_INTERVAL = 5.0
+DEFAULT_STOP_DELAY = 1.0
+
+_REFRESH = 'refresh'
+_STOP = 'stop'
+
+
+class _Typing(object):
+    __slots__ = ('refresh_at', 'stop_at')
+
+    def __init__(self, refresh_at):
+        self.refresh_at = refresh_at
+        self.stop_at = None
+
+
+class TypingScheduler(object):
+    """Keep typing indicators of many chats alive from a single thread.
+
+    While a chat is typing, `send_typing(chat_id)` is called every
+    `interval` seconds. Stopping is delayed by `stop_delay` seconds, so
+    typing notifications flapping between start and stop don't cause extra
+    calls. :meth:`start` and :meth:`stop` never block.
+
+    Args:
+        send_typing: Callable sending a typing action to a chat id.
+        interval (float): Seconds between typing actions of a chat.
+        stop_delay (float): Seconds to wait before actually stopping.
+    """
+
+    def __init__(self, send_typing, interval=DEFAULT_INTERVAL, stop_delay=DEFAULT_STOP_DELAY):
+        self.send_typing = send_typing
+        self.interval = interval
+        self.stop_delay = stop_delay
+
+        self._cond = Condition()
+        self._seq = itertools.count()
+        self._timers = []  # heap of (due time, seq, kind, chat_id)
+        self._typing = {}  # chat_id -> _Typing
+        self._running = True
+
+        self._thread = Thread(target=self._run, name='matrigram-typing')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def start(self, chat_id):
+        """Start showing a typing indicator in a chat.
+
+        Args:
+            chat_id: Telegram chat id.
+        """
+        with self._cond:
+            typing = self._typing.get(chat_id)
+            if typing is not None:
+                typing.stop_at = None
+                return
+
+            now = time.time()
+            self._typing[chat_id] = _Typing(now)
+            self._push(now, _REFRESH, chat_id)
+
+    def stop(self, chat_id):
+        """Stop showing a typing indicator in a chat, after `stop_delay`.
+
+        Args:
+            chat_id: Telegram chat id.
+        """
+        with self._cond:
+            typing = self._typing.get(chat_id)
+            if typing is None or typing.stop_at is not None:
+                return
+
+            typing.stop_at = time.time() + self.stop_delay
+            self._push(typing.stop_at, _STOP, chat_id)
+
+    def is_typing(self, chat_id):
+        with self._cond:
+            return chat_id in self._typing
+
+    def _push(self, due, kind, chat_id):
+        heapq.heappush(self._timers, (due, next(self._seq), kind, chat_id))
+        self._cond.notify()
+
+    def _next_due(self):
+        """Wait for the next chat due for a typing action.
+
+        Returns:
+            The chat id, or None when shut down.
+        """
+        with self._cond:
+            while self._running:
+                now = time.time()
+                while self._timers and self._timers[0][0] <= now:
+                    due, _, kind, chat_id = heapq.heappop(self._timers)
+                    typing = self._typing.get(chat_id)
+                    if typing is None:
+                        continue
+
+                    if kind == _STOP and typing.stop_at == due:
+                        del self._typing[chat_id]
+                    elif kind == _REFRESH and typing.refresh_at == due:
+                        typing.refresh_at = now + self.interval
+                        self._push(typing.refresh_at, _REFRESH, chat_id)
+                        return chat_id
+
+                timeout = self._timers[0][0] - now if self._timers else None
+                self._cond.wait(timeout)
+
+        return None
+
+    def _run(self):
+        while True:
+            chat_id = self._next_due()
+            if chat_id is None:
+                return
+
+            try:
+                self.send_typing(chat_id)
+            except Exception:
+                logger.exception('typing notification to %s failed', chat_id)
+
+    def shutdown(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        self._thread.join()
@@ -0,0 +1,227 @@
+import hmac
+import json
+import logging
+from threading import Thread
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler
+    from BaseHTTPServer import HTTPServer
+    from Queue import Queue
+except ImportError:
+    from http.server import BaseHTTPRequestHandler
+    from http.server import HTTPServer
+    from queue import Queue
+
+logger = logging.getLogger('matrigram')
+
+DEFAULT_HOST = '0.0.0.0'
+DEFAULT_PORT = 8443
+# telegram's default for the connections it opens to a webhook
+DEFAULT_CONNECTIONS = 40
+# seconds an idle keep-alive connection holds a thread
+IDLE_TIMEOUT = 60
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+# keys of an update holding the message, in the order telepot looks them up
+UPDATE_KINDS = (
+    'message',
+    'edited_message',
+    'channel_post',
+    'edited_channel_post',
+    'callback_query',
+    'inline_query',
+    'chosen_inline_result',
+)
+
+
+def extract_message(update):
+    """Get the message carried by an update.
+
+    Args:
+        update (dict): A Bot API update.
+
+    Returns:
+        dict: The message, or None if the update has no known message.
+    """
+    for kind in UPDATE_KINDS:
+        if kind in update:
+            return update[kind]
+    return None
+
+
+class PooledHTTPServer(HTTPServer):
+    """HTTP server handling connections on a fixed number of threads.
+
+    Args:
+        address (tuple): (host, port) to listen on.
+        handler: Request handler class.
+        connections (int): Connections served at the same time.
+    """
+    allow_reuse_address = True
+
+    def __init__(self, address, handler, connections):
+        HTTPServer.__init__(self, address, handler)
+        self._connections = Queue()
+        self._threads = []
+        for i in range(connections):
+            thread = Thread(target=self._work, name='matrigram-webhook-{}'.format(i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def process_request(self, request, client_address):
+        self._connections.put((request, client_address))
+
+    def _work(self):
+        while True:
+            request, client_address = self._connections.get()
+            if request is None:
+                return
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        # threads still serving a keep-alive connection exit once it closes
+        for _ in self._threads:
+            self._connections.put((None, None))
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    timeout = IDLE_TIMEOUT
+
+    def do_POST(self):
+        webhook = self.server.webhook
+        if not webhook.authorized(self.path, self.headers.get(SECRET_TOKEN_HEADER)):
+            logger.warning('rejected webhook request to %s from %s',
+                           self.path, self.client_address[0])
+            self._respond(403)
+            return
+
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            update = json.loads(self.rfile.read(length).decode('utf-8'))
+        except ValueError:
+            self._respond(400)
+            return
+
+        # telegram resends updates not acknowledged with a 2xx, so a failing
+        # handler is logged rather than reported
+        try:
+            webhook.on_update(update)
+        except Exception:
+            logger.exception('handling update %s failed', update.get('update_id'))
+        self._respond(200)
+
+    def _respond(self, code):
+        self.send_response(code)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, fmt, *args):
+        logger.debug('webhook: ' + fmt, *args)
+
+
+class WebhookServer(object):
+    """Local HTTP server receiving updates pushed by the Bot API.
+
+    Updates are handed to `on_update` from the thread serving the request,
+    so no polling thread sits between telegram and the handlers.
+    `on_update` should return quickly, since telegram waits for the
+    response before pushing further updates of the same chat.
+
+    Each open connection is served by one of `connections` threads, however
+    many chats push updates, so it should match the ``max_connections``
+    the webhook is registered with.
+
+    Only requests to ``/<secret>`` are accepted. When `secret_token` is
+    given, requests must also carry it in the
+    ``X-Telegram-Bot-Api-Secret-Token`` header.
+
+    Args:
+        on_update: Callable taking a decoded update.
+        secret (str): Secret path of the webhook.
+        secret_token (str): Secret token telegram sends with each update.
+        host (str): Address to listen on.
+        port (int): Port to listen on, ``0`` for any free port.
+        connections (int): Connections served at the same time.
+    """
+
+    def __init__(self, on_update, secret, secret_token=None, host=DEFAULT_HOST,
+                 port=DEFAULT_PORT, connections=DEFAULT_CONNECTIONS):
+        self.on_update = on_update
+        self.path = '/' + secret.strip('/')
+        self.secret_token = secret_token
+
+        self._server = PooledHTTPServer((host, port), _Handler, connections)
+        self._server.webhook = self
+        self._thread = None
+
+    @property
+    def server_address(self):
+        return self._server.server_address
+
+    def authorized(self, path, token):
+        """Check whether a request comes from telegram.
+
+        Args:
+            path (str): Path of the request.
+            token (str): Value of the secret token header, or None.
+
+        Returns:
+            bool: True if the request is authorized.
+        """
+        if not _equal(path, self.path):
+            return False
+        if self.secret_token is None:
+            return True
+        return token is not None and _equal(token, self.secret_token)
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def start(self):
+        """Serve requests from a background thread."""
+        self._thread = Thread(target=self.serve_forever, name='matrigram-webhook')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def shutdown(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+
+def run_webhook(bot, on_update, url, secret, secret_token=None, host=DEFAULT_HOST,
+                port=DEFAULT_PORT, max_connections=DEFAULT_CONNECTIONS):
+    """Register a webhook with telegram and serve it forever.
+
+    Args:
+        bot (telepot.Bot): Bot the webhook is registered for.
+        on_update: Callable taking a decoded update.
+        url (str): Public base url telegram reaches the server at.
+        secret (str): Secret path of the webhook, appended to `url`.
+        secret_token (str): Secret token telegram sends with each update.
+        host (str): Address to listen on.
+        port (int): Port to listen on.
+        max_connections (int): Connections telegram may open at the same time.
+    """
+    server = WebhookServer(on_update, secret, secret_token, host, port, max_connections)
+    params = {'url': url.rstrip('/') + server.path, 'max_connections': max_connections}
+    if secret_token is not None:
+        params['secret_token'] = secret_token
+    bot._api_request('setWebhook', params)
+
+    logger.info('webhook listening on %s:%s', *server.server_address[:2])
+    server.serve_forever()
+
+
+def _equal(a, b):
+    """Compare secrets in constant time."""
+    return hmac.compare_digest(a.encode('utf-8'), b.encode('utf-8'))
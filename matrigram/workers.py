@@ -0,0 +1,144 @@
+import logging
+from collections import deque
+from threading import Condition
+from threading import Thread
+
+logger = logging.getLogger('matrigram')
+
+DEFAULT_WORKERS = 8
+
+
+class ChatExecutor(object):
+    """Bounded thread pool running tasks serially per key.
+
+    Tasks submitted with the same key (usually a telegram chat id) run one
+    after another in submission order, while tasks of different keys run in
+    parallel on up to `workers` threads.
+
+    Args:
+        workers (int): Number of worker threads.
+        name (str): Prefix for the worker thread names.
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS, name='matrigram-worker'):
+        self._cond = Condition()
+        self._pending = {}  # key -> deque of tasks
+        self._ready = deque()  # keys with pending tasks, not running and not held
+        self._active = set()  # keys with a running task
+        self._held = set()  # keys whose tasks are buffered until released
+        self._queued = 0
+        self._running = True
+
+        self._threads = []
+        for i in range(workers):
+            thread = Thread(target=self._work, name='{}-{}'.format(name, i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, key, func, *args, **kwargs):
+        """Schedule `func(*args, **kwargs)` after all earlier tasks of `key`.
+
+        Args:
+            key: Serialization key, e.g. telegram chat id.
+            func: The callable to run.
+        """
+        with self._cond:
+            if not self._running:
+                raise RuntimeError('executor is shut down')
+
+            tasks = self._pending.setdefault(key, deque())
+            if not tasks and key not in self._active and key not in self._held:
+                self._ready.append(key)
+                self._cond.notify()
+            tasks.append((func, args, kwargs))
+            self._queued += 1
+
+    def hold(self, key):
+        """Buffer tasks of `key` until :meth:`release` is called.
+
+        A task already running for `key` is not affected.
+
+        Args:
+            key: Serialization key, e.g. telegram chat id.
+        """
+        with self._cond:
+            if key in self._held:
+                return
+            self._held.add(key)
+            if key in self._ready:
+                self._ready.remove(key)
+
+    def release(self, key):
+        """Resume running the tasks of a held `key`.
+
+        Args:
+            key: Serialization key, e.g. telegram chat id.
+        """
+        with self._cond:
+            self._held.discard(key)
+            if self._pending.get(key) and key not in self._active:
+                self._ready.append(key)
+                self._cond.notify()
+
+    def is_held(self, key):
+        """Return True if tasks of `key` are currently buffered."""
+        with self._cond:
+            return key in self._held
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while self._running and not self._ready:
+                    self._cond.wait()
+                if not self._ready:
+                    return
+
+                key = self._ready.popleft()
+                func, args, kwargs = self._pending[key].popleft()
+                self._queued -= 1
+                self._active.add(key)
+
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                logger.exception('task of %s failed', key)
+
+            with self._cond:
+                self._active.discard(key)
+                if not self._pending[key]:
+                    del self._pending[key]
+                elif key not in self._held:
+                    self._ready.append(key)
+                    self._cond.notify()
+
+    def stats(self):
+        """Return queue depth statistics.
+
+        Returns:
+            dict: Number of workers, busy workers, keys with pending work,
+            held keys, total queued tasks and the deepest per-key queue.
+        """
+        with self._cond:
+            return {
+                'workers': len(self._threads),
+                'busy': len(self._active),
+                'keys': len(self._pending),
+                'held': len(self._held),
+                'queued': self._queued,
+                'max_depth': max([len(tasks) for tasks in self._pending.values()] or [0]),
+            }
+
+    def shutdown(self, wait=True):
+        """Stop accepting tasks and let the workers drain the queues.
+
+        Args:
+            wait (bool): Block until all workers are done.
+        """
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+
+        if wait:
+            for thread in self._threads:
+                thread.join()
@@ -1,17 +1,68 @@
+import functools
 import logging
 import logging.handlers
 import os
 import sys
 import tempfile
 
+import telepot
+from telepot.loop import GetUpdatesLoop
+
 from matrigram import helper
 from matrigram.bot import MatrigramBot
+from matrigram.metrics import DEFAULT_PORT as DEFAULT_METRICS_PORT
+from matrigram.outbound import DEFAULT_GLOBAL_RATE
+from matrigram.sharding import HashRing
+from matrigram.sharding import ShardSupervisor
+from matrigram.webhook import run_webhook
 
-reload(sys)
-sys.setdefaultencoding('utf-8')
+if sys.version_info[0] < 3:
+    # shards started fresh import this module again, which must work on python 3
+    reload(sys)
+    sys.setdefaultencoding('utf-8')
 
 
-def main():
+def make_shard(token, config, shard):
+    """Create the bot of a shard process.
+
+    The shards share the flood limit of the bot, so each gets its part of it.
+    """
+    processes = config['processes']
+    outbox = dict(config.get('outbox', {}))
+    outbox['global_rate'] = float(outbox.get('global_rate', DEFAULT_GLOBAL_RATE)) / processes
+    shard_config = dict(config, outbox=outbox)
+    if config.get('metrics'):
+        # every shard serves its own metrics, on the ports following the configured one
+        metrics = dict(config['metrics'])
+        metrics['port'] = metrics.get('port', DEFAULT_METRICS_PORT) + shard
+        shard_config['metrics'] = metrics
+
+    if not logging.getLogger('matrigram').handlers:
+        # shards started fresh don't inherit the logging of the front process
+        setup_logging()
+    logging.getLogger('matrigram').info('shard %s starting', shard)
+    bot = MatrigramBot(token, config=shard_config)
+    if bot.metrics_server is not None:
+        bot.metrics_server.start()
+    ring = HashRing(range(processes))
+    bot.restore_sessions(lambda chat_id: ring.node_for(chat_id) == shard)
+    return bot.on_update
+
+
+def run_sharded(token, config):
+    supervisor = ShardSupervisor(functools.partial(make_shard, token, config),
+                                 config['processes'])
+    supervisor.start()
+
+    front = telepot.Bot(token)
+    webhook = config.get('webhook')
+    if webhook:
+        run_webhook(front, supervisor.dispatch, **webhook)
+    else:
+        GetUpdatesLoop(front, supervisor.dispatch).run_forever()
+
+
+def setup_logging():
     logger = logging.getLogger('matrigram')
     logger.setLevel(logging.DEBUG)
     formatter = logging.Formatter(fmt='%(asctime)s %(levelname)s '
@@ -23,6 +74,11 @@ def main():
     fh.setFormatter(formatter)
     logger.addHandler(sh)
     logger.addHandler(fh)
+    return logger
+
+
+def main():
+    logger = setup_logging()
 
     if not os.path.isfile(helper.CONFIG_PATH):
         logger.error('Please fill the config file at %s', helper.CONFIG_PATH)
@@ -36,13 +92,36 @@ def main():
         os.mkdir(media_dir)
 
     config['media_dir'] = media_dir
+
+    data_dir = config.get('data_dir', helper.DATA_DIR)
+    if not os.path.exists(data_dir):
+        logging.debug('creating dir %s', data_dir)
+        # holds access tokens
+        os.mkdir(data_dir, 0o700)
+    config['data_dir'] = data_dir
     token = config['telegram_token']
     if not helper.config_filled():
         logger.error('Please enter you tg token in %s', helper.CONFIG_PATH)
         return
 
+    if config.get('processes', 1) > 1:
+        if config.get('appservice'):
+            logger.error('appservice and processes can\'t be used together')
+            return
+        run_sharded(token, config)
+        return
+
     mg = MatrigramBot(token, config=config)
-    mg.message_loop(run_forever='-I- matrigram running...')
+    if mg.appservice is not None:
+        mg.appservice.start()
+    if mg.metrics_server is not None:
+        mg.metrics_server.start()
+    mg.restore_sessions()
+    webhook = config.get('webhook')
+    if webhook:
+        mg.run_webhook(**webhook)
+    else:
+        mg.message_loop(run_forever='-I- matrigram running...')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,94 @@
+import json
+
+import requests
+
+from matrigram.appservice import AppService
+
+
+class FakeClient(object):
+    def __init__(self, user_id, rooms):
+        self.user_id = user_id
+        self.rooms = list(rooms)
+        self.events = []
+        self.ephemeral = []
+
+    def room_ids(self):
+        return self.rooms
+
+    def on_pushed_event(self, event):
+        self.events.append(event['event_id'])
+
+    def on_pushed_ephemeral_event(self, event):
+        self.ephemeral.append(event['type'])
+
+
+def _message(event_id, room_id):
+    return {'event_id': event_id, 'room_id': room_id, 'type': 'm.room.message',
+            'content': {'msgtype': 'm.text', 'body': 'hi'}}
+
+
+def _member(event_id, room_id, user_id, membership):
+    return {'event_id': event_id, 'room_id': room_id, 'type': 'm.room.member',
+            'state_key': user_id, 'content': {'membership': membership}}
+
+
+def test_events_fanned_out_to_room_members():
+    appservice = AppService('hs', port=0)
+    alice = FakeClient('@alice:server', ['!a:server', '!b:server'])
+    bob = FakeClient('@bob:server', ['!b:server'])
+    appservice.register(alice)
+    appservice.register(bob)
+
+    appservice.on_transaction('1', {
+        'events': [_message('$1', '!a:server'), _message('$2', '!b:server'),
+                   _message('$3', '!c:server')],
+        'ephemeral': [{'type': 'm.typing', 'room_id': '!b:server'}],
+    })
+    appservice.on_transaction('1', {'events': [_message('$1', '!a:server')]})
+
+    assert alice.events == ['$1', '$2']
+    assert bob.events == ['$2']
+    assert alice.ephemeral == bob.ephemeral == ['m.typing']
+
+
+def test_membership_followed():
+    appservice = AppService('hs', port=0)
+    alice = FakeClient('@alice:server', [])
+    appservice.register(alice)
+
+    appservice.on_transaction('1', {'events': [
+        _member('$invite', '!a:server', '@alice:server', 'invite'),
+        _member('$join', '!a:server', '@alice:server', 'join'),
+        _message('$message', '!a:server'),
+        _member('$leave', '!a:server', '@alice:server', 'leave'),
+        _message('$after', '!a:server'),
+    ]})
+    appservice.unregister(alice)
+    appservice.on_transaction('2', {'events': [_member('$gone', '!b:server', '@alice:server',
+                                                       'invite')]})
+
+    assert alice.events == ['$invite', '$join', '$message', '$leave']
+
+
+def test_transactions_authorized():
+    appservice = AppService('hs', port=0)
+    alice = FakeClient('@alice:server', ['!a:server'])
+    appservice.register(alice)
+    appservice.start()
+    url = 'http://127.0.0.1:{}/_matrix/app/v1/transactions/'.format(
+        appservice.server_address[1])
+
+    def put(txn_id, **kwargs):
+        body = json.dumps({'events': [_message(txn_id, '!a:server')]})
+        return requests.put(url + txn_id, data=body, **kwargs).status_code
+
+    codes = [
+        put('$1'),
+        put('$2', params={'access_token': 'wrong'}),
+        put('$3', params={'access_token': 'hs'}),
+        put('$4', headers={'Authorization': 'Bearer hs'}),
+    ]
+    appservice.shutdown()
+
+    assert codes == [401, 403, 200, 200]
+    assert alice.events == ['$3', '$4']
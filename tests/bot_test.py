@@ -0,0 +1,452 @@
+import io
+import json
+import time
+from threading import Event
+
+from matrix_client.client import MatrixClient
+from telepot.exception import TelegramError
+
+from matrigram import bot as bot_module
+from matrigram.bot import MatrigramBot
+from matrigram.client import MatrigramClient
+
+
+class FakeResponse(object):
+    def __init__(self, body, headers):
+        self.raw = io.BytesIO(body)
+        self.headers = headers
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+    def raise_for_status(self):
+        pass
+
+
+class FakeClient(object):
+    def __init__(self, sized=True):
+        self.sized = sized
+        self.downloads = 0
+
+    def open_media(self, event):
+        self.downloads += 1
+        body = event['content']['body']
+        return FakeResponse(body, {'Content-Length': str(len(body))} if self.sized else {})
+
+    @staticmethod
+    def media_name(event):
+        return event['content']['url'].split('/')[-1]
+
+
+def _bot(tmpdir):
+    bot = MatrigramBot('0:test', config={'server': 'http://localhost',
+                                         'data_dir': str(tmpdir),
+                                         'outbox': {'chat_rate': 100, 'burst': 100}})
+    bot.uploads = []
+    bot.sent_ids = []
+
+    def upload(kind, sender, body, chat_id):
+        bot.uploads.append(body.read())
+        return {kind: [{'file_id': 'small'}, {'file_id': 'id{}'.format(len(bot.uploads))}]}
+
+    bot._workaround_upload = upload
+    bot._send_file_id = lambda kind, sender, file_id, chat_id: bot.sent_ids.append(file_id)
+    return bot
+
+
+def _forward(bot, kind, event, client, chat_id):
+    sent = Event()
+    reservation = bot.outbox.reserve(chat_id)
+    bot.outbox.submit(chat_id, sent.set)
+    bot._prepare_media(reservation, bot._forward_media,
+                       bot_module._MatrixMedia(kind, 'sender', event, client, chat_id))
+    assert sent.wait(5)
+
+
+def _event(mxcurl, body):
+    return {'content': {'url': mxcurl, 'body': body, 'info': {'mimetype': 'image/jpeg'}}}
+
+
+def test_media_sent_by_file_id(tmpdir):
+    bot = _bot(tmpdir)
+    client = FakeClient()
+
+    _forward(bot, 'photo', _event('mxc://server/a', b'A'), client, 1)
+    _forward(bot, 'photo', _event('mxc://server/a', b'A'), client, 2)
+
+    assert len(bot.uploads) == 1
+    assert client.downloads == 1
+    assert bot.sent_ids == ['id1']
+
+
+def test_media_streamed(tmpdir):
+    bot = _bot(tmpdir)
+    client = FakeClient()
+
+    _forward(bot, 'photo', _event('mxc://server/a', b'A' * 100000), client, 1)
+
+    assert len(bot.uploads) == 1
+    assert b'A' * 100000 in bot.uploads[0]
+    assert b'filename="a"' in bot.uploads[0]
+
+
+def test_same_content_sent_by_file_id(tmpdir):
+    bot = _bot(tmpdir)
+    client = FakeClient(sized=False)
+
+    _forward(bot, 'photo', _event('mxc://server/a', b'A'), client, 1)
+    _forward(bot, 'photo', _event('mxc://server/b', b'A'), client, 1)
+    _forward(bot, 'video', _event('mxc://server/b', b'A'), client, 1)
+
+    assert len(bot.uploads) == 2
+    assert bot.sent_ids == ['id1']
+
+
+def test_media_upload_retried_after_flood_limit(tmpdir):
+    bot = _bot(tmpdir)
+    upload = bot._workaround_upload
+
+    def flooded_upload(kind, sender, body, chat_id):
+        if not bot.uploads:
+            bot.uploads.append(body.read())
+            raise TelegramError('Too Many Requests', 429, {'parameters': {'retry_after': 0}})
+        return upload(kind, sender, body, chat_id)
+
+    bot._workaround_upload = flooded_upload
+    client = FakeClient()
+    _forward(bot, 'photo', _event('mxc://server/a', b'A' * 1000), client, 1)
+
+    assert len(bot.uploads) == 2
+    assert b'A' * 1000 in bot.uploads[1]
+    assert client.downloads == 2
+
+
+def test_media_keeps_order_with_messages(tmpdir):
+    bot = _bot(tmpdir)
+    bot._send_chat_action = lambda *args: None
+    sent = []
+    bot.sendMessage = lambda chat_id, text: sent.append(text)
+    upload = bot._workaround_upload
+
+    def slow_upload(kind, sender, body, chat_id):
+        sent.append(kind)
+        return upload(kind, sender, body, chat_id)
+
+    bot._workaround_upload = slow_upload
+    client = FakeClient()
+    open_media = client.open_media
+
+    def slow_open_media(event):
+        time.sleep(0.1)
+        return open_media(event)
+
+    client.open_media = slow_open_media
+    bot.users.add(1, client)
+
+    bot.send_photo('bob', _event('mxc://server/a', b'A'), client)
+    bot.send_message('bob', 'look at this ^', client)
+    bot.outbox.shutdown()
+
+    assert sent == ['photo', 'bob: look at this ^']
+
+
+def test_file_ids_persist(tmpdir):
+    bot = _bot(tmpdir)
+    _forward(bot, 'photo', _event('mxc://server/a', b'A'), FakeClient(), 1)
+
+    restarted = _bot(tmpdir)
+    client = FakeClient()
+    _forward(restarted, 'photo', _event('mxc://server/a', b'A'), client, 1)
+
+    assert not restarted.uploads
+    assert client.downloads == 0
+    assert restarted.sent_ids == ['id1']
+
+
+class FakeMatrixClient(object):
+    def __init__(self):
+        self.uploads = []
+        self.sent = []
+
+    def upload(self, content, mimetype):
+        content = content()
+        self.uploads.append((b''.join(content), len(content), mimetype))
+        return 'mxc://server/{}'.format(len(self.uploads))
+
+    def send_media(self, msgtype, mxcurl, name):
+        self.sent.append((msgtype, mxcurl, name))
+
+
+class FakeHttp(object):
+    def __init__(self, body, headers):
+        self.body = body
+        self.headers = headers
+        self.downloads = []
+
+    def get(self, url, **kwargs):
+        self.downloads.append(url)
+        return FakeResponse(self.body, self.headers)
+
+
+def _telegram_bot(tmpdir, body, headers):
+    bot = _bot(tmpdir)
+    bot.config['media_dir'] = str(tmpdir)
+    bot.client = FakeMatrixClient()
+    bot._get_client = lambda chat_id: bot.client
+    bot.http = FakeHttp(body, headers)
+    bot.get_file_calls = []
+
+    def get_file(file_id):
+        bot.get_file_calls.append(file_id)
+        return {'file_id': file_id, 'file_path': 'animations/file_1.mp4'}
+
+    bot.getFile = get_file
+    return bot
+
+
+def test_telegram_media_sent_by_mxc_url(tmpdir):
+    bot = _telegram_bot(tmpdir, b'gif', {'Content-Length': '3'})
+
+    msg = {'chat': {'id': 1}}
+    gif = {'file_id': 'id-a', 'file_unique_id': 'unique'}
+    resent = {'file_id': 'id-b', 'file_unique_id': 'unique'}
+    bot._forward_media_to_mc(msg, gif, 'm.video')
+    bot._forward_media_to_mc(msg, resent, 'm.video')
+
+    assert bot.get_file_calls == ['id-a']
+    assert len(bot.http.downloads) == 1
+    assert bot.client.uploads == [(b'gif', 3, 'video/mp4')]
+    assert bot.client.sent == [('m.video', 'mxc://server/1', 'file_1.mp4')] * 2
+
+
+def test_telegram_media_of_unknown_size(tmpdir):
+    bot = _telegram_bot(tmpdir, b'x' * 1000, {})
+    bot.config['media_spool_threshold'] = 10
+
+    bot._forward_media_to_mc({'chat': {'id': 1}}, {'file_id': 'id'}, 'm.video')
+
+    assert bot.client.uploads == [(b'x' * 1000, 1000, 'video/mp4')]
+
+
+def test_get_file_cached(tmpdir):
+    bot = _bot(tmpdir)
+    calls = []
+
+    def get_file(file_id):
+        calls.append(file_id)
+        return {'file_id': file_id, 'file_path': 'photos/file_1.jpg'}
+
+    bot.getFile = get_file
+
+    assert bot._get_file('id') == bot._get_file('id')
+    assert calls == ['id']
+
+
+def test_webhook_update_routed(tmpdir):
+    bot = _bot(tmpdir)
+    handled = []
+    bot.on_chat_message = handled.append
+    msg = {'message_id': 1, 'chat': {'id': 1, 'type': 'private'}, 'text': 'hi'}
+
+    bot.on_update({'update_id': 1, 'message': msg})
+    bot.on_update({'update_id': 2, 'poll': {}})
+
+    assert handled == [msg]
+
+
+class FakeSessionClient(object):
+    def __init__(self, server, tb, username, filter_options=None, alias_ids=None,
+                 history_size=None):
+        self.client = MatrixClient(server)
+        self.username = username
+        self.since = 's0'
+        self.restored = None
+
+    def restore(self, state):
+        self.restored = state
+
+    def state(self):
+        return {'server': 'http://localhost', 'username': self.username, 'since': self.since}
+
+
+def test_sessions_resumed(tmpdir, monkeypatch):
+    monkeypatch.setattr(bot_module, 'MatrigramClient', FakeSessionClient)
+    bot = _bot(tmpdir)
+    client = FakeSessionClient('http://localhost', bot, 'alice')
+    bot.users.add(5, client)
+    bot._save_session(5, client)
+    bot.saved_sessions.close()
+
+    restarted = _bot(tmpdir)
+    assert restarted.restore_sessions(lambda chat_id: chat_id != 6) == 1
+    deadline = time.time() + 5
+    while 5 not in restarted.users and time.time() < deadline:
+        time.sleep(0.01)
+
+    assert restarted.users.get_client(5).restored == client.state()
+
+
+def test_session_saved_on_room_changes(tmpdir):
+    bot = _bot(tmpdir)
+    client = MatrigramClient('http://localhost', bot, 'alice')
+    client.client.user_id = '@alice:localhost'
+    bot.users.add(5, client)
+    bot.checkpoint_session(client)
+
+    client.on_pushed_event({'type': 'm.room.member', 'room_id': '!a:localhost',
+                            'sender': '@alice:localhost', 'state_key': '@alice:localhost',
+                            'content': {'membership': 'join'}})
+    assert list(json.loads(bot.saved_sessions.get('5'))['rooms']) == ['!a:localhost']
+
+    client.set_focus_room('!a:localhost')
+    assert json.loads(bot.saved_sessions.get('5'))['focus_room_id'] == '!a:localhost'
+
+
+def test_session_checkpoints_throttled(tmpdir):
+    bot = _bot(tmpdir)
+    client = FakeSessionClient('http://localhost', bot, 'alice')
+    bot.users.add(5, client)
+
+    bot.checkpoint_session(client)
+    client.since = 's1'
+    bot.checkpoint_session(client)
+
+    assert json.loads(bot.saved_sessions.get('5'))['since'] == 's0'
+
+
+def test_leave_keyboard_resolves_locally(tmpdir):
+    bot = _bot(tmpdir)
+    replies = []
+    bot._reply = lambda chat_id, text, **kwargs: replies.append((text, kwargs))
+    bot.answerCallbackQuery = lambda query_id, text: None
+    client = MatrigramClient('http://localhost', bot, 'alice', alias_ids=bot.alias_ids)
+    room = client.client._mkroom('!a:localhost')
+    room._put_event({'type': 'm.room.canonical_alias', 'state_key': '',
+                     'content': {'alias': '#a:localhost'}})
+    requests = []
+    client.client.api._send = lambda method, path, *args, **kwargs: requests.append(path) or {}
+    bot.users.add(1, client)
+
+    bot.leave_room({'chat': {'id': 1}}, None)
+    button = replies[-1][1]['reply_markup']['inline_keyboard'][0][0]
+    data = button['callback_data']
+    callback, match = bot.callback_query_router.match(data)
+    callback({'id': 'q', 'from': {'id': 1}, 'data': data, 'message': {'chat': {'id': 1}}}, match)
+
+    assert (button['text'], data) == ('#a:localhost', 'LEAVE !a:localhost')
+    assert replies[-1][0] == 'Left #a:localhost'
+    assert requests == ['/rooms/!a:localhost/leave']
+
+
+def test_discover_paged_from_directory(tmpdir):
+    bot = _bot(tmpdir)
+    replies = []
+    bot._reply = lambda chat_id, text, **kwargs: replies.append((text, kwargs['reply_markup']))
+    bot._edit = lambda chat_id, message_id, text, **kwargs: replies.append(
+        (text, kwargs['reply_markup']))
+    bot.answerCallbackQuery = lambda query_id, text=None: None
+    bot._send_chat_action = lambda *args: None
+    requests = []
+
+    def send(method, path, body):
+        requests.append(body)
+        return {'chunk': [{'aliases': ['#room{}:localhost'.format(i)], 'name': 'Python',
+                           'num_joined_members': i} for i in range(15)]}
+    for user, chat_id in (('alice', 1), ('bob', 2)):
+        client = MatrigramClient('http://localhost', bot, user)
+        client.client.api._send = send
+        bot.users.add(chat_id, client)
+
+    command = {'chat': {'id': 1}, 'text': '/discover python'}
+    bot.discover_rooms(command, bot.text_router.match(command['text'])[1])
+    data = replies[-1][1]['inline_keyboard'][0][0]['callback_data']
+    callback, match = bot.callback_query_router.match(data)
+    callback({'id': 'q', 'from': {'id': 2}, 'data': data,
+              'message': {'message_id': 3, 'chat': {'id': 2}}}, match)
+
+    assert replies[0][0].split('\n')[0] == '#room0:localhost - Python (0 members)'
+    assert data == 'DISCOVER 10 python'
+    assert replies[1] == ('#room10:localhost - Python (10 members)\n'
+                          '#room11:localhost - Python (11 members)\n'
+                          '#room12:localhost - Python (12 members)\n'
+                          '#room13:localhost - Python (13 members)\n'
+                          '#room14:localhost - Python (14 members)',
+                          {'inline_keyboard': [[{'text': '< Prev',
+                                                 'callback_data': 'DISCOVER 0 python'}]]})
+    assert requests == [{'limit': 50, 'filter': {'generic_search_term': 'python'}}]
+
+
+def test_history_sent_as_digest(tmpdir):
+    bot = _bot(tmpdir)
+    replies = []
+    bot._reply = lambda chat_id, text, **kwargs: replies.append(text)
+    client = MatrigramClient('http://localhost', bot, 'alice')
+    client.client._mkroom('!a:localhost')
+    client.focus_room_id = '!a:localhost'
+    history = [
+        {'type': 'm.room.message', 'sender': '@bob:localhost',
+         'content': {'msgtype': 'm.image', 'body': 'cat.jpg', 'url': 'mxc://localhost/cat'}},
+        {'type': 'm.room.member', 'sender': '@bob:localhost', 'content': {}},
+        {'type': 'm.room.topic', 'sender': '@bob:localhost', 'content': {'topic': 'cats'}},
+    ] + [{'type': 'm.room.message', 'sender': '@bob:localhost',
+          'content': {'msgtype': 'm.text', 'body': 'x' * 1000}}] * 7
+    client.client.api.get_room_messages = lambda room_id, token, direction, limit: {
+        'chunk': list(reversed(history[:limit]))}
+
+    bot._send_history(1, client, '#a:localhost')
+
+    assert len(replies) == 2
+    assert replies[0].split('\n')[:3] == [
+        '#a:localhost Room history:',
+        '@bob sent a photo: http://localhost/_matrix/media/r0/download/localhost/cat',
+        '@bob changed topic to: "cats"']
+    assert replies[1] == '\n'.join(['@bob: ' + 'x' * 1000] * 4)
+
+
+def test_relays_measured(tmpdir):
+    bot = _bot(tmpdir)
+    bot._send_chat_action = lambda *args: None
+    sent = []
+    bot.sendMessage = lambda chat_id, text: sent.append(text)
+    client = FakeSessionClient('http://localhost', bot, 'alice')
+    bot.users.add(1, client)
+
+    bot.send_message('@bob', 'hi', client)
+    bot.outbox.shutdown()
+
+    text = bot.metrics.render()
+    assert sent == ['@bob: hi']
+    assert 'matrigram_relayed_messages_total{direction="matrix_to_telegram",type="text"} 1' in text
+    assert '\nmatrigram_sessions 1\n' in text
+
+
+def test_members_pages_tied_to_room(tmpdir):
+    bot = _bot(tmpdir)
+    replies = []
+    bot._reply = lambda chat_id, text, **kwargs: replies.append((text, kwargs['reply_markup']))
+    bot._edit = lambda chat_id, message_id, text, **kwargs: replies.append(
+        (text, kwargs['reply_markup']))
+    answers = []
+    bot.answerCallbackQuery = lambda query_id, text=None: answers.append(text)
+    client = MatrigramClient('http://localhost', bot, 'alice')
+    for room_id in ('!a:localhost', '!b:localhost'):
+        client.client._mkroom(room_id)
+    client.focus_room_id = '!a:localhost'
+    client.client.api._send = lambda method, path: {
+        'joined': {'@{}:localhost'.format(i): {} for i in range(15)}}
+    bot.users.add(1, client)
+
+    command = {'chat': {'id': 1}, 'text': '/members'}
+    bot.get_members(command, bot.text_router.match(command['text'])[1])
+    data = replies[-1][1]['inline_keyboard'][0][0]['callback_data']
+    callback, match = bot.callback_query_router.match(data)
+    query = {'id': 'q', 'from': {'id': 1}, 'data': data,
+             'message': {'message_id': 3, 'chat': {'id': 1}}}
+    callback(query, match)
+    client.focus_room_id = '!b:localhost'
+    callback(query, match)
+
+    assert data == 'MEMBERS 10 !a:localhost'
+    assert len(replies) == 2
+    assert answers == [None, 'This listing expired, send /members again']
@@ -0,0 +1,42 @@
+import time
+
+from matrigram.cache import PersistentMap
+from matrigram.cache import TTLCache
+
+
+def test_persistent_map(tmpdir):
+    path = str(tmpdir.join('test.db'))
+    mapping = PersistentMap(path, 'test')
+
+    assert mapping.get('key') is None
+    assert mapping.get('key', 'default') == 'default'
+
+    mapping.set('key', 'value')
+    mapping.set('key', 'new value')
+    mapping.set('other', 'value')
+    assert mapping.get('key') == 'new value'
+    assert len(mapping) == 2
+
+    mapping.delete('other')
+    mapping.close()
+
+    reopened = PersistentMap(path, 'test')
+    assert reopened.get('key') == 'new value'
+    assert reopened.get('other') is None
+    reopened.close()
+
+
+def test_ttl_cache():
+    cache = TTLCache(ttl=0.05, max_size=2)
+
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+
+    cache.set('c', 3)
+    assert cache.get('a') is None
+    assert len(cache) == 2
+
+    time.sleep(0.06)
+    assert cache.get('b') is None
+    assert cache.get('c', 'expired') == 'expired'
@@ -0,0 +1,287 @@
+import io
+import json
+
+import pytest
+from matrix_client.client import MatrixRequestError
+from requests import Response
+from requests.adapters import BaseAdapter
+
+from matrigram.cache import TTLCache
+from matrigram.client import MatrigramClient
+from matrigram.streaming import SizedStream
+
+
+class FakeBot(object):
+    appservice = None
+
+    def checkpoint_session(self, client, force=False):
+        pass
+
+
+def test_session_state_resumed():
+    state = {
+        'server': 'http://localhost',
+        'username': 'alice',
+        'user_id': '@alice:localhost',
+        'token': 'token',
+        'device_id': 'DEVICE',
+        'focus_room_id': '!room:localhost',
+        'since': 's42',
+        'rooms': {'!room:localhost': {'name': 'Room',
+                                      'canonical_alias': '#room:localhost',
+                                      'aliases': ['#room:localhost']}},
+    }
+    client = MatrigramClient('http://localhost', FakeBot(), 'alice')
+    # no homeserver to sync with
+    client.client.start_listener_thread = lambda **kwargs: None
+    client.client.api.create_filter = lambda user_id, definition: {'filter_id': '7'}
+
+    client.restore(state)
+
+    assert client.client.api.token == 'token'
+    assert client.client.sync_filter == '7'
+    assert client.have_focus_room()
+    assert client.state() == state
+
+
+def test_focus_only_filter_follows_focus():
+    client = MatrigramClient('http://localhost', FakeBot(), 'alice', {'focus_only': True})
+    client.client.user_id = '@alice:localhost'
+    for room_id in ('!a:localhost', '!b:localhost'):
+        client.client._mkroom(room_id)
+    uploaded = []
+
+    def create_filter(user_id, definition):
+        uploaded.append(definition['room']['timeline']['rooms'])
+        return {'filter_id': str(len(uploaded))}
+
+    client.client.api.create_filter = create_filter
+    client.update_sync_filter()
+    client.set_focus_room('!a:localhost')
+    client.set_focus_room('!b:localhost')
+
+    assert uploaded == [[], ['!a:localhost'], ['!b:localhost']]
+    assert client.client.sync_filter == '3'
+
+
+class KickedBot(FakeBot):
+    def __init__(self):
+        self.kicks = []
+
+    def send_kick(self, room, client):
+        self.kicks.append(room)
+
+
+def test_pushed_events_handled_like_synced():
+    tb = KickedBot()
+    client = MatrigramClient('http://localhost', tb, 'alice')
+    client.client.user_id = '@alice:localhost'
+
+    def member(membership, sender):
+        return {'type': 'm.room.member', 'room_id': '!a:localhost', 'sender': sender,
+                'state_key': '@alice:localhost', 'content': {'membership': membership}}
+
+    message = {'type': 'm.room.message', 'room_id': '!a:localhost', 'sender': '@bob:localhost',
+               'content': {'msgtype': 'm.text', 'body': 'hi'}}
+    client.on_pushed_event(member('join', '@alice:localhost'))
+    client.on_pushed_event(message)
+    events = client.client.rooms['!a:localhost'].events
+    client.on_pushed_event(member('leave', '@bob:localhost'))
+
+    assert events[-1] == message
+    assert tb.kicks == [None]
+    assert client.room_ids() == []
+
+
+def test_message_sent_with_one_request():
+    client = MatrigramClient('http://localhost', FakeBot(), 'alice')
+    for i in range(50):
+        room = client.client._mkroom('!{}:localhost'.format(i))
+        room._put_event({'type': 'm.room.canonical_alias', 'state_key': '',
+                         'content': {'alias': '#room{}:localhost'.format(i)}})
+    requests = []
+
+    def send(method, path, *args, **kwargs):
+        requests.append((method, path))
+        return {'event_id': '$1', 'room_id': '!7:localhost'}
+    client.client.api._send = send
+
+    client.set_focus_room('#room7:localhost')
+    client.send_message('hi')
+
+    assert len(requests) == 1
+    assert requests[0][1].startswith('/rooms/%217%3Alocalhost/send/m.room.message/')
+    assert client.get_rooms_aliases()['!7:localhost'] == ['#room7:localhost']
+    assert client._room_id_to_alias('!7:localhost') == '#room7:localhost'
+
+
+def test_aliases_resolved_once_per_server():
+    alias_ids = TTLCache(60)
+    alice = MatrigramClient('http://localhost', FakeBot(), 'alice', alias_ids=alias_ids)
+    bob = MatrigramClient('http://localhost', FakeBot(), 'bob', alias_ids=alias_ids)
+    lookups = []
+
+    def get_room_id(alias):
+        lookups.append(alias)
+        return '!{}:localhost'.format(len(lookups))
+    alice.client.api.get_room_id = bob.client.api.get_room_id = get_room_id
+
+    resolved = [client._room_alias_to_id('#room:localhost') for client in (alice, bob)]
+    bob.on_alias_event({'type': 'm.room.canonical_alias', 'room_id': '!2:localhost',
+                        'content': {'alias': '#room:localhost'}})
+    resolved.append(alice._room_alias_to_id('#room:localhost'))
+
+    assert resolved == ['!1:localhost', '!1:localhost', '!2:localhost']
+    assert lookups == ['#room:localhost', '#room:localhost']
+
+
+def test_members_fetched_once():
+    client = MatrigramClient('http://localhost', FakeBot(), 'alice')
+    room = client.client._mkroom('!a:localhost')
+    client.focus_room_id = room.room_id
+    requests = []
+
+    def send(method, path, *args, **kwargs):
+        requests.append(path)
+        return {'joined': {'@{}:localhost'.format(i): {'display_name': 'user{:03}'.format(i)}
+                           for i in range(100)}}
+    client.client.api._send = send
+
+    first = client.get_members()
+    room._put_event({'type': 'm.room.member', 'state_key': '@0:localhost',
+                     'sender': '@0:localhost', 'content': {'membership': 'leave'}})
+    room._put_event({'type': 'm.room.member', 'state_key': '@new:localhost',
+                     'sender': '@new:localhost',
+                     'content': {'membership': 'join', 'displayname': 'user0500'}})
+
+    assert first == (['user{:03}'.format(i) for i in range(10)], 100)
+    assert client.get_members(offset=95) == (['user095', 'user096', 'user097', 'user098',
+                                              'user099'], 100)
+    assert client.get_members(prefix='user05', limit=2) == (['user050', 'user0500'], 11)
+    assert requests == ['/rooms/%21a%3Alocalhost/joined_members']
+
+
+def test_focus_history_replayed_locally():
+    client = MatrigramClient('http://localhost', FakeBot(), 'alice', history_size=5)
+    for room_id in ('!a:localhost', '!b:localhost'):
+        client.client._mkroom(room_id)
+    fetches = []
+
+    def get_room_messages(room_id, token, direction, limit):
+        fetches.append((room_id, limit))
+        return {'chunk': [{'event_id': '$old', 'type': 'm.room.message', 'room_id': room_id,
+                           'sender': '@bob:localhost',
+                           'content': {'msgtype': 'm.text', 'body': 'old'}}]}
+    client.client.api.get_room_messages = get_room_messages
+
+    histories = []
+    for room_id, body in (('!a:localhost', 'hi'), ('!b:localhost', 'ho'),
+                          ('!a:localhost', 'hey')):
+        client.focus_room_id = room_id
+        client.on_pushed_event({'event_id': '$' + body, 'type': 'm.room.message',
+                                'room_id': room_id, 'sender': '@bob:localhost',
+                                'content': {'msgtype': 'm.text', 'body': body}})
+        histories.append([event['content']['body'] for event in client.get_history()])
+
+    assert histories == [['old', 'hi'], ['old', 'ho'], ['old', 'hi', 'hey']]
+    assert fetches == [('!a:localhost', 5), ('!b:localhost', 5)]
+
+
+def test_redacted_aliases_tolerated():
+    client = MatrigramClient('http://localhost', FakeBot(), 'alice')
+    room = client.client._mkroom('!a:localhost')
+    room._put_event({'type': 'm.room.canonical_alias', 'state_key': '',
+                     'content': {'alias': '#a:localhost'}})
+    # redacted, its content is stripped
+    room._put_event({'type': 'm.room.aliases', 'state_key': 'localhost', 'content': {}})
+
+    assert room.aliases is None
+    assert client.get_rooms_aliases() == {'!a:localhost': ['#a:localhost']}
+
+
+def test_members_refetched_when_changes_unseen():
+    client = MatrigramClient('http://localhost', FakeBot(), 'alice', {'focus_only': True})
+    for room_id in ('!a:localhost', '!b:localhost'):
+        client.client._mkroom(room_id)
+    client.focus_room_id = '!a:localhost'
+    fetches = []
+
+    def send(method, path, *args, **kwargs):
+        fetches.append(path)
+        if len(fetches) == 1:
+            raise MatrixRequestError(500, 'unavailable')
+        return {'joined': {'@bob:localhost': {'display_name': 'Bob'}}}
+    client.client.api._send = send
+    client.client._api_sync = lambda *args, **kwargs: {
+        'next_batch': 's1', 'rooms': {'join': {'!a:localhost': {
+            'timeline': {'limited': True, 'prev_batch': 'p', 'events': []}}}}}
+
+    with pytest.raises(MatrixRequestError):
+        client.get_members()
+    client.get_members()
+    client.get_members()
+    client.client._sync()
+    client.get_members()
+    client.set_focus_room('!b:localhost')
+    client.set_focus_room('!a:localhost')
+    client.get_members()
+
+    assert len(fetches) == 4
+    assert len(client.client.rooms['!a:localhost'].state_listeners) == 1
+
+
+def test_history_refetched_after_gap():
+    client = MatrigramClient('http://localhost', FakeBot(), 'alice')
+    client.client._mkroom('!a:localhost')
+    client.focus_room_id = '!a:localhost'
+    fetches = []
+    client.client.api.get_room_messages = lambda room_id, token, direction, limit: (
+        fetches.append(room_id) or {'chunk': []})
+    client.client._api_sync = lambda *args, **kwargs: {
+        'next_batch': 's1', 'rooms': {'join': {'!a:localhost': {
+            'timeline': {'limited': True, 'prev_batch': 'p', 'events': []}}}}}
+
+    client.get_history()
+    client.get_history()
+    client.client._sync()
+    client.get_history()
+
+    assert fetches == ['!a:localhost'] * 2
+
+
+class FakeAdapter(BaseAdapter):
+    def __init__(self, statuses):
+        super(FakeAdapter, self).__init__()
+        self.statuses = list(statuses)
+        self.bodies = []
+
+    def send(self, request, **kwargs):
+        self.bodies.append(b''.join(request.body))
+        response = Response()
+        response.status_code = self.statuses.pop(0)
+        response.request = request
+        response.url = request.url
+        if response.status_code == 429:
+            response._content = json.dumps({'errcode': 'M_LIMIT_EXCEEDED',
+                                            'retry_after_ms': 10}).encode('utf-8')
+        else:
+            response._content = b'{"content_uri": "mxc://localhost/media"}'
+        return response
+
+    def close(self):
+        pass
+
+
+def test_rate_limited_upload_reopens_stream():
+    client = MatrigramClient('http://localhost', FakeBot(), 'alice')
+    adapter = FakeAdapter([429, 200])
+    client.client.api.session.mount('http://', adapter)
+    opened = []
+
+    def open_body():
+        opened.append(True)
+        return SizedStream(io.BytesIO(b'media'), 5, chunk_size=2)
+
+    assert client.upload(open_body, 'image/png') == 'mxc://localhost/media'
+    assert len(opened) == 2
+    assert adapter.bodies == [b'media', b'media']
@@ -0,0 +1,55 @@
+from matrigram.directory import RoomDirectory
+
+
+class FakeHomeserver(object):
+    def __init__(self, rooms):
+        self.rooms = rooms
+        self.requests = []
+
+    def fetch(self, since, limit, term):
+        self.requests.append((since, term))
+        rooms = [room for room in self.rooms if not term or term in room['name']]
+        start = int(since or 0)
+        response = {'chunk': rooms[start:start + limit]}
+        if start + limit < len(rooms):
+            response['next_batch'] = str(start + limit)
+        return response
+
+
+def _rooms(count):
+    rooms = [{'room_id': '!{}:server'.format(i), 'name': 'room{}'.format(i),
+              'aliases': ['#room{}:server'.format(i)], 'num_joined_members': i}
+             for i in range(count)]
+    rooms[1]['canonical_alias'] = '#one:server'
+    del rooms[2]['aliases']
+    return rooms
+
+
+def test_rooms_fetched_as_paged():
+    homeserver = FakeHomeserver(_rooms(100))
+    directory = RoomDirectory(batch_size=30)
+
+    first, more = directory.page('server', homeserver.fetch, 0, 10)
+    again = directory.page('server', homeserver.fetch, 0, 10)
+    second = directory.page('server', homeserver.fetch, 10, 10)
+    last = directory.page('server', homeserver.fetch, 90, 10)
+
+    assert [room['alias'] for room in first[:3]] == ['#room0:server', '#one:server',
+                                                     '#room3:server']
+    assert first[3] == {'alias': '#room4:server', 'name': 'room4', 'members': 4}
+    assert more and again == (first, True) and second[1]
+    assert [room['alias'] for room in last[0]] == ['#room{}:server'.format(i)
+                                                   for i in range(91, 100)]
+    assert not last[1]
+    assert homeserver.requests == [(None, None), ('30', None), ('60', None), ('90', None)]
+
+
+def test_searches_listed_apart():
+    homeserver = FakeHomeserver(_rooms(30))
+    directory = RoomDirectory()
+
+    rooms, more = directory.page('server', homeserver.fetch, 0, 10, term='room1')
+    directory.page('other', homeserver.fetch, 0, 10, term='room1')
+
+    assert len(rooms) == 10 and more
+    assert homeserver.requests == [(None, 'room1'), (None, 'room1')]
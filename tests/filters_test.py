@@ -0,0 +1,20 @@
+from matrigram.filters import TIMELINE_TYPES
+from matrigram.filters import sync_filter
+
+
+def test_default_filter():
+    definition = sync_filter()
+
+    assert definition['presence'] == {'types': []}
+    assert definition['room']['state']['lazy_load_members']
+    assert definition['room']['timeline'] == {'limit': 10, 'types': TIMELINE_TYPES}
+    assert 'rooms' not in definition['room']['ephemeral']
+
+
+def test_focus_only_filter():
+    definition = sync_filter(focus_only=True, focus_room_id='!room:server', presence=True)
+
+    assert 'presence' not in definition
+    assert definition['room']['timeline']['rooms'] == ['!room:server']
+    assert definition['room']['ephemeral']['rooms'] == ['!room:server']
+    assert sync_filter(focus_only=True)['room']['timeline']['rooms'] == []
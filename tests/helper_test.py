@@ -24,3 +24,10 @@ def test_list_to_nice_lines():
     l = ['room1', 'room2', 'room3']
 
     assert helper.list_to_nice_lines(l) == 'room1\nroom2\nroom3'
+
+
+def test_pack_lines():
+    lines = ['a' * 4, 'b' * 3, 'c' * 2, 'd' * 12, 'e']
+
+    assert helper.pack_lines(lines, 8) == ['aaaa\nbbb', 'cc', 'dddddddd', 'dddd\ne']
+    assert helper.pack_lines([], 8) == []
@@ -0,0 +1,43 @@
+from matrigram.history import RoomHistory
+
+
+def _message(event_id, body, **content):
+    content.update({'msgtype': 'm.text', 'body': body})
+    return {'event_id': event_id, 'type': 'm.room.message', 'sender': '@bob:server',
+            'content': content}
+
+
+def test_history_bounded():
+    history = RoomHistory(size=3)
+    history.seed('!a:server', [])
+    for i in range(5):
+        history.add('!a:server', _message('${}'.format(i), 'x' * 5000))
+    history.add('!a:server', {'event_id': '$member', 'type': 'm.room.member',
+                              'sender': '@bob:server', 'content': {}})
+
+    events = history.get('!a:server')
+
+    assert [event['event_id'] for event in events] == ['$2', '$3', '$4']
+    assert len(events[0]['content']['body']) == 1024
+
+
+def test_history_complete_once_seeded():
+    history = RoomHistory(size=4)
+    history.add('!a:server', _message('$2', 'two'))
+    history.add('!a:server', _message('$3', 'three'))
+    assert history.get('!a:server') is None
+
+    history.seed('!a:server', [_message('$1', 'one'), _message('$2', 'two')])
+    history.add('!a:server', {'event_id': '$4', 'type': 'm.room.topic', 'sender': '@bob:server',
+                              'content': {'topic': 'cats'}})
+    photo = _message('$5', 'cat.jpg', url='mxc://server/cat', info={'mimetype': 'image/jpeg'})
+    photo['content']['msgtype'] = 'm.image'
+    history.add('!a:server', photo)
+
+    events = history.get('!a:server')
+    assert [event['event_id'] for event in events] == ['$2', '$3', '$4', '$5']
+    assert events[2]['content'] == {'topic': 'cats'}
+    assert events[3] == photo
+
+    history.discard('!a:server')
+    assert history.get('!a:server') is None
@@ -0,0 +1,33 @@
+from matrigram.members import MemberIndex
+
+
+def _member(user_id, membership, name=None):
+    return {'type': 'm.room.member', 'state_key': user_id,
+            'content': {'membership': membership, 'displayname': name}}
+
+
+def test_members_paged_by_name():
+    index = MemberIndex()
+    index.load({'@{}:server'.format(i): {'display_name': 'user{:02}'.format(i)}
+                for i in range(25)})
+    index.load({'@anon:server': {}})
+
+    assert index.page(0, 3) == (['@anon:server', 'user00', 'user01'], 26)
+    assert index.page(24, 10) == (['user23', 'user24'], 26)
+    assert index.page(0, 5, prefix='USER1') == (
+        ['user10', 'user11', 'user12', 'user13', 'user14'], 10)
+    assert index.page(5, 10, prefix='user1')[0][-1] == 'user19'
+
+
+def test_members_follow_events():
+    index = MemberIndex()
+    index.on_member_event(_member('@bob:server', 'leave'))
+    index.on_member_event(_member('@carol:server', 'join', 'Carol'))
+    # fetched before the events were seen
+    index.load({'@alice:server': {'display_name': 'Alice'},
+                '@bob:server': {'display_name': 'Bob'}})
+    index.on_member_event(_member('@alice:server', 'join', 'Zed'))
+    index.on_member_event(_member('@carol:server', 'ban'))
+
+    assert index.page() == (['Zed'], 1)
+    assert len(index) == 1
@@ -0,0 +1,77 @@
+import time
+
+import pytest
+import requests
+
+from matrigram.metrics import BridgeMetrics
+from matrigram.metrics import Counter
+from matrigram.metrics import Histogram
+from matrigram.metrics import MetricsServer
+from matrigram.metrics import TELEGRAM_TO_MATRIX
+
+
+class FakeApi(object):
+    def _send(self, method, path, content=None):
+        if path == '/fail':
+            raise ValueError(path)
+        return {}
+
+
+def test_metrics_rendered():
+    metrics = BridgeMetrics()
+    counter = metrics.add(Counter('relays_total', 'Relays.', ('type',)))
+    histogram = metrics.add(Histogram('latency_seconds', 'Latency.', ('type',), (0.1, 1)))
+    counter.inc(('text',))
+    counter.inc(('say "hi"',), 2)
+    for value in (0.05, 0.5, 5):
+        histogram.observe(value, ('text',))
+
+    text = metrics.render()
+
+    assert '# TYPE relays_total counter\n' in text
+    assert 'relays_total{type="say \\"hi\\""} 2\n' in text
+    assert 'relays_total{type="text"} 1\n' in text
+    assert ('latency_seconds_bucket{type="text",le="0.1"} 1\n'
+            'latency_seconds_bucket{type="text",le="1"} 2\n'
+            'latency_seconds_bucket{type="text",le="+Inf"} 3\n'
+            'latency_seconds_sum{type="text"} 5.55\n'
+            'latency_seconds_count{type="text"} 3\n') in text
+    assert '\nmatrigram_threads ' in text
+
+
+def test_relays_and_requests_timed():
+    metrics = BridgeMetrics()
+    api = FakeApi()
+    metrics.watch_homeserver(api)
+
+    api._send('GET', '/rooms/%21a%3Aserver/messages')
+    api._send('post', '/publicRooms', {})
+    api._send('GET', '/sync')
+    with pytest.raises(ValueError):
+        api._send('GET', '/fail')
+    metrics.relay(TELEGRAM_TO_MATRIX, 'photo', lambda: None, time.time() - 10)()
+
+    assert metrics.homeserver_seconds.count(('GET', 'rooms/messages', 'ok')) == 1
+    assert metrics.homeserver_seconds.count(('POST', 'publicRooms', 'ok')) == 1
+    assert metrics.homeserver_seconds.count(('GET', 'fail', 'error')) == 1
+    assert metrics.homeserver_seconds.count(('GET', 'sync', 'ok')) == 0
+    assert metrics.relays.get((TELEGRAM_TO_MATRIX, 'photo')) == 1
+    assert metrics.relay_seconds.count((TELEGRAM_TO_MATRIX, 'photo')) == 1
+    assert 'matrigram_relay_seconds_bucket{direction="telegram_to_matrix",type="photo",le="5"} 0' \
+        in metrics.render()
+
+
+def test_metrics_served():
+    metrics = BridgeMetrics()
+    server = MetricsServer(metrics, port=0)
+    server.start()
+    url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+    res = requests.get(url + '/metrics')
+    missing = requests.get(url + '/other')
+    server.shutdown()
+
+    assert res.status_code == 200
+    assert res.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+    assert '# TYPE matrigram_relay_seconds histogram' in res.text
+    assert missing.status_code == 404
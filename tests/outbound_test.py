@@ -0,0 +1,122 @@
+import time
+
+from telepot.exception import TooManyRequestsError
+
+from matrigram.outbound import ChatActionThrottle
+from matrigram.outbound import PRIORITY_COMMAND
+from matrigram.outbound import SendScheduler
+from matrigram.outbound import TokenBucket
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=2, capacity=2, now=0)
+
+    bucket.take(0)
+    bucket.take(0)
+    assert bucket.delay(0) == 0.5
+    assert bucket.delay(0.5) == 0
+
+    bucket.block(10)
+    assert bucket.delay(1) == 9
+
+
+def test_chat_order_and_priority():
+    scheduler = SendScheduler(senders=2, chat_rate=1000, burst=1)
+    sent = []
+
+    scheduler.submit(1, time.sleep, (0.05,), priority=PRIORITY_COMMAND)
+    for i in range(5):
+        scheduler.submit(1, sent.append, ('relay {}'.format(i),))
+    scheduler.submit(1, sent.append, ('reply',), priority=PRIORITY_COMMAND)
+    scheduler.shutdown()
+
+    assert sent == ['reply'] + ['relay {}'.format(i) for i in range(5)]
+    assert scheduler.stats()['sent'] == 7
+
+
+def test_chat_rate_limit():
+    scheduler = SendScheduler(chat_rate=20, burst=1)
+    sent = []
+
+    start = time.time()
+    for i in range(5):
+        scheduler.submit(1, sent.append, (i,))
+    scheduler.shutdown()
+
+    assert sent == list(range(5))
+    assert time.time() - start >= 0.19
+    assert scheduler.stats()['throttled'] > 0
+
+
+def test_retry_after():
+    scheduler = SendScheduler()
+    calls = []
+
+    def flaky():
+        calls.append(time.time())
+        if len(calls) == 1:
+            raise TooManyRequestsError('Too Many Requests: retry after 1', 429,
+                                       {'parameters': {'retry_after': 0.2}})
+
+    scheduler.submit(1, flaky)
+    scheduler.shutdown()
+
+    assert len(calls) == 2
+    assert calls[1] - calls[0] >= 0.19
+    stats = scheduler.stats()
+    assert stats['retried'] == 1
+    assert stats['sent'] == 1
+    assert stats['queued'] == 0
+
+
+def test_reservation_keeps_order():
+    scheduler = SendScheduler(chat_rate=1000, burst=10)
+    sent = []
+
+    photo = scheduler.reserve(1)
+    scheduler.submit(1, sent.append, ('text',))
+    dropped = scheduler.reserve(1)
+    scheduler.submit(1, sent.append, ('more text',))
+    scheduler.submit(2, sent.append, ('other chat',))
+    time.sleep(0.05)
+    assert sent == ['other chat']
+
+    photo.fill(sent.append, ('photo',))
+    dropped.cancel()
+    scheduler.shutdown()
+
+    assert sent == ['other chat', 'photo', 'text', 'more text']
+    assert scheduler.stats()['queued'] == 0
+
+
+def test_chat_action_throttle():
+    throttle = ChatActionThrottle(window=5)
+
+    assert throttle.allow(1, 'typing')
+    for _ in range(49):
+        assert not throttle.allow(1, 'typing')
+    assert throttle.allow(1, 'upload_photo')
+    assert throttle.allow(2, 'typing')
+    assert throttle.stats() == {'allowed': 3, 'suppressed': 49}
+
+
+def test_chat_action_throttle_window():
+    throttle = ChatActionThrottle(window=0.05)
+
+    assert throttle.allow(1, 'typing')
+    time.sleep(0.06)
+    assert throttle.allow(1, 'typing')
+
+
+def test_chat_action_refresh_within_window():
+    throttle = ChatActionThrottle(window=5)
+
+    assert throttle.allow(1, 'typing')
+    assert throttle.allow(1, 'typing', refresh=True)
+    assert not throttle.allow(1, 'typing')
+
+
+def test_chat_actions_disabled():
+    throttle = ChatActionThrottle(enabled=False)
+
+    assert not throttle.allow(1, 'typing')
@@ -0,0 +1,46 @@
+from matrigram.routing import Router
+
+
+def _router():
+    routes = [
+        ('/login', r'^/login (?P<username>\S+) (?P<password>\S+)$', 'login'),
+        ('/join', r'^/join\s(?P<room_name>[^$]+)$', 'join'),
+        ('/me', r'^/me (?P<text>[^/].*)$', 'emote'),
+        (None, r'^(?P<text>[^/].*)$', 'forward'),
+    ]
+    return Router(routes, command_prefix='/')
+
+
+def test_command_route():
+    callback, match = _router().match('/login user pass')
+
+    assert callback == 'login'
+    assert match.group('username') == 'user'
+    assert match.group('password') == 'pass'
+
+
+def test_text_route():
+    callback, match = _router().match('hello /login')
+
+    assert callback == 'forward'
+    assert match.group('text') == 'hello /login'
+
+
+def test_no_route():
+    router = _router()
+
+    assert router.match('/unknown') == (None, None)
+    assert router.match('/login onlyuser') == (None, None)
+    assert router.match('/me /x') == (None, None)
+    assert router.match('') == (None, None)
+
+
+def test_prefixless_router():
+    router = Router([('LEAVE', r'^LEAVE (?P<room>\S+)$', 'leave'),
+                     ('NOP', r'^NOP$', 'nop')])
+
+    callback, match = router.match('LEAVE #room:server')
+    assert callback == 'leave'
+    assert match.group('room') == '#room:server'
+    assert router.match('NOP')[0] == 'nop'
+    assert router.match('NOPE') == (None, None)
@@ -0,0 +1,41 @@
+from matrigram.sessions import SessionRegistry
+
+
+def test_bidirectional_lookup():
+    registry = SessionRegistry()
+    client = object()
+
+    registry.add(42, client)
+
+    assert registry.get_client(42) is client
+    assert registry.get_chat_id(client) == 42
+    assert 42 in registry
+    assert len(registry) == 1
+
+
+def test_relogin_replaces_client():
+    registry = SessionRegistry()
+    old_client = object()
+    new_client = object()
+
+    registry.add(42, old_client)
+    registry.add(42, new_client)
+
+    assert registry.get_client(42) is new_client
+    assert registry.get_chat_id(old_client) is None
+    assert registry.get_chat_id(new_client) == 42
+    assert len(registry) == 1
+
+
+def test_remove():
+    registry = SessionRegistry()
+    client = object()
+
+    registry.add(42, client)
+    session = registry.remove(42)
+
+    assert session.client is client
+    assert registry.get_client(42) is None
+    assert registry.get_chat_id(client) is None
+    assert registry.remove(42) is None
+    assert not registry.sessions()
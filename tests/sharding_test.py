@@ -0,0 +1,121 @@
+import functools
+import multiprocessing
+import os
+import time
+
+from matrigram.sharding import HashRing
+from matrigram.sharding import ShardSupervisor
+from matrigram.sharding import update_chat_id
+
+
+def _queue():
+    # the shards aren't forked where python can start them fresh
+    if hasattr(multiprocessing, 'get_context'):
+        return multiprocessing.get_context('spawn').Queue()
+    return multiprocessing.Queue()
+
+
+def _update(update_id, chat_id):
+    return {'update_id': update_id, 'message': {'message_id': update_id,
+                                                'chat': {'id': chat_id}}}
+
+
+def test_hash_ring_spreads_keys():
+    ring = HashRing(range(4))
+    counts = [0] * 4
+    for chat_id in range(4000):
+        counts[ring.node_for(chat_id)] += 1
+
+    assert min(counts) > 700
+
+
+def test_hash_ring_moves_only_removed_node_keys():
+    ring = HashRing(range(4))
+    before = dict((chat_id, ring.node_for(chat_id)) for chat_id in range(1000))
+    ring.remove(3)
+
+    for chat_id, node in before.items():
+        if node != 3:
+            assert ring.node_for(chat_id) == node
+        else:
+            assert ring.node_for(chat_id) != 3
+
+
+def test_update_chat_id():
+    callback_query = {'update_id': 1, 'callback_query': {'from': {'id': 2},
+                                                         'message': {'chat': {'id': 3}}}}
+    inline_query = {'update_id': 1, 'inline_query': {'from': {'id': 4}}}
+
+    assert update_chat_id(_update(1, 5)) == 5
+    assert update_chat_id(callback_query) == 3
+    assert update_chat_id(inline_query) == 4
+    assert update_chat_id({'update_id': 1}) is None
+
+
+def _make_handler(results, shard):
+    def handle(update):
+        if update.get('crash'):
+            os._exit(1)
+        results.put((shard, update['update_id']))
+    return handle
+
+
+def _collect(results, count):
+    collected = []
+    for _ in range(count):
+        collected.append(results.get(timeout=10))
+    return collected
+
+
+def test_updates_reach_owning_shard():
+    results = _queue()
+    supervisor = ShardSupervisor(functools.partial(_make_handler, results), 3)
+    supervisor.start()
+
+    for update_id in range(30):
+        supervisor.dispatch(_update(update_id, update_id % 6))
+    collected = _collect(results, 30)
+    supervisor.shutdown(timeout=5)
+
+    for shard, update_id in collected:
+        assert shard == supervisor.shard_for(update_id % 6)
+    assert sorted(update_id for _, update_id in collected) == list(range(30))
+
+
+def test_crashed_shard_restarted():
+    results = _queue()
+    supervisor = ShardSupervisor(functools.partial(_make_handler, results), 2,
+                                 check_interval=0.05)
+    supervisor.start()
+
+    chat_id = 1
+    crash = _update(0, chat_id)
+    crash['crash'] = True
+    supervisor.dispatch(crash)
+    while supervisor.stats()['restarts'] == 0:
+        time.sleep(0.01)
+    supervisor.dispatch(_update(1, chat_id))
+    collected = _collect(results, 1)
+    stats = supervisor.stats()
+    supervisor.shutdown(timeout=5)
+
+    assert collected == [(supervisor.shard_for(chat_id), 1)]
+    assert stats == {'shards': 2, 'alive': 2, 'restarts': 1}
+
+
+def test_waiting_updates_survive_crash():
+    results = _queue()
+    supervisor = ShardSupervisor(functools.partial(_make_handler, results), 2,
+                                 check_interval=0.05)
+    supervisor.start()
+
+    chat_id = 1
+    crash = _update(0, chat_id)
+    crash['crash'] = True
+    supervisor.dispatch(crash)
+    supervisor.dispatch(_update(1, chat_id))
+    supervisor.dispatch(_update(2, chat_id))
+    collected = _collect(results, 2)
+    supervisor.shutdown(timeout=5)
+
+    assert sorted(update_id for _, update_id in collected) == [1, 2]
@@ -0,0 +1,64 @@
+import hashlib
+import io
+
+from matrigram.streaming import HashingReader
+from matrigram.streaming import MultipartStream
+from matrigram.streaming import SizedStream
+from matrigram.streaming import spool
+
+
+def test_multipart_stream():
+    data = b'x' * 1000
+    body = MultipartStream('photo', 'a.jpg', 'image/jpeg', io.BytesIO(data), len(data),
+                           chunk_size=7)
+
+    chunks = list(body)
+    content = b''.join(chunks)
+
+    assert max(len(chunk) for chunk in chunks) <= 7
+    assert len(content) == len(body)
+    boundary = body.content_type.split('boundary=')[1].encode('utf-8')
+    assert content.startswith(b'--' + boundary + b'\r\n')
+    assert b'name="photo"; filename="a.jpg"' in content
+    assert b'\r\n\r\n' + data + b'\r\n--' + boundary + b'--\r\n' in content
+
+
+def test_multipart_stream_short_source():
+    body = MultipartStream('photo', 'a.jpg', 'image/jpeg', io.BytesIO(b'short'), 10)
+
+    try:
+        body.read()
+    except IOError:
+        pass
+    else:
+        assert False, 'short media not detected'
+
+
+def test_sized_stream():
+    stream = SizedStream(io.BytesIO(b'z' * 2500), 2500, chunk_size=1000)
+
+    assert len(stream) == 2500
+    assert [len(chunk) for chunk in stream] == [1000, 1000, 500]
+
+
+def test_hashing_reader():
+    reader = HashingReader(io.BytesIO(b'data'))
+    reader.read(2)
+    reader.read()
+
+    assert reader.hexdigest() == '8d777f385d3dfec8815d20f7496026dc'
+
+
+def test_spool():
+    data = b'y' * 5000
+
+    small, size, digest = spool(io.BytesIO(data), threshold=10000, chunk_size=1000)
+    assert size == 5000
+    assert small.read() == data
+    assert digest == hashlib.md5(data).hexdigest()
+    small.close()
+
+    big, size, _ = spool(io.BytesIO(data), threshold=100, chunk_size=1000)
+    assert big._rolled
+    assert big.read() == data
+    big.close()
@@ -0,0 +1,53 @@
+from threading import Thread
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler
+    from BaseHTTPServer import HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler
+    from http.server import HTTPServer
+    from socketserver import ThreadingMixIn
+
+from matrigram.transport import HttpPool
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        body = b'{"ok": true}'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_connection_reuse(tmpdir):
+    server = ThreadingServer(('127.0.0.1', 0), KeepAliveHandler)
+    thread = Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    media = tmpdir.join('photo.jpg')
+    media.write('data')
+    url = 'http://127.0.0.1:{}/sendPhoto'.format(server.server_address[1])
+
+    pool = HttpPool()
+    for _ in range(5):
+        with open(str(media), 'rb') as f:
+            res = pool.post(url, files={'photo': f})
+        assert res.json() == {'ok': True}
+
+    assert pool.stats() == {'requests': 5, 'connections': 1, 'reused': 4}
+    pool.close()
+    server.shutdown()
+    server.server_close()
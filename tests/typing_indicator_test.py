@@ -0,0 +1,46 @@
+import time
+
+from matrigram.typing_indicator import TypingScheduler
+
+
+def test_refresh_until_stopped():
+    sent = []
+    typing = TypingScheduler(sent.append, interval=0.05, stop_delay=0)
+
+    typing.start(1)
+    time.sleep(0.12)
+    typing.stop(1)
+    time.sleep(0.02)
+    count = len(sent)
+    time.sleep(0.1)
+    typing.shutdown()
+
+    assert count >= 2
+    assert len(sent) == count
+    assert set(sent) == {1}
+    assert not typing.is_typing(1)
+
+
+def test_flapping_is_debounced():
+    sent = []
+    typing = TypingScheduler(sent.append, interval=10, stop_delay=0.05)
+
+    for _ in range(20):
+        typing.start(1)
+        typing.stop(1)
+    typing.start(1)
+    time.sleep(0.1)
+
+    assert sent == [1]
+    assert typing.is_typing(1)
+    typing.shutdown()
+
+
+def test_start_and_stop_dont_block():
+    typing = TypingScheduler(lambda chat_id: time.sleep(1), interval=10)
+
+    start = time.time()
+    typing.start(1)
+    typing.stop(1)
+    typing.start(2)
+    assert time.time() - start < 0.1
@@ -0,0 +1,73 @@
+import json
+import threading
+
+import requests
+
+from matrigram.webhook import SECRET_TOKEN_HEADER
+from matrigram.webhook import WebhookServer
+from matrigram.webhook import extract_message
+
+
+def _serve(secret_token=None):
+    updates = []
+    server = WebhookServer(updates.append, 'secret', secret_token, host='127.0.0.1', port=0)
+    server.start()
+    url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    return server, url, updates
+
+
+def test_updates_handed_over():
+    server, url, updates = _serve()
+    update = {'update_id': 1, 'message': {'text': 'hi'}}
+
+    res = requests.post(url + '/secret', data=json.dumps(update))
+    server.shutdown()
+
+    assert res.status_code == 200
+    assert updates == [update]
+
+
+def test_wrong_path_rejected():
+    server, url, updates = _serve()
+
+    res = requests.post(url + '/guess', data='{}')
+    server.shutdown()
+
+    assert res.status_code == 403
+    assert updates == []
+
+
+def test_secret_token_checked():
+    server, url, updates = _serve('token')
+
+    missing = requests.post(url + '/secret', data='{}')
+    wrong = requests.post(url + '/secret', data='{}', headers={SECRET_TOKEN_HEADER: 'nope'})
+    right = requests.post(url + '/secret', data='{}', headers={SECRET_TOKEN_HEADER: 'token'})
+    server.shutdown()
+
+    assert [missing.status_code, wrong.status_code, right.status_code] == [403, 403, 200]
+    assert updates == [{}]
+
+
+def test_extract_message():
+    assert extract_message({'update_id': 1, 'callback_query': {'data': 'NOP'}}) == {'data': 'NOP'}
+    assert extract_message({'update_id': 1}) is None
+
+
+def test_connections_served_by_fixed_threads():
+    updates = []
+    server = WebhookServer(updates.append, 'secret', host='127.0.0.1', port=0, connections=2)
+    server.start()
+    url = 'http://127.0.0.1:{}/secret'.format(server.server_address[1])
+    before = threading.active_count()
+
+    sessions = [requests.Session() for _ in range(2)]
+    for i in range(6):
+        sessions[i % 2].post(url, data=json.dumps({'update_id': i}))
+    during = threading.active_count()
+    for session in sessions:
+        session.close()
+    server.shutdown()
+
+    assert during == before
+    assert [update['update_id'] for update in updates] == list(range(6))
@@ -0,0 +1,74 @@
+import threading
+import time
+
+from matrigram.workers import ChatExecutor
+
+
+def test_per_key_order():
+    executor = ChatExecutor(workers=4)
+    results = {'a': [], 'b': []}
+
+    def task(key, i):
+        time.sleep(0.001)
+        results[key].append(i)
+
+    for i in range(50):
+        executor.submit('a', task, 'a', i)
+        executor.submit('b', task, 'b', i)
+    executor.shutdown()
+
+    assert results['a'] == list(range(50))
+    assert results['b'] == list(range(50))
+
+
+def test_keys_run_in_parallel():
+    executor = ChatExecutor(workers=2)
+    blocker = threading.Event()
+    done = threading.Event()
+
+    executor.submit('slow', blocker.wait, 5)
+    executor.submit('fast', done.set)
+
+    assert done.wait(5)
+    assert executor.stats()['busy'] == 1
+    blocker.set()
+    executor.shutdown()
+
+
+def test_stats():
+    executor = ChatExecutor(workers=1)
+    blocker = threading.Event()
+
+    executor.submit('a', blocker.wait, 5)
+    executor.submit('a', lambda: None)
+    executor.submit('b', lambda: None)
+    time.sleep(0.05)
+
+    stats = executor.stats()
+    assert stats['workers'] == 1
+    assert stats['queued'] == 2
+    assert stats['keys'] == 2
+    assert stats['max_depth'] == 1
+
+    blocker.set()
+    executor.shutdown()
+    assert executor.stats()['queued'] == 0
+
+
+def test_hold_buffers_until_release():
+    executor = ChatExecutor(workers=2)
+    results = []
+    other = threading.Event()
+
+    executor.hold('a')
+    executor.submit('a', results.append, 1)
+    executor.submit('a', results.append, 2)
+    executor.submit('b', other.set)
+
+    assert other.wait(5)
+    assert not results
+    assert executor.is_held('a')
+
+    executor.release('a')
+    executor.shutdown()
+    assert results == [1, 2]